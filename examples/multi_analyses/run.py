@@ -1,14 +1,11 @@
 import src.btap_batch as btap
 import os
 import yaml
-from datetime import date
 import re
-import itertools
-import multiprocessing
-import concurrent.futures
 
-# Set this to 1 if running locally...or 14 if running on aws.
-NUMBER_OF_PARALLEL_ANALYSES = 1
+# Number of analyses that are run at the same time. They share the capacity of the compute environment, so this can be
+# the number of analyses, unless they have a large memory footprint.
+NUMBER_OF_PARALLEL_ANALYSES = 14
 
 OPTIONS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'input.yml')
 building_types = [
@@ -58,51 +55,37 @@ optimization = {
         "cost_equipment_total_cost_per_m_sq"]
 }
 
-def run_analysis(short_city_name,
-                 building_type,
-                 primary_heating_fuel,
-                 epw_file
-                 ):
-    # Open the yaml in analysis dict.
-    with open(OPTIONS_FILE, 'r') as stream:
-        analysis = yaml.safe_load(stream)
-    #Change configuration options.
-    analysis[':analysis_configuration'][':compute_environment'] = 'local'
-    analysis[':analysis_configuration'][':algorithm'] = optimization
-    analysis[':analysis_configuration'][':analysis_name'] = f"{short_city_name}_{building_type}_{primary_heating_fuel}"
-    analysis[':analysis_configuration'][':kill_database'] = False
-    analysis[':building_options'][':epw_file'] = [epw_file]
-    analysis[':building_options'][':building_type'] = [building_type]
-    analysis[':building_options'][':primary_heating_fuel'] = [primary_heating_fuel]
-    print(analysis[':analysis_configuration'][':analysis_name'])
-    input_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                              f"{analysis[':analysis_configuration'][':analysis_name']}.yml")
-    with open(input_file, 'w') as outfile:
-        yaml.dump(analysis, outfile)
-    analysis = btap.btap_batch(analysis_config_file=input_file, git_api_token=os.environ['GIT_API_TOKEN'])
-    analysis.run()
+# Open the yaml in analysis dict.
+with open(OPTIONS_FILE, 'r') as stream:
+    analysis = yaml.safe_load(stream)
+# Change configuration options shared by all the analyses.
+analysis[':analysis_configuration'][':compute_environment'] = 'local'
+analysis[':analysis_configuration'][':algorithm'] = optimization
+analysis[':analysis_configuration'][':kill_database'] = False
+# Reuse the reference runs of earlier analyses of the same building type, fuel and weather file.
+analysis[':analysis_configuration'][':reference_library'] = True
+input_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'multi_analyses.yml')
+with open(input_file, 'w') as outfile:
+    yaml.dump(analysis, outfile)
 
+# One analysis for each weather file, building type and fuel.
+overrides = []
+for epw_file in epw_files:
+    short_city_name = re.compile("(.*?)\.").search(epw_file)[1]
+    for building_type in building_types:
+        for primary_heating_fuel in primary_heating_fuels:
+            overrides.append({
+                ':analysis_configuration': {':analysis_name': f"{short_city_name}_{building_type}_{primary_heating_fuel}"},
+                ':building_options': {':epw_file': [epw_file],
+                                      ':building_type': [building_type],
+                                      ':primary_heating_fuel': [primary_heating_fuel]}})
 
-# Create parallel analysis in threads.
-with concurrent.futures.ThreadPoolExecutor(NUMBER_OF_PARALLEL_ANALYSES) as executor:
-    futures = []
-    # Iterate through different weather files.
-    for epw_file in epw_files:
-        short_city_name = re.compile("(.*?)\.").search(epw_file)[1]
-        # Iterate through building types.
-        for building_type in building_types:
-            for primary_heating_fuel in primary_heating_fuels:
-                # Executes docker simulation in a thread
-                futures.append(executor.submit(run_analysis,
-                                               short_city_name=short_city_name,
-                                               building_type=building_type,
-                                               primary_heating_fuel=primary_heating_fuel,
-                                               epw_file=epw_file
-                                               ))
-    for future in concurrent.futures.as_completed(futures):
-        print(future.result())
-
-#Sara, I had to eliminate the database to simplify btap_batch.. However.. all you have to do is get the output.xlsx files from
-# each run and concantenate them to a single df and then write to a new excel file.
-
+# Run all the analyses at the same time on one backend. The simulations of the analyses share its capacity.
+combined_database = btap.btap_batch_multi(analysis_config_file=input_file,
+                                          overrides=overrides,
+                                          git_api_token=os.environ['GIT_API_TOKEN'],
+                                          max_parallel_analyses=NUMBER_OF_PARALLEL_ANALYSES)
 
+# The results of all the analyses are in one database. Save them to a single excel file.
+btap.ResultsDatabase(combined_database).read_dataframe().to_excel(
+    os.path.join(os.path.dirname(combined_database), 'output.xlsx'), sheet_name='btap_data')
@@ -4,14 +4,21 @@
 from icecream import ic
 import itertools
 import copy
+import abc
 import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import shutil
-from sklearn import preprocessing
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import ConstantKernel, RBF, WhiteKernel
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.feature_extraction import DictVectorizer
 from pymoo.factory import get_algorithm, get_crossover, get_mutation, get_sampling
 from pymoo.optimize import minimize
 from pymoo.core.problem import ElementwiseProblem
 from pymoo.core.problem import starmap_parallelized_eval
+from pymoo.util.nds.non_dominated_sorting import NonDominatedSorting
+from pymoo.algorithms.moo.nsga2 import calc_crowding_distance
 from multiprocessing.pool import ThreadPool
 import docker
 from docker.errors import DockerException
@@ -19,6 +26,7 @@ import json
 import yaml
 import errno
 import boto3
+import boto3.s3.transfer
 from botocore.config import Config
 import botocore
 import os
@@ -43,6 +51,13 @@ import atexit
 from functools import partial
 import tqdm
 import csv
+import warnings
+import hashlib
+import threading
+import contextlib
+import math
+import sqlite3
+import heapq
 import numpy_financial as npf
 
 np.random.seed(123)
@@ -52,8 +67,8 @@ BTAP_BATCH_VERSION = '1.0.005'
 
 # Maximum AWS CPUS that AWS will allocate for the run.
 MAX_AWS_VCPUS = 500
-# Number of VCPUs that AWSBatch will initialize with.
-# DESIRED_AWS_VCPUS = 50 # Not used currently
+# Number of VCPUs that AWSBatch will initialize with. Only used to warm up a persistent batch pool (:aws_batch_pool).
+DESIRED_AWS_VCPUS = 50
 # Minimum number of CPU should be set to zero.
 MIN_AWS_VCPUS = 0
 # Container allocated VCPU for AWS Batch
@@ -62,6 +77,25 @@ CONTAINER_VCPU = 1
 CONTAINER_MEMORY = 2000
 # Container Storage (GB)
 CONTAINER_STORAGE = 100
+# Container vCPU and memory (MB) of the AWS Batch jobs by building type. Building types that are not listed use
+# CONTAINER_VCPU and CONTAINER_MEMORY. EnergyPlus runs a simulation on a single thread, so only the memory grows with
+# the size of the building. Can be changed with :job_resource_profiles in input.yml.
+JOB_RESOURCE_PROFILES = {
+    'Hospital': {':vcpus': 1, ':memory': 8000},
+    'LargeHotel': {':vcpus': 1, ':memory': 6000},
+    'LargeOffice': {':vcpus': 1, ':memory': 6000},
+    'HighriseApartment': {':vcpus': 1, ':memory': 4000},
+    'SecondarySchool': {':vcpus': 1, ':memory': 4000},
+    'PrimarySchool': {':vcpus': 1, ':memory': 3000},
+    'Outpatient': {':vcpus': 1, ':memory': 3000},
+    'MidriseApartment': {':vcpus': 1, ':memory': 3000}}
+# Largest memory (MB) a job is given when it is resubmitted after running out of memory.
+MAX_JOB_MEMORY = 16000
+# Number of times a job that ran out of memory is resubmitted with twice the memory.
+JOB_OUT_OF_MEMORY_RETRIES = 2
+# Location of the persistent memory (MB) the AWS Batch jobs of each building type were raised to after running out of
+# memory. Later analyses start the jobs of these building types with it.
+JOB_MEMORY_HISTORY_PATH = os.path.join(os.path.expanduser('~'), '.btap_batch', 'job_memory_history.sqlite')
 # AWS Batch Allocation Strategy. https://docs.aws.amazon.com/batch/latest/userguide/allocation-strategies.html
 AWS_BATCH_ALLOCATION_STRATEGY = 'BEST_FIT_PROGRESSIVE'
 # AWS Compute instances types..setting to optimal to let AWS figure it out for me.
@@ -91,8 +125,131 @@ BATCH_JOB_ROLE = 'arn:aws:iam::834599497928:role/batchJobRole'
 BATCH_SERVICE_ROLE = 'arn:aws:iam::834599497928:role/service-role/AWSBatchServiceRole'
 # Max Retry attemps for aws clients.
 AWS_MAX_RETRIES = 12
+# Size of the connection pool of the shared aws clients.
+AWS_CLIENT_MAX_POOL_CONNECTIONS = 64
+# Number of files transferred to and from S3 at the same time.
+S3_TRANSFER_MAX_CONCURRENCY = 32
+# Files larger than this (bytes) are transferred to and from S3 in parts of S3_MULTIPART_CHUNKSIZE bytes.
+S3_MULTIPART_THRESHOLD = 64 * 1024 ** 2
+S3_MULTIPART_CHUNKSIZE = 16 * 1024 ** 2
+# Number of times a failed S3 transfer is retried.
+S3_TRANSFER_MAX_RETRIES = 5
+# Shortest and longest time (s) between AWS Batch job status polls. The poller adapts between these.
+AWS_JOB_POLL_MIN_INTERVAL = 5
+AWS_JOB_POLL_MAX_INTERVAL = 60
+# Maximum number of job ids that AWS Batch describe_jobs accepts in a single call.
+AWS_DESCRIBE_JOBS_MAX_IDS = 100
+# Number of polls in a row that describe_jobs can leave out a watched job before the job is failed. Jobs are left out
+# when they have expired or their id is wrong.
+AWS_JOB_POLL_MAX_MISSING = 5
+# Memory (MB) allowed for each local docker simulation when working out how many can run at once. Can be changed with
+# :container_memory in input.yml.
+DOCKER_CONTAINER_MEMORY = 3000
+# Number of host cpus that are not used for local docker simulations to give a bit of slack.
+DOCKER_RESERVED_CPUS = 2
+# Number of datapoints a warm docker worker container runs before it is replaced by a new one.
+DOCKER_WARM_POOL_MAX_JOBS = 50
+# Folder in the image where btap_cli is run and where warm docker workers mount the analysis folder.
+DOCKER_BTAP_CLI_FOLDER = '/btap_costing/utilities/btap_cli'
+DOCKER_WORKER_MOUNT = '/btap_batch'
+# Default settings of the local_mock compute environment. Can be changed with :local_mock in input.yml. :latency is the
+# median simulation time in seconds, :latency_sigma the sigma of its lognormal distribution and :failure_rate the
+# fraction of datapoints that fail. :threads defaults to the number of cpus.
+LOCAL_MOCK_DEFAULTS = {':latency': 1.0, ':latency_sigma': 0.5, ':failure_rate': 0.0, ':threads': None,
+                       ':hourly_outputs': True, ':seed': 0}
+# Columns of the reference results that describe the run rather than the building. They are not used as the outputs of
+# local_mock simulations.
+LOCAL_MOCK_IGNORED_COLUMNS = ['Unnamed: 0', 'index', 'success', 'eplus_severes', 'eplus_fatals', 'simulation_time',
+                              'run_options', 'container_output', 'datapoint_output_url', 'container_error',
+                              'docker_command']
+# Columns of the reference results that are scaled by the energy and the cost response of the options of a local_mock
+# datapoint.
+LOCAL_MOCK_ENERGY_PREFIXES = ('energy_', 'cost_utility_', 'net_site_eui', 'total_site_eui', 'heating_peak',
+                              'cooling_peak', 'peak_', 'bc_step_code_', 'phius_annual_', 'phius_peak_')
+LOCAL_MOCK_COST_PREFIXES = ('cost_equipment_',)
 # Dockerfile url location
 DOCKERFILE_URL = 'https://raw.githubusercontent.com/canmet-energy/btap_cli/dev/Dockerfile'
+# Default location of the persistent datapoint result cache. Can be changed with :datapoint_cache_folder in input.yml
+DATAPOINT_CACHE_FOLDER = os.path.join(os.path.expanduser('~'), '.btap_batch', 'datapoint_cache')
+# Default maximum size of the datapoint result cache (GB) before least recently used entries are evicted.
+DATAPOINT_CACHE_MAX_SIZE_GB = 20.0
+# Name of the results database file kept in the results/database folder of each analysis.
+RESULTS_DATABASE_FILENAME = 'btap_data.sqlite'
+# Default location of the persistent history of simulation times used to predict the runtime of datapoints. Can be
+# changed with :runtime_history_path in input.yml
+RUNTIME_HISTORY_PATH = os.path.join(os.path.expanduser('~'), '.btap_batch', 'runtime_history.sqlite')
+# Number of simulation times of a compute environment needed before the runtime estimator is trained. Scenarios are
+# submitted in the order they are generated until then.
+RUNTIME_ESTIMATOR_MIN_SAMPLES = 30
+# Largest number of the most recent simulation times the runtime estimator is trained on.
+RUNTIME_ESTIMATOR_MAX_TRAINING_POINTS = 5000
+# Number of generated scenarios that are ordered by their predicted runtime at a time, so very large grids do not have
+# to fit in memory.
+RUNTIME_ORDER_BLOCK_SIZE = 10000
+# Summary of the predicted and actual makespan of an analysis, saved in the results folder.
+RUNTIME_SUMMARY_FILENAME = 'runtime_summary.csv'
+# Settings of the :analysis_configuration that create the backend. The analyses of btap_batch_multi share one backend,
+# so their overrides cannot change these.
+MULTI_ANALYSIS_SHARED_KEYS = [':compute_environment', ':image_name', ':os_version', ':os_standards_branch',
+                              ':btap_costing_branch', ':build_image', ':local_mock', ':max_threads', ':container_memory',
+                              ':docker_warm_pool', ':docker_warm_pool_max_jobs', ':aws_batch_pool',
+                              ':job_resource_profiles']
+# Name of the folder in the project root where btap_batch_multi saves the combined results of its analyses.
+MULTI_ANALYSIS_RESULTS_FOLDER = 'multi_analysis_results'
+# Columns that match a datapoint with the reference (baseline) datapoint of its archetype.
+REFERENCE_KEY_COLUMNS = [':building_type', ':template', ':primary_heating_fuel', ':epw_file']
+# Differences with the baseline added by reference_comparisons. Each entry is the new column, the compared column and
+# whether the difference is a percentage of the baseline value.
+REFERENCE_DIFFERENCE_COLUMNS = [
+    ('baseline_savings_energy_cost_per_m_sq', 'cost_utility_neb_total_cost_per_m_sq', False),
+    ('baseline_difference_energy_eui_electricity_gj_per_m_sq', 'energy_eui_electricity_gj_per_m_sq', False),
+    ('baseline_difference_energy_eui_natural_gas_gj_per_m_sq', 'energy_eui_natural_gas_gj_per_m_sq', False),
+    ('baseline_difference_energy_eui_additional_fuel_gj_per_m_sq', 'energy_eui_additional_fuel_gj_per_m_sq', False),
+    ('baseline_difference_cost_equipment_total_cost_per_m_sq', 'cost_equipment_total_cost_per_m_sq', False),
+    ('baseline_peak_electric_percent_better', 'energy_peak_electric_w_per_m_sq', True),
+    ('baseline_energy_percent_better', 'energy_eui_total_gj_per_m_sq', True),
+    ('baseline_ghg_percent_better', 'cost_utility_ghg_total_kg_per_m_sq', True),
+    ('baseline_difference_npv_total_per_m_sq', 'npv_total_per_m_sq', False)]
+# Operations that can be applied to hourly outputs with the 'operation' key of :output_variables.
+HOURLY_OPERATIONS = ['sum', 'mean', 'max', 'min', 'percentile', 'peak_hour']
+# Conversion factors from the Joules in hourly.csv to the 'unit' key of :output_variables. '*' keeps the file units.
+HOURLY_UNIT_CONVERSIONS = {'GJ': 1.0 / 10 ** 9, 'kWh': 277.778 / 10 ** 9, '*': 1.0}
+# Name of the file with the results of the operations on hourly outputs.
+HOURLY_OPERATIONS_FILENAME = 'sum_hourly_res.csv'
+# Folder in the results folder where hourly outputs are stored as memory mapped float32 blocks and their index file.
+HOURLY_STORE_FOLDER = 'hourly'
+HOURLY_STORE_INDEX_FILENAME = 'index.json'
+# Number of tries to find a design that has not been simulated before the asynchronous optimization stops proposing.
+ASYNC_OPTIMIZATION_MAX_PROPOSAL_ATTEMPTS = 100
+# Number of offspring the surrogate model screens for each simulation. Can be changed with :surrogate_candidates.
+SURROGATE_CANDIDATES = 20
+# Weight of the prediction standard deviation in the lower confidence bound used to pick designs to simulate.
+SURROGATE_CONFIDENCE = 1.0
+# Number of new results after which the surrogate model is retrained.
+SURROGATE_RETRAIN_INTERVAL = 10
+# Largest number of the most recent results the surrogate model is trained on.
+SURROGATE_MAX_TRAINING_POINTS = 1000
+# File in the results folder with the predicted and simulated objectives of the designs chosen by the surrogate model.
+SURROGATE_PREDICTIONS_FILENAME = 'surrogate_predictions.csv'
+# The time (s) spent in each phase of a datapoint is saved in btap_data as a span_<phase>_s column.
+DATAPOINT_SPAN_PREFIX = 'span_'
+DATAPOINT_SPAN_SUFFIX = '_s'
+# Summary of the time spent in each phase of the datapoints of an analysis, saved in the results folder.
+TIMING_SUMMARY_FILENAME = 'timing_summary.csv'
+# Percentiles of the phase times reported in the timing summary.
+TIMING_SUMMARY_PERCENTILES = [50, 90, 99]
+# Number of datapoints per thread that are kept submitted ahead of the running ones. Scenarios are generated as they are
+# submitted so memory use does not grow with the size of the analysis.
+SCENARIO_SUBMISSION_WINDOW_FACTOR = 2
+# run_options keys that do not change the simulation itself and are therefore left out of the datapoint cache key.
+DATAPOINT_CACHE_IGNORED_KEYS = [':datapoint_id', ':analysis_id', ':analysis_name', ':algorithm', ':algorithm_type',
+                                ':scenario', ':compute_environment', ':btap_batch_version', ':s3_bucket', ':nocache',
+                                ':kill_database', ':run_reference', ':datapoint_cache', ':datapoint_cache_folder',
+                                ':datapoint_cache_max_size_gb', ':export_database_csv', ':max_threads',
+                                ':container_memory', ':docker_warm_pool', ':docker_warm_pool_max_jobs', ':resume',
+                                ':local_mock', 'docker_command', ':reference_library',
+                                ':aws_batch_pool', ':job_resource_profiles', ':runtime_estimator',
+                                ':runtime_history_path']
 
 
 # Custom exception for a failed simulation
@@ -109,15 +266,223 @@ class OSMErrorException(Exception):
     pass
 
 
+# Process wide cache of boto3 clients. boto3 clients are thread safe, so a single client per service is shared by all
+# threads instead of creating new clients for each datapoint or file.
+class AWSClients:
+    clients = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, service_name, max_pool_connections=AWS_CLIENT_MAX_POOL_CONNECTIONS):
+        key = (service_name, max_pool_connections)
+        # Creating clients from the default session is not thread safe, so creation is done under the lock.
+        with cls.lock:
+            if key not in cls.clients:
+                cls.clients[key] = boto3.client(service_name,
+                                                config=Config(max_pool_connections=max_pool_connections,
+                                                              retries={'max_attempts': AWS_MAX_RETRIES,
+                                                                       'mode': 'standard'}))
+            return cls.clients[key]
+
+
+# Shared engine for S3 transfers. It holds a single pooled S3 client for the process, runs file transfers in parallel,
+# uses multipart transfers for large files, skips files that are already up to date and retries failed transfers with
+# exponential backoff. It keeps aggregate transfer statistics for the process.
+class S3TransferManager:
+    shared_manager = None
+    shared_lock = threading.Lock()
+
+    # Returns the process wide transfer manager, creating it on first use.
+    @classmethod
+    def shared(cls):
+        with cls.shared_lock:
+            if cls.shared_manager is None:
+                cls.shared_manager = cls()
+            return cls.shared_manager
+
+    def __init__(self,
+                 # Number of files transferred at the same time.
+                 max_concurrency=S3_TRANSFER_MAX_CONCURRENCY,
+                 # Files larger than this (bytes) are transferred in parts.
+                 multipart_threshold=S3_MULTIPART_THRESHOLD,
+                 # Size of each part (bytes).
+                 multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                 # Number of times a failed transfer is retried.
+                 max_retries=S3_TRANSFER_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.client = AWSClients.get('s3', max_pool_connections=max(max_concurrency * 2,
+                                                                    AWS_CLIENT_MAX_POOL_CONNECTIONS))
+        self.transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=multipart_threshold,
+                                                                multipart_chunksize=multipart_chunksize)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='s3_transfer')
+        self.lock = threading.Lock()
+        self.files_uploaded = 0
+        self.files_downloaded = 0
+        self.files_skipped = 0
+        self.files_copied = 0
+        self.bytes_transferred = 0
+        self.first_transfer_time = None
+        self.last_transfer_time = None
+
+    # Uploads all files in a folder, keeping the folder structure under the target prefix.
+    def upload_folder(self, bucket_name, source_folder, target_folder, skip_unchanged=True):
+        files = [file for file in glob.glob(os.path.join(source_folder, '**', '*'), recursive=True)
+                 if os.path.isfile(file)]
+        futures = []
+        for file in files:
+            target_path = os.path.join(target_folder, os.path.relpath(file, source_folder))
+            # s3 likes forward slashes.
+            target_path = target_path.replace('\\', '/')
+            futures.append(self.executor.submit(self.upload_file, file, bucket_name, target_path,
+                                                skip_unchanged=skip_unchanged))
+        self.__wait(futures)
+
+    # Downloads all objects under a prefix, keeping the folder structure under the local folder.
+    def download_folder(self, bucket_name, s3_folder, local_dir, skip_unchanged=True):
+        futures = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_folder):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith('/'):
+                    continue
+                relative_key = obj['Key'][len(s3_folder):].lstrip('/')
+                target = os.path.join(local_dir, *relative_key.split('/'))
+                # The listing already has the size and etag, so up to date files are skipped without extra requests.
+                if skip_unchanged and self.__is_unchanged(target, obj['Size'], obj['ETag']):
+                    self.__record_skip()
+                    continue
+                futures.append(self.executor.submit(self.download_file, bucket_name, obj['Key'], target))
+        self.__wait(futures)
+
+    # Uploads a single file. If skip_unchanged is set, the file is not uploaded when the object on S3 has the same
+    # size and etag.
+    def upload_file(self, file, bucket_name, target_path, skip_unchanged=False):
+        if skip_unchanged:
+            try:
+                head = self.client.head_object(Bucket=bucket_name, Key=target_path)
+                if self.__is_unchanged(file, head['ContentLength'], head['ETag']):
+                    self.__record_skip()
+                    return
+            except botocore.exceptions.ClientError as err:
+                if err.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+                    raise
+        logging.info(f"uploading {file} to s3 bucket {bucket_name} target {target_path}")
+        self.__retry(lambda: self.client.upload_file(file, bucket_name, target_path, Config=self.transfer_config),
+                     f"upload of {file}")
+        self.__record_transfer(os.path.getsize(file), upload=True)
+
+    # Downloads a single object.
+    def download_file(self, bucket_name, key, target):
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        self.__retry(lambda: self.client.download_file(bucket_name, key, target, Config=self.transfer_config),
+                     f"download of s3://{bucket_name}/{key}")
+        self.__record_transfer(os.path.getsize(target), upload=False)
+
+    # Returns the content of an object as a utf-8 string.
+    def read_object(self, bucket_name, key):
+        body = self.__retry(lambda: self.client.get_object(Bucket=bucket_name, Key=key)['Body'].read(),
+                            f"read of s3://{bucket_name}/{key}")
+        self.__record_transfer(len(body), upload=False)
+        return body.decode('utf-8')
+
+    # Copies an object from one location to another on S3 without downloading it. Large objects are copied in parts.
+    def copy_object(self, source_bucket_name, source_key, bucket_name, target_path):
+        logging.info(f"copying s3://{source_bucket_name}/{source_key} to s3://{bucket_name}/{target_path}")
+        self.__retry(lambda: self.client.copy({'Bucket': source_bucket_name, 'Key': source_key}, bucket_name,
+                                              target_path, Config=self.transfer_config),
+                     f"copy of s3://{source_bucket_name}/{source_key}")
+        with self.lock:
+            self.files_copied += 1
+
+    # Deletes all objects under a prefix, up to 1000 per request.
+    def delete_folder(self, bucket_name, s3_folder):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_folder):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if len(objects) > 0:
+                self.client.delete_objects(Bucket=bucket_name, Delete={'Objects': objects})
+
+    # Aggregate statistics of the transfers done by this manager.
+    def stats(self):
+        with self.lock:
+            elapsed = 0.0
+            if self.first_transfer_time is not None:
+                elapsed = self.last_transfer_time - self.first_transfer_time
+            return {'files_uploaded': self.files_uploaded,
+                    'files_downloaded': self.files_downloaded,
+                    'files_skipped': self.files_skipped,
+                    'files_copied': self.files_copied,
+                    'megabytes_transferred': self.bytes_transferred / 1024 ** 2,
+                    'throughput_mb_per_s': self.bytes_transferred / 1024 ** 2 / elapsed if elapsed > 0 else 0.0}
+
+    # Etag that S3 gives a file uploaded with this manager's multipart settings.
+    def local_etag(self, file):
+        part_md5s = []
+        whole_md5 = hashlib.md5()
+        with open(file, 'rb') as stream:
+            for part in iter(lambda: stream.read(self.transfer_config.multipart_chunksize), b''):
+                part_md5s.append(hashlib.md5(part).digest())
+                whole_md5.update(part)
+        if os.path.getsize(file) < self.transfer_config.multipart_threshold:
+            return f'"{whole_md5.hexdigest()}"'
+        return f'"{hashlib.md5(b"".join(part_md5s)).hexdigest()}-{len(part_md5s)}"'
+
+    def __is_unchanged(self, file, size, etag):
+        if not os.path.isfile(file) or os.path.getsize(file) != size:
+            return False
+        return self.local_etag(file) == etag
+
+    def __retry(self, transfer, description):
+        n = 0
+        while True:
+            try:
+                return transfer()
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, OSError) as err:
+                # Missing objects will not appear by retrying.
+                if isinstance(err, botocore.exceptions.ClientError) and \
+                        err.response['Error']['Code'] in ['404', 'NoSuchKey', '403', 'AccessDenied']:
+                    raise
+                if n == self.max_retries:
+                    logging.error(f"Failed {description} in {n + 1} tries while using exponential backoff. {err}")
+                    raise
+                wait_time = 2 ** n + random()
+                logging.warning(f"Implementing exponential backoff for {description} for {wait_time}s. {err}")
+                time.sleep(wait_time)
+                n += 1
+
+    def __wait(self, futures):
+        # Raise the first error after all transfers have finished.
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if len(errors) > 0:
+            raise errors[0]
+
+    def __record_transfer(self, size, upload=True):
+        with self.lock:
+            now = time.time()
+            if self.first_transfer_time is None:
+                self.first_transfer_time = now
+            self.last_transfer_time = now
+            self.bytes_transferred += size
+            if upload:
+                self.files_uploaded += 1
+            else:
+                self.files_downloaded += 1
+
+    def __record_skip(self):
+        with self.lock:
+            self.files_skipped += 1
+
+
 # Blob Storage operations
 
 
 class S3:
     # Constructor
     def __init__(self):
-        # Create the s3 client.
-        config = Config(retries={'max_attempts': AWS_MAX_RETRIES, 'mode': 'standard'})
-        self.s3 = boto3.client('s3', config=config)
+        # Use the shared transfer manager and its pooled s3 client.
+        self.transfer_manager = S3TransferManager.shared()
+        self.s3 = self.transfer_manager.client
 
     # Method to delete a bucket. Not used
     def delete_bucket(self, bucket_name):
@@ -130,7 +495,7 @@ class S3:
     def check_bucket_exists(self, bucket_name):
         exists = True
         try:
-            self.s3.meta.client.head_bucket(Bucket=bucket_name)
+            self.s3.head_bucket(Bucket=bucket_name)
         except botocore.exceptions.ClientError as e:
             # If a client error is thrown, then check that it was a 404 error.
             # If it was a 404 error, then the bucket does not exist.
@@ -153,7 +518,7 @@ class S3:
             ObjectLockEnabledForBucket=False
         )
 
-    # Method to download folder. Single threaded.
+    # Method to download folder. Files are downloaded in parallel and files that are already up to date are skipped.
     def download_s3_folder(self, bucket_name, s3_folder, local_dir=None):
         """
         Download the contents of a folder directory
@@ -162,49 +527,47 @@ class S3:
             s3_folder: the folder path in the s3 bucket
             local_dir: a relative or absolute directory path in the local file system
         """
-        bucket = self.s3.Bucket(bucket_name)
-        for obj in bucket.objects.filter(Prefix=s3_folder):
-            target = obj.key if local_dir is None \
-                else os.path.join(local_dir, os.path.basename(obj.key))
-            if not os.path.exists(os.path.dirname(target)):
-                os.makedirs(os.path.dirname(target))
-            bucket.download_file(obj.key, target)
+        if local_dir is None:
+            local_dir = s3_folder
+        self.transfer_manager.download_folder(bucket_name, s3_folder, local_dir)
 
     # Delete S3 folder.
     def delete_s3_folder(self, bucket, folder):
-        bucket = self.s3.Bucket(bucket)
-        bucket.objects.filter(Prefix=folder).delete()
-
-    # Copy folder to S3. Single thread.
-    def copy_folder_to_s3(self, bucket_name, source_folder, target_folder):
-        # Get files in folder.
-        files = glob.glob(source_folder + '/**/*', recursive=True)
-        # Go through all files recursively.
-        for file in files:
-            target_path = file.replace(source_folder, target_folder)
-            # s3 likes forward slashes.
-            target_path = target_path.replace('\\', '/')
-            message = "Uploading %s..." % target_path
-            logging.info(message)
+        self.transfer_manager.delete_folder(bucket, folder)
 
-            self.s3.upload_file(file, bucket_name, target_path)
+    # Copy folder to S3. Files are uploaded in parallel. If skip_unchanged is set, files already on S3 with the same
+    # content are not uploaded again.
+    def copy_folder_to_s3(self, bucket_name, source_folder, target_folder, skip_unchanged=True):
+        message = f"Uploading {source_folder} to s3 bucket {bucket_name} folder {target_folder}"
+        logging.info(message)
+        self.transfer_manager.upload_folder(bucket_name, source_folder, target_folder, skip_unchanged=skip_unchanged)
 
     # Method to upload a file to S3.
     def upload_file(self, file, bucket_name, target_path):
-        logging.info(f"uploading {file} to s3 bucket {bucket_name} target {target_path}")
-        self.s3.upload_file(file, bucket_name, target_path)
+        self.transfer_manager.upload_file(file, bucket_name, target_path)
 
 
 # Class to authenticate to AWS and to get account information
 class AWSCredentials:
+    shared_credentials = None
+    shared_lock = threading.Lock()
+
+    # Returns the process wide credentials, getting the caller identity from AWS on first use only.
+    @classmethod
+    def shared(cls):
+        with cls.shared_lock:
+            if cls.shared_credentials is None:
+                cls.shared_credentials = cls()
+            return cls.shared_credentials
+
     # Initialize with required clients.
     def __init__(self):
-        config = Config(retries={'max_attempts': AWS_MAX_RETRIES, 'mode': 'standard'})
-        self.sts = boto3.client('sts', config=config)
-        self.iam = boto3.client('iam', config=config)
+        self.sts = AWSClients.get('sts')
+        self.iam = AWSClients.get('iam')
         try:
-            self.account_id = self.sts.get_caller_identity()["Account"]
-            self.user_id = self.sts.get_caller_identity()["UserId"]
+            identity = self.sts.get_caller_identity()
+            self.account_id = identity["Account"]
+            self.user_id = identity["UserId"]
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == 'ExpiredToken':
                 logging.error(
@@ -227,17 +590,321 @@ class AWSCredentials:
             self.user_name = re.compile(".*:(.*)@.*").search(self.user_id)[1]
 
         # User ARN (Not used currently)
-        self.user_arn = self.sts.get_caller_identity()["Arn"]
+        self.user_arn = identity["Arn"]
         # AWS Region name.
         self.region_name = boto3.Session().region_name
 
 
+# Tracks every AWS Batch job that is in flight and polls their status together. Jobs are described in chunks of
+# AWS_DESCRIBE_JOBS_MAX_IDS per API call on an interval that shortens while jobs are changing state and lengthens while
+# they are not. Each watched job has a future that is completed as soon as the job succeeds or fails.
+class AWSBatchJobPoller:
+    def __init__(self,
+                 # Function taking a list of job ids and returning the describe_jobs response.
+                 describe_jobs=None,
+                 min_interval=AWS_JOB_POLL_MIN_INTERVAL,
+                 max_interval=AWS_JOB_POLL_MAX_INTERVAL,
+                 max_missing=AWS_JOB_POLL_MAX_MISSING):
+        self.describe_jobs = describe_jobs
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_missing = max_missing
+        self.interval = min_interval
+        self.lock = threading.Lock()
+        # Dict of job_id to job name, last known status, status history and the future to complete.
+        self.jobs = {}
+        self.wake_up = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Start watching a submitted job. Returns a future with the describe_jobs description of the finished job.
+    def watch(self, job_id, job_name):
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.jobs[job_id] = {'job_name': job_name, 'status': None, 'status_times': {}, 'missing': 0,
+                                 'future': future}
+            if self.thread is None or not self.thread.is_alive():
+                self.stopped.clear()
+                self.thread = threading.Thread(target=self.__poll, name='aws_batch_job_poller', daemon=True)
+                self.thread.start()
+            # Poll soon so the new job is picked up without waiting a long interval.
+            self.interval = self.min_interval
+        self.wake_up.set()
+        return future
+
+    def number_of_jobs(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def stop(self):
+        self.stopped.set()
+        self.wake_up.set()
+        if self.thread is not None:
+            self.thread.join()
+        # Release any thread still waiting on a job that will no longer be polled.
+        with self.lock:
+            for job_id, item in self.jobs.items():
+                item['future'].set_exception(Exception(f"Stopped polling AWS Batch job {job_id}"))
+            self.jobs = {}
+
+    def __poll(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                interval = self.interval
+            self.wake_up.wait(interval)
+            self.wake_up.clear()
+            if self.stopped.is_set():
+                break
+            with self.lock:
+                job_ids = list(self.jobs.keys())
+            if len(job_ids) == 0:
+                with self.lock:
+                    self.interval = self.max_interval
+                continue
+            changed = False
+            for i in range(0, len(job_ids), AWS_DESCRIBE_JOBS_MAX_IDS):
+                chunk = job_ids[i:i + AWS_DESCRIBE_JOBS_MAX_IDS]
+                try:
+                    response = self.describe_jobs(chunk)
+                except Exception as err:
+                    logging.warning(f"Could not get status of AWS Batch jobs. Will try again. {err}")
+                    continue
+                for job in response['jobs']:
+                    changed = self.__update(job) or changed
+                described = set(job['jobId'] for job in response['jobs'])
+                for job_id in chunk:
+                    if job_id not in described:
+                        changed = self.__missing(job_id) or changed
+            # Poll faster while jobs are changing state, slow down while they are queued or running.
+            with self.lock:
+                if changed:
+                    self.interval = max(self.min_interval, self.interval / 2.0)
+                else:
+                    self.interval = min(self.max_interval, self.interval * 1.5)
+
+    # Counts a poll that did not describe a job. The job is failed once it has been missing max_missing polls in a row.
+    # Returns True if the job was failed.
+    def __missing(self, job_id):
+        with self.lock:
+            item = self.jobs.get(job_id)
+            if item is None:
+                return False
+            item['missing'] += 1
+            if item['missing'] < self.max_missing:
+                return False
+            del self.jobs[job_id]
+        message = f"AWS Batch job [{item['job_name']} - {job_id}] was not found in {self.max_missing} polls in a row."
+        logging.error(message)
+        item['future'].set_exception(Exception(message))
+        return True
+
+    # Records the status of a job and completes its future if it has finished. Returns True if the status changed.
+    def __update(self, job):
+        with self.lock:
+            item = self.jobs.get(job['jobId'])
+            if item is None:
+                return False
+            item['missing'] = 0
+            if item['status'] == job['status']:
+                return False
+            item['status'] = job['status']
+            item['status_times'][job['status']] = time.time()
+            if job['status'] in ['SUCCEEDED', 'FAILED']:
+                del self.jobs[job['jobId']]
+            else:
+                return True
+        job['status_times'] = item['status_times']
+        if job['status'] == 'SUCCEEDED':
+            logging.info('SUCCEEDED - Job [%s - %s] %s' % (item['job_name'], job['jobId'], job['status']))
+        else:
+            logging.error('FAILED - Job [%s - %s] %s' % (item['job_name'], job['jobId'], job['status']))
+        item['future'].set_result(job)
+        return True
+
+
+# Shared budget of datapoints running at the same time on a backend. Every datapoint takes a slot before it is submitted
+# and gives it back when it is done. When the slots are all taken, a free slot goes to the waiting datapoint with the
+# lowest priority, then to the group (analysis) with the fewest running datapoints, then to the one that asked first.
+# This lets several analyses, such as the stages of an IDP or the analyses of btap_batch_multi, share one backend
+# fairly without running more datapoints than it has capacity for. Each waiting datapoint has its own event, so a
+# release only wakes the datapoint that gets the slot.
+class WorkerSlots:
+    def __init__(self, size=1):
+        self.size = max(1, int(size))
+        self.lock = threading.Lock()
+        self.running = 0
+        # Number of running datapoints of each group.
+        self.group_running = {}
+        # Waiting datapoints by arrival number. Values are (priority, group, event).
+        self.waiting = {}
+        self.counter = itertools.count()
+        # Number of analyses of each group that are submitting datapoints. Used to share the threads between them.
+        self.active_groups = {}
+
+    def acquire(self, priority=0, group=None):
+        with self.lock:
+            if self.running < self.size and len(self.waiting) == 0:
+                self.__grant(group)
+                return
+            event = threading.Event()
+            self.waiting[next(self.counter)] = (priority, group, event)
+        event.wait()
+
+    def release(self, group=None):
+        with self.lock:
+            self.running -= 1
+            self.group_running[group] -= 1
+            if self.group_running[group] == 0:
+                del self.group_running[group]
+            self.__dispatch()
+
+    # Registers an analysis of the group that is about to submit its datapoints.
+    def join(self, group=None):
+        with self.lock:
+            self.active_groups[group] = self.active_groups.get(group, 0) + 1
+
+    def leave(self, group=None):
+        with self.lock:
+            self.active_groups[group] -= 1
+            if self.active_groups[group] == 0:
+                del self.active_groups[group]
+
+    # Number of threads an analysis should use to submit datapoints. The slots are shared equally between the groups
+    # that are submitting datapoints, so the analyses on a backend together start about as many threads as there are
+    # slots instead of each starting one per slot.
+    def share(self):
+        with self.lock:
+            return max(1, math.ceil(self.size / max(1, len(self.active_groups))))
+
+    def __grant(self, group):
+        self.running += 1
+        self.group_running[group] = self.group_running.get(group, 0) + 1
+
+    def __dispatch(self):
+        while self.running < self.size and len(self.waiting) > 0:
+            arrival = min(self.waiting, key=lambda number: (self.waiting[number][0],
+                                                            self.group_running.get(self.waiting[number][1], 0),
+                                                            number))
+            priority, group, event = self.waiting.pop(arrival)
+            self.__grant(group)
+            event.set()
+
+
+# Guards the creation of the worker slots of a backend.
+WORKER_SLOTS_LOCK = threading.Lock()
+
+
+# Interface of the backends that run datapoints. A backend is chosen by :compute_environment from BATCH_BACKENDS and
+# created with create_batch. The analyses only use the methods below, so a new backend only has to implement them.
+class BatchBackend(abc.ABC):
+    def __init__(self):
+        # Worker slots shared by the analyses. Created by get_worker_slots when first used, since some backends only
+        # know their capacity once they are set up.
+        self.worker_slots = None
+
+    # Creates the backend from the :analysis_configuration of the input file.
+    @classmethod
+    @abc.abstractmethod
+    def from_analysis_config(cls, analysis_config=None, git_api_token=None):
+        pass
+
+    # Prepares the backend before any datapoint is submitted, for example building the image.
+    def setup(self):
+        pass
+
+    # Frees the resources of the backend when the analyses are finished.
+    def tear_down(self):
+        pass
+
+    # Capacity of the backend. Number of datapoints that can be run at the same time.
+    @abc.abstractmethod
+    def get_threads(self):
+        pass
+
+    # Identity of what runs the simulations. Used in the datapoint cache key.
+    @abc.abstractmethod
+    def image_identity(self):
+        pass
+
+    # Lets the backend record its jobs so a resumed analysis can re-attach to them. Only needed by backends whose jobs
+    # outlive the analysis process.
+    def register_job_ledger(self, analysis_id, job_ledger):
+        pass
+
+    # Worker slots shared by all the analyses that run on this backend. Sized by get_threads when first used.
+    def get_worker_slots(self):
+        with WORKER_SLOTS_LOCK:
+            if self.worker_slots is None:
+                self.worker_slots = WorkerSlots(self.get_threads())
+        return self.worker_slots
+
+    # Submits a datapoint, waits for it to finish and collects its results. The run_options.yml file of the datapoint is
+    # in local_datapoint_input_folder. Returns the btap_data dict of the datapoint with 'success' set to True or False.
+    # The time spent in each phase is added to the DatapointTimer timer.
+    @abc.abstractmethod
+    def submit_job(self,
+                   output_folder,
+                   local_btap_data_path,
+                   local_datapoint_input_folder,
+                   local_datapoint_output_folder,
+                   run_options,
+                   timer=None):
+        pass
+
+
+# Memory (MB) the jobs of each building type needed, kept in a SQLite table shared by all the analyses on this machine.
+# Only the largest memory of a building type is kept.
+class JobMemoryHistory:
+    def __init__(self, history_path=JOB_MEMORY_HISTORY_PATH):
+        self.history_path = history_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+        # Other analyses may be writing to the history. Wait for their transactions instead of failing.
+        self.connection = sqlite3.connect(self.history_path, timeout=60.0, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS job_memory ('
+                                    'building_type TEXT PRIMARY KEY, '
+                                    'memory INTEGER, '
+                                    'updated REAL)')
+            self.connection.commit()
+
+    # Returns the memory of each building type in the history.
+    def get(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT building_type, memory FROM job_memory').fetchall())
+
+    # Records the memory a job of the building type needed, unless a larger one is already recorded.
+    def put(self, building_type, memory):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT INTO job_memory (building_type, memory, updated) VALUES (?, ?, ?) '
+                                        'ON CONFLICT(building_type) DO UPDATE SET '
+                                        'memory = MAX(memory, excluded.memory), updated = excluded.updated',
+                                        (building_type, int(memory), time.time()))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
 # Class to manage a AWS Batch run
-class AWSBatch:
+class AWSBatch(BatchBackend):
     @classmethod
     def get_threads(cls):
         return MAX_AWS_VCPUS
 
+    @classmethod
+    def from_analysis_config(cls, analysis_config=None, git_api_token=None):
+        return cls(analysis_id=analysis_config[':analysis_id'],
+                   btap_image_name=analysis_config[':image_name'],
+                   rebuild_image=analysis_config[':nocache'],
+                   git_api_token=git_api_token,
+                   os_version=analysis_config[':os_version'],
+                   btap_costing_branch=analysis_config[':btap_costing_branch'],
+                   os_standards_branch=analysis_config[':os_standards_branch'],
+                   batch_pool=analysis_config.get(':aws_batch_pool'),
+                   job_resource_profiles=analysis_config.get(':job_resource_profiles'))
+
     """
     This class  manages creating an aws batch workflow, simplifies creating jobs and manages tear down of the
     aws batch. This is opposed to using the aws web console to configure the batch run. That method can lead to problems in
@@ -256,8 +923,16 @@ class AWSBatch:
                  os_version=None,
                  btap_costing_branch=None,
                  os_standards_branch=None,
+                 # Name of a persistent compute environment and job queue shared by analyses. None creates them for
+                 # this analysis and deletes them on tear_down.
+                 batch_pool=None,
+                 # vCPU and memory of the jobs by building type. Replaces the entries of JOB_RESOURCE_PROFILES.
+                 job_resource_profiles=None,
+                 # Location of the memory the jobs of each building type needed in earlier analyses.
+                 job_memory_history_path=JOB_MEMORY_HISTORY_PATH
                  ):
-        self.credentials = AWSCredentials()
+        super().__init__()
+        self.credentials = AWSCredentials.shared()
         self.bucket = self.credentials.account_id
         self.image_name = btap_image_name
         self.rebuild_image = rebuild_image
@@ -266,20 +941,13 @@ class AWSBatch:
         self.btap_costing_branch = btap_costing_branch
         self.os_standards_branch = os_standards_branch
 
-        # Create the aws clients required.
-        config = Config(retries={'max_attempts': AWS_MAX_RETRIES, 'mode': 'standard'})
-        self.ec2 = boto3.client('ec2', config=config)
-        self.batch_client = boto3.client('batch', config=botocore.client.Config(max_pool_connections=self.get_threads(),
-                                                                                retries={
-                                                                                    'max_attempts': AWS_MAX_RETRIES,
-                                                                                    'mode': 'standard'}))
-        self.iam = boto3.client('iam', config=config)
-        self.s3 = boto3.client('s3', config=botocore.client.Config(max_pool_connections=self.get_threads(),
-                                                                   retries={'max_attempts': AWS_MAX_RETRIES,
-                                                                            'mode': 'standard'}))
-        self.cloudwatch = boto3.client('logs')
-        self.ecr = boto3.client('ecr')
-        self.cloudwatch = boto3.client('logs')
+        # Get the shared aws clients required.
+        self.ec2 = AWSClients.get('ec2')
+        self.batch_client = AWSClients.get('batch', max_pool_connections=self.get_threads())
+        self.iam = AWSClients.get('iam')
+        self.s3 = S3TransferManager.shared().client
+        self.ecr = AWSClients.get('ecr')
+        self.cloudwatch = AWSClients.get('logs')
         # Todo create cloud build service role.
         self.cloudbuild_service_role = CLOUD_BUILD_SERVICE_ROLE
 
@@ -294,8 +962,13 @@ class AWSBatch:
         else:
             self.analysis_id = analysis_id
 
-        # Compute id is the same as analysis id but stringed.
-        self.compute_environment_id = f"{self.credentials.user_name.replace('.', '_')}-{self.analysis_id}"
+        # Compute id is the same as analysis id but stringed. A batch pool is named after the pool instead, so the
+        # analyses that use it find it again.
+        self.batch_pool = batch_pool
+        if self.batch_pool is None:
+            self.compute_environment_id = f"{self.credentials.user_name.replace('.', '_')}-{self.analysis_id}"
+        else:
+            self.compute_environment_id = f"{self.credentials.user_name.replace('.', '_')}-pool-{self.batch_pool}"
 
         # Set up the job def as a suffix of the compute_environment_id"
         self.job_def_id = f"{self.compute_environment_id}_job_def"
@@ -311,7 +984,24 @@ class AWSBatch:
         security_groups = self.ec2.describe_security_groups()["SecurityGroups"]
         self.securityGroupIds = [security_group['GroupId'] for security_group in security_groups]
 
+        # Single poller that tracks the status of all jobs submitted by this object.
+        self.job_poller = AWSBatchJobPoller(describe_jobs=self.__get_job_status)
+
+        # vCPU and memory given to the jobs of each building type. The memory of a building type is raised when one of
+        # its jobs runs out of memory, so the next jobs start with enough. The memory is saved in the job memory history
+        # and the profiles start from it, so later analyses do not run out of memory again.
+        self.job_resource_profiles = copy.deepcopy(JOB_RESOURCE_PROFILES)
+        self.job_resource_profiles.update(job_resource_profiles or {})
+        self.job_resource_lock = threading.Lock()
+        self.job_memory_history = JobMemoryHistory(job_memory_history_path)
+        self.seed_job_memory(self.job_memory_history.get())
+
+        # Job ledgers of the analyses using this object by analysis_id. Jobs are recorded in them so that a resumed
+        # analysis can re-attach to jobs that are still running.
+        self.job_ledgers = {}
+
         # On exit deconstructor
+        self.torn_down = False
         atexit.register(self.tear_down)
 
     def setup(self):
@@ -319,24 +1009,64 @@ class AWSBatch:
         self.build_image()
         self.__create_compute_environment()
         self.__create_job_queue()
-        self.__register_job_definition()
+        if self.batch_pool is None:
+            self.__register_job_definition()
+        else:
+            # The pool keeps one job definition per image digest. Scale up so instances start before the queue fills.
+            self.__attach_job_definition()
+            self.__scale_compute_environment(min_vcpus=MIN_AWS_VCPUS, desired_vcpus=DESIRED_AWS_VCPUS)
         print("Completed AWS batch initialization.")
 
+    def register_job_ledger(self, analysis_id, job_ledger):
+        self.job_ledgers[analysis_id] = job_ledger
+
     def tear_down(self):
-        # This method manages the teardown of the batch workflow. See methods for details.
+        # This method manages the teardown of the batch workflow. See methods for details. It is also registered to run
+        # at exit, so it only runs once.
+        if self.torn_down:
+            return
+        self.torn_down = True
         message = "Shutting down AWSBatch...."
         print(message)
         logging.info(message)
+        self.job_poller.stop()
+        self.job_memory_history.close()
+        message = f"S3 transfer statistics: {S3TransferManager.shared().stats()}"
+        logging.info(message)
+        if self.batch_pool is not None:
+            # Keep the pool for the next analysis. Let AWS Batch scale it down to zero once its queue is empty.
+            try:
+                self.__scale_compute_environment(min_vcpus=MIN_AWS_VCPUS)
+            except botocore.exceptions.ClientError as err:
+                logging.warning(f"Could not scale down Compute Environment {self.compute_environment_id}. {err}")
+            return
         self.__delete_job_definition()
         self.__delete_job_queue()
         self.__delete_compute_environment()
 
+    # Deletes the job definitions, job queue and compute environment of the batch pool. The pool is created again by
+    # the next analysis that uses it.
+    def delete_pool(self):
+        self.job_poller.stop()
+        describe = self.batch_client.describe_job_definitions(status='ACTIVE')
+        job_definitions = describe['jobDefinitions']
+        while describe.get('nextToken'):
+            describe = self.batch_client.describe_job_definitions(status='ACTIVE', nextToken=describe['nextToken'])
+            job_definitions += describe['jobDefinitions']
+        for job_definition in job_definitions:
+            if job_definition['jobDefinitionName'].startswith(f"{self.compute_environment_id}_"):
+                self.batch_client.deregister_job_definition(jobDefinition=job_definition['jobDefinitionArn'])
+        self.__delete_job_queue()
+        self.__delete_compute_environment()
+
     def submit_job(self,
                    output_folder,
                    local_btap_data_path,
                    local_datapoint_input_folder,
                    local_datapoint_output_folder,
-                   run_options):
+                   run_options,
+                   timer=None):
+        timer = timer or DatapointTimer()
         run_options[':s3_bucket'] = self.credentials.account_id
         btap_data = {}
         # add run options to dict.
@@ -352,6 +1082,10 @@ class AWSBatch:
         s3_error_txt_path = os.path.join(s3_datapoint_output_folder, 'error.txt').replace('\\', '/')
 
         jobName = f"{run_options[':analysis_id']}-{run_options[':datapoint_id']}"
+        # vCPU and memory of the job. The memory is raised if the job is resubmitted after running out of memory.
+        resources = self.job_resources(run_options.get(':building_type'))
+        # Description of the finished job, used to report why a job failed.
+        job_description = {}
 
         bundle_command = f"bundle exec ruby btap_cli.rb --input_path s3://{run_options[':s3_bucket']}/{s3_datapoint_input_folder} --output_path s3://{run_options[':s3_bucket']}/{s3_output_folder} "
         # replace \ slashes to / slash for correct s3 convention.
@@ -360,18 +1094,27 @@ class AWSBatch:
 
             logging.info(
                 f"Copying from {local_datapoint_input_folder} to bucket {run_options[':s3_bucket']} folder {s3_datapoint_input_folder}")
-            S3().copy_folder_to_s3(bucket_name=run_options[':s3_bucket'],
-                                   source_folder=local_datapoint_input_folder,
-                                   target_folder=s3_datapoint_input_folder)
+            # The datapoint folder is new, so there is nothing on S3 to compare against.
+            with timer.span('upload_inputs'):
+                S3().copy_folder_to_s3(bucket_name=run_options[':s3_bucket'],
+                                       source_folder=local_datapoint_input_folder,
+                                       target_folder=s3_datapoint_input_folder,
+                                       skip_unchanged=False)
             # Start timer to track simulation time.
             start = time.time()
-            self.job(jobName=jobName, debug=True, command=["/bin/bash", "-c", bundle_command])
+            with timer.span('job'):
+                result = self.job(jobName=jobName, debug=True, command=["/bin/bash", "-c", bundle_command],
+                                  analysis_id=run_options[':analysis_id'], timer=timer, resources=resources,
+                                  building_type=run_options.get(':building_type'), job_description=job_description)
+            if result != 'SUCCEEDED':
+                raise Exception(f"Job {jobName} {result}. {job_description.get('statusReason', '')}")
             # Get btap_data from s3
             logging.info(
                 f"Getting data from S3 bucket {run_options[':s3_bucket']} at path {s3_btap_data_path}")
-            content_object = boto3.resource('s3').Object(run_options[':s3_bucket'], s3_btap_data_path)
             # Adding simulation high level results to btap_data df.
-            btap_data.update(json.loads(content_object.get()['Body'].read().decode('utf-8')))
+            with timer.span('download_outputs'):
+                btap_data.update(json.loads(S3TransferManager.shared().read_object(run_options[':s3_bucket'],
+                                                                                   s3_btap_data_path)))
             # save url to datapoint output for Kamel.
             btap_data[
                 'datapoint_output_url'] = f"https://s3.console.aws.amazon.com/s3/buckets/{run_options[':s3_bucket']}?region=ca-central-1&prefix={s3_datapoint_output_folder}/"
@@ -394,67 +1137,126 @@ class AWSBatch:
             # Flag that is was successful.
             btap_data['success'] = True
             btap_data['simulation_time'] = time.time() - start
+            btap_data['job_vcpus'] = resources[':vcpus']
+            btap_data['job_memory_mb'] = resources[':memory']
             return btap_data
 
 
-        except Exception:
-            error_msg = ''
-            content_object = boto3.resource('s3').Object(run_options[':s3_bucket'], s3_error_txt_path)
-            print(error_msg)
-            error_msg = content_object.get()['Body'].read().decode('utf-8')
+        except Exception as err:
+            with timer.span('download_outputs'):
+                try:
+                    error_msg = S3TransferManager.shared().read_object(run_options[':s3_bucket'], s3_error_txt_path)
+                except Exception:
+                    # The container did not write error.txt, for example when the job ran out of memory or was lost.
+                    error_msg = job_description.get('statusReason') or str(err)
             btap_data = {}
             btap_data.update(run_options)
             btap_data['success'] = False
             btap_data['container_error'] = str(error_msg)
             btap_data['run_options'] = yaml.dump(run_options)
             btap_data['datapoint_output_url'] = 'file:///' + os.path.join(local_datapoint_output_folder)
+            btap_data['job_vcpus'] = resources[':vcpus']
+            btap_data['job_memory_mb'] = resources[':memory']
             # save btap_data json file to output folder if aws_run.
             pathlib.Path(os.path.dirname(local_btap_data_path)).mkdir(parents=True, exist_ok=True)
             with open(local_btap_data_path, 'w') as outfile:
                 json.dump(btap_data, outfile, indent=4)
             return btap_data
 
-    def job(self, jobName='test', debug=False, command=None):
-        # Tell user.
-
-        # See https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/batch.html#Batch.Client.submit_job
-        submitJobResponse = self.__submit_job_wrapper(command, jobName)
-
-        jobId = submitJobResponse['jobId']
-        message = f"Submitted job_id {jobId} with job name {jobName} to the job queue {self.job_queue_id}"
-        logging.info(message)
-        running = False
-        # logGroupName = '/aws/batch/job'
-        result = 'FAILED'
-        while debug:
-            # Don't hammer AWS.. make queries every minute for the run status
-            time.sleep(60 + random())
-            describeJobsResponse = self.__get_job_status(jobId)
-            status = describeJobsResponse['jobs'][0]['status']
-            if status == 'SUCCEEDED':
-                message = 'SUCCEEDED - Job [%s - %s] %s' % (jobName, jobId, status)
+    # Returns a copy of the vCPU and memory (MB) of the jobs of a building type.
+    def job_resources(self, building_type=None):
+        with self.job_resource_lock:
+            profile = self.job_resource_profiles.get(building_type, {})
+            return {':vcpus': profile.get(':vcpus', CONTAINER_VCPU), ':memory': profile.get(':memory', CONTAINER_MEMORY)}
+
+    # Raises the memory of the building types to the memory (MB) their jobs needed before.
+    def seed_job_memory(self, memory_by_building_type):
+        with self.job_resource_lock:
+            for building_type, memory in memory_by_building_type.items():
+                profile = self.job_resource_profiles.setdefault(building_type, {':vcpus': CONTAINER_VCPU})
+                profile[':memory'] = max(profile.get(':memory', CONTAINER_MEMORY), memory)
+
+    # Doubles the memory of a job that ran out of memory, up to MAX_JOB_MEMORY, and raises the memory of its building
+    # type so the next jobs start with it. Returns False if the memory cannot be raised.
+    def raise_job_memory(self, building_type, resources):
+        if resources[':memory'] >= MAX_JOB_MEMORY:
+            return False
+        resources[':memory'] = min(resources[':memory'] * 2, MAX_JOB_MEMORY)
+        with self.job_resource_lock:
+            profile = self.job_resource_profiles.setdefault(building_type, {':vcpus': resources[':vcpus']})
+            profile[':memory'] = max(profile.get(':memory', CONTAINER_MEMORY), resources[':memory'])
+        if building_type is not None:
+            self.job_memory_history.put(building_type, resources[':memory'])
+        return True
+
+    # True if a finished job was stopped because its container ran out of memory.
+    @staticmethod
+    def is_out_of_memory(job):
+        reasons = [job.get('statusReason'), job.get('container', {}).get('reason')]
+        reasons += [attempt.get('container', {}).get('reason') for attempt in job.get('attempts', [])]
+        return any('OutOfMemory' in reason for reason in reasons if reason)
+
+    # Submits the job and, with debug, waits for it to finish and returns its status. The description of the finished
+    # job is copied into the job_description dict if one is given.
+    def job(self, jobName='test', debug=False, command=None, analysis_id=None, timer=None, resources=None,
+            building_type=None, job_description=None):
+        resources = resources if resources is not None else self.job_resources(building_type)
+        # Re-attach to a job that was submitted before the analysis was interrupted if it has not failed.
+        job_ledger = self.job_ledgers.get(analysis_id)
+        jobId = None
+        if job_ledger is not None:
+            jobId = self.__resumable_job_id(job_ledger.get_job_id(jobName))
+        if jobId is not None:
+            message = f"Re-attached to job_id {jobId} with job name {jobName}"
+            logging.info(message)
+        for retry in range(JOB_OUT_OF_MEMORY_RETRIES + 1):
+            if jobId is None:
+                # See https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/batch.html#Batch.Client.submit_job
+                start = time.time()
+                submitJobResponse = self.__submit_job_wrapper(command, jobName, resources=resources)
+                if timer is not None:
+                    timer.record('submit', time.time() - start)
+
+                jobId = submitJobResponse['jobId']
+                message = f"Submitted job_id {jobId} with job name {jobName} to the job queue {self.job_queue_id} " \
+                          f"with {resources[':vcpus']} vCPU and {resources[':memory']}MB"
                 logging.info(message)
-                result = 'SUCCEEDED'
-                break
-            elif status == 'FAILED':
-                message = 'FAILED - Job [%s - %s] %s' % (jobName, jobId, status)
-                logging.error(message)
-                result = 'FAILED'
+                if job_ledger is not None:
+                    job_ledger.set_job_id(jobName, jobId)
+            result = 'FAILED'
+            if not debug:
+                return result
+            # Wait for the shared poller to report that the job has finished.
+            job = self.job_poller.watch(jobId, jobName).result()
+            if job_description is not None:
+                job_description.update(job)
+            if timer is not None:
+                self.record_job_spans(job, timer)
+            result = job['status']
+            # Resubmit a job that ran out of memory with twice the memory.
+            if result != 'FAILED' or retry == JOB_OUT_OF_MEMORY_RETRIES or not self.is_out_of_memory(job) or \
+                    not self.raise_job_memory(building_type, resources):
                 break
-            elif status == 'RUNNING':
-                # Commented out logstream.
-                # logStreamName = self.getLogStream(logGroupName, jobName, jobId)
-                if not running:  # and logStreamName:
-                    running = True
-                    # print('Output [%s]:\n %s' % (logStreamName, '=' * 80))
-                # if logStreamName:
-                # startTime = self.printLogs(logGroupName, logStreamName, startTime) + 1
-            else:
-                message = 'UNKNOWN - Job [%s - %s] is %-9s' % (jobName, jobId, status)
-                # logging.info(message)
-                sys.stdout.flush()
+            message = f"Job {jobName} ran out of memory. Resubmitting it with {resources[':memory']}MB."
+            logging.warning(message)
+            jobId = None
         return result
 
+    # Adds the queue and compute times of a finished job to the timer. They are taken from the timestamps (ms) of the
+    # job description. The time spent RUNNABLE and STARTING is taken from the statuses seen by the poller, so it is only
+    # as precise as the polling interval.
+    @staticmethod
+    def record_job_spans(job, timer):
+        if job.get('createdAt') is not None and job.get('startedAt') is not None:
+            timer.record('queue_wait', (job['startedAt'] - job['createdAt']) / 1000.0)
+        if job.get('startedAt') is not None and job.get('stoppedAt') is not None:
+            timer.record('compute', (job['stoppedAt'] - job['startedAt']) / 1000.0)
+        status_times = job.get('status_times', {})
+        for status, next_statuses in [('RUNNABLE', ['STARTING', 'RUNNING']), ('STARTING', ['RUNNING'])]:
+            next_times = [status_times[next_status] for next_status in next_statuses if next_status in status_times]
+            if status in status_times and len(next_times) > 0:
+                timer.record(status.lower(), min(next_times) - status_times[status])
+
     def build_image(self, rebuild=False):
         
         # Ensure image is rebuilt if requested
@@ -496,7 +1298,7 @@ class AWSBatch:
             logging.info(message)
             print(message)
             # Codebuild image.
-            codebuild = boto3.client('codebuild')
+            codebuild = AWSClients.get('codebuild')
 
             # Upload files to S3 using custom s3 class to a user folder.
             s3 = S3()
@@ -631,6 +1433,26 @@ class AWSBatch:
                 # Check status every 5 secs.
                 time.sleep(5)
 
+        # Store the digest of the tagged image. This identifies the exact image used to run the simulations.
+        image_details = self.ecr.describe_images(repositoryName=self.image_name,
+                                                 imageIds=[{'imageTag': self.image_tag}])['imageDetails']
+        self.image_digest = image_details[0]['imageDigest'] if len(image_details) > 0 else None
+
+    # Identity of the image that runs the simulations. Used to key the datapoint cache so that a rebuilt image does not
+    # reuse results from the old one.
+    def image_identity(self):
+        if getattr(self, 'image_digest', None) is not None:
+            return self.image_digest
+        return f"{self.image_name}:{self.os_version}:{self.os_standards_branch}:{self.btap_costing_branch}"
+
+    # Image registered in the job definition. The digest pins the exact image, so jobs do not pick up a later push of the
+    # same tag. The tag is only used if the digest is not known.
+    def job_image(self):
+        if getattr(self, 'image_digest', None) is not None:
+            repository = self.image_full_name.rsplit(':', 1)[0]
+            return f"{repository}@{self.image_digest}"
+        return self.image_full_name
+
     # This method is a helper to print/stream logs.
     def __printLogs(self, logGroupName, logStreamName, startTime):
         kwargs = {'logGroupName': logGroupName,
@@ -707,10 +1529,40 @@ class AWSBatch:
         print(message)
         logging.info(message)
 
+        # A resumed analysis uses the compute environment that it created before it was interrupted.
+        existing = self.__describe_compute_environments(self.compute_environment_id)['computeEnvironments']
+        if len(existing) > 0 and existing[0]['status'] not in ['DELETING', 'DELETED']:
+            message = f'Using existing Compute Environment {self.compute_environment_id}'
+            print(message)
+            logging.info(message)
+            if existing[0]['state'] == 'DISABLED':
+                self.batch_client.update_compute_environment(computeEnvironment=self.compute_environment_id,
+                                                             state='ENABLED')
+            response = existing[0]
+        else:
+            response = self.__create_new_compute_environment()
+        # Check state of creating CE.
+        while True:
+            # See https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/batch.html#Batch.Client.describe_compute_environments
+            describe = self.__describe_compute_environments(self.compute_environment_id)
+            computeEnvironment = describe['computeEnvironments'][0]
+            status = computeEnvironment['status']
+            # If CE is in valid state, inform user and break from loop.
+            if status == 'VALID':
+                break
+            # If CE is in invalid state, inform user and break from loop.
+            elif status == 'INVALID':
+                reason = computeEnvironment['statusReason']
+                raise Exception('Failed to create compute environment: %s' % (reason))
+            time.sleep(1)
+
+        return response
+
+    def __create_new_compute_environment(self):
         # Call to create Compute environment.
         # See https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/batch.html#Batch.Client.create_compute_environment
         # and https://docs.aws.amazon.com/batch/latest/userguide/compute_environment_parameters.html#compute_environment_type
-        response = self.batch_client.create_compute_environment(
+        return self.batch_client.create_compute_environment(
             computeEnvironmentName=self.compute_environment_id,
             type='MANAGED',  # Allow AWS to manage instances.
             serviceRole=self.aws_batch_service_role,
@@ -730,22 +1582,6 @@ class AWSBatch:
                     'launchTemplateName': self.__add_storage_space_launch_template()}
             }
         )
-        # Check state of creating CE.
-        while True:
-            # See https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/batch.html#Batch.Client.describe_compute_environments
-            describe = self.__describe_compute_environments(self.compute_environment_id)
-            computeEnvironment = describe['computeEnvironments'][0]
-            status = computeEnvironment['status']
-            # If CE is in valid state, inform user and break from loop.
-            if status == 'VALID':
-                break
-            # If CE is in invalid state, inform user and break from loop.
-            elif status == 'INVALID':
-                reason = computeEnvironment['statusReason']
-                raise Exception('Failed to create compute environment: %s' % (reason))
-            time.sleep(1)
-
-        return response
 
     def __delete_compute_environment(self):
         # Inform user starting to create CE.
@@ -836,14 +1672,24 @@ class AWSBatch:
         logging.info(message)
         print(message)
 
-        response = self.batch_client.create_job_queue(jobQueueName=self.job_queue_id,
-                                                      priority=100,
-                                                      computeEnvironmentOrder=[
-                                                          {
-                                                              'order': 0,
-                                                              'computeEnvironment': self.compute_environment_id
-                                                          }
-                                                      ])
+        # A resumed analysis uses the job queue that it created before it was interrupted.
+        existing = self.__describe_job_queues(self.job_queue_id)['jobQueues']
+        if len(existing) > 0 and existing[0]['status'] not in ['DELETING', 'DELETED']:
+            message = f'Using existing Job Queue {self.job_queue_id}'
+            logging.info(message)
+            print(message)
+            if existing[0]['state'] == 'DISABLED':
+                self.batch_client.update_job_queue(jobQueue=self.job_queue_id, state='ENABLED')
+            response = existing[0]
+        else:
+            response = self.batch_client.create_job_queue(jobQueueName=self.job_queue_id,
+                                                          priority=100,
+                                                          computeEnvironmentOrder=[
+                                                              {
+                                                                  'order': 0,
+                                                                  'computeEnvironment': self.compute_environment_id
+                                                              }
+                                                          ])
 
         while True:
             describe = self.__describe_job_queues(self.job_queue_id)
@@ -878,7 +1724,7 @@ class AWSBatch:
         response = self.batch_client.register_job_definition(jobDefinitionName=self.job_def_id,
                                                              type='container',
                                                              containerProperties={
-                                                                 'image': self.image_full_name,
+                                                                 'image': self.job_image(),
                                                                  'vcpus': unitVCpus,
                                                                  'memory': unitMemory,
                                                                  'privileged': True,
@@ -887,13 +1733,52 @@ class AWSBatch:
 
         return response
 
-    def __submit_job_wrapper(self, command, jobName, n=0):
+    # Uses the job definition of the pool for this image, registering it if it does not exist. The job definition is
+    # named after the image digest so each image gets its own, and it is reused as long as its container settings are
+    # the same.
+    def __attach_job_definition(self,
+                                unitVCpus=CONTAINER_VCPU,
+                                unitMemory=CONTAINER_MEMORY):
+        image_key = (getattr(self, 'image_digest', None) or self.image_tag).replace('sha256:', '')[:16]
+        self.job_def_id = f"{self.compute_environment_id}_{image_key}_job_def"
+        existing = self.batch_client.describe_job_definitions(jobDefinitionName=self.job_def_id,
+                                                              status='ACTIVE')['jobDefinitions']
+        for job_definition in existing:
+            container = job_definition['containerProperties']
+            if container.get('image') == self.job_image() and container.get('vcpus') == unitVCpus and \
+                    container.get('memory') == unitMemory and container.get('jobRoleArn') == self.batch_job_role:
+                message = f"Using existing Job Definition {self.job_def_id}"
+                logging.info(message)
+                print(message)
+                return job_definition
+        return self.__register_job_definition(unitVCpus=unitVCpus, unitMemory=unitMemory)
+
+    # Sets the vCPUs of the compute environment. AWS Batch only accepts a desiredvCpus that is not lower than the
+    # current one, so the pool is scaled down by lowering minvCpus and letting AWS Batch remove idle instances.
+    def __scale_compute_environment(self, min_vcpus=MIN_AWS_VCPUS, desired_vcpus=None):
+        compute_resources = {'minvCpus': min_vcpus}
+        if desired_vcpus is not None:
+            describe = self.__describe_compute_environments(self.compute_environment_id)
+            current = describe['computeEnvironments'][0]['computeResources'].get('desiredvCpus', 0)
+            if desired_vcpus > current:
+                compute_resources['desiredvCpus'] = min(desired_vcpus, MAX_AWS_VCPUS)
+        message = f"Scaling Compute Environment {self.compute_environment_id} to {compute_resources}"
+        logging.info(message)
+        self.batch_client.update_compute_environment(computeEnvironment=self.compute_environment_id,
+                                                     computeResources=compute_resources)
+
+    def __submit_job_wrapper(self, command, jobName, n=0, resources=None):
+        containerOverrides = {'command': command}
+        # The vCPU and memory of the job replace the ones of the job definition.
+        if resources is not None:
+            containerOverrides['resourceRequirements'] = [{'type': 'VCPU', 'value': str(resources[':vcpus'])},
+                                                          {'type': 'MEMORY', 'value': str(resources[':memory'])}]
         try:
             submitJobResponse = self.batch_client.submit_job(
                 jobName=jobName,
                 jobQueue=self.job_queue_id,
                 jobDefinition=self.job_def_id,
-                containerOverrides={'command': command}
+                containerOverrides=containerOverrides
             )
             return submitJobResponse
         except:
@@ -904,19 +1789,28 @@ class AWSBatch:
             wait_time = 2 ** n + random()
             logging.warning(f"Implementing exponential backoff for job {jobName} for {wait_time}s")
             time.sleep(wait_time)
-            return self.__submit_job_wrapper(command, jobName, n=n + 1)
-
-    def __get_job_status(self, jobId, n=0):
+            return self.__submit_job_wrapper(command, jobName, n=n + 1, resources=resources)
+
+    # Returns the job id if the job is still known to AWS Batch and has not failed, otherwise None.
+    def __resumable_job_id(self, job_id):
+        if job_id is None:
+            return None
+        jobs = self.__get_job_status([job_id])['jobs']
+        if len(jobs) == 0 or jobs[0]['status'] == 'FAILED':
+            return None
+        return job_id
+
+    def __get_job_status(self, jobIds, n=0):
         try:
-            describeJobsResponse = self.batch_client.describe_jobs(jobs=[jobId])
+            describeJobsResponse = self.batch_client.describe_jobs(jobs=jobIds)
             return describeJobsResponse
         except:
             if n == 8:
-                raise (f'Failed to get job status for {jobId} in 7 tries while using exponential backoff.')
+                raise Exception(f'Failed to get job status for {jobIds} in 7 tries while using exponential backoff.')
             wait_time = 2 ** n + random()
-            logging.warning(f"Implementing exponential backoff for job {jobId} for {wait_time}s")
+            logging.warning(f"Implementing exponential backoff for jobs {jobIds} for {wait_time}s")
             time.sleep(wait_time)
-            return self.__get_job_status(jobId, n=n + 1)
+            return self.__get_job_status(jobIds, n=n + 1)
 
     def __describe_job_queues(self, job_queue_id, n=0):
         try:
@@ -944,20 +1838,272 @@ class AWSBatch:
             return self.__describe_compute_environments(compute_environment_id, n=n + 1)
 
 
-# Class to manage local Docker batch run.
-class DockerBatch:
+# Pool of long lived containers that run local simulations. A worker container mounts the project folder that holds
+# the analysis folders and runs one datapoint at a time with docker exec, so the container start is paid once per
+# worker instead of once per datapoint, and the stages of an integrated design process reuse the same workers. Workers
+# are checked before they are reused and are replaced after max_jobs datapoints or a failed datapoint. A worker that
+# crashes only fails the datapoint it was running.
+class DockerWorkerPool:
+    def __init__(self, docker_client=None, image_name=None, max_jobs=DOCKER_WARM_POOL_MAX_JOBS):
+        self.docker_client = docker_client
+        self.image_name = image_name
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        # Idle workers for each mounted folder. A worker is a dict with its container, mounted folder and job count.
+        self.idle = {}
+        # All the workers that have not been removed.
+        self.workers = []
+        self.counts = {'started': 0, 'recycled': 0, 'crashed': 0, 'jobs': 0}
+
+    # Runs btap_cli in a worker for the datapoint input folder and the output folder. Raises a ContainerError if the
+    # simulation fails, like docker run does. The time taken to get a worker and to run btap_cli in it is added to the
+    # DatapointTimer timer if given.
+    def run(self, local_input_folder, local_output_folder, timer=None):
+        timer = timer or DatapointTimer()
+        local_input_folder = os.path.abspath(local_input_folder)
+        local_output_folder = os.path.abspath(local_output_folder)
+        mount_folder = self.mount_folder(local_input_folder, local_output_folder)
+        with timer.span('container_acquire'):
+            worker = self.__acquire(mount_folder)
+        command = self.command(mount_folder, local_input_folder, local_output_folder)
+        try:
+            with timer.span('compute'):
+                exit_code, output = worker['container'].exec_run(cmd=['sh', '-c', command])
+        except DockerException:
+            # The worker went away while running the datapoint.
+            self.__remove(worker, 'crashed')
+            raise
+        with self.lock:
+            worker['jobs'] += 1
+            self.counts['jobs'] += 1
+        if exit_code != 0:
+            # Do not reuse a worker after a failure in case the simulation left it in a bad state.
+            self.__remove(worker, 'recycled' if self.__healthy(worker) else 'crashed')
+            raise docker.errors.ContainerError(worker['container'], exit_code, command, self.image_name, output)
+        self.__release(worker)
+        return output
+
+    # Folder mounted in the workers. The input and output folders of a datapoint are in the analysis folder
+    # (project_root/analysis_name/analysis_id), so the project root two levels up is shared by every analysis and stage
+    # of the project and their datapoints do not evict each other's idle workers.
+    @staticmethod
+    def mount_folder(local_input_folder, local_output_folder):
+        analysis_folder = os.path.commonpath([os.path.abspath(local_input_folder), os.path.abspath(local_output_folder)])
+        return os.path.dirname(os.path.dirname(analysis_folder))
+
+    # Shell command run in a worker. The btap_cli input and output folders are linked to the datapoint folders in the
+    # mounted folder before btap_cli is run.
+    @staticmethod
+    def command(mount_folder, local_input_folder, local_output_folder):
+        input_path = pathlib.PurePosixPath(DOCKER_WORKER_MOUNT,
+                                           *pathlib.Path(os.path.relpath(local_input_folder, mount_folder)).parts)
+        output_path = pathlib.PurePosixPath(DOCKER_WORKER_MOUNT,
+                                            *pathlib.Path(os.path.relpath(local_output_folder, mount_folder)).parts)
+        return f"cd {DOCKER_BTAP_CLI_FOLDER} && rm -rf input output && ln -s {input_path} input && " \
+               f"ln -s {output_path} output && bundle exec ruby btap_cli.rb"
+
+    # Removes all the workers.
+    def shutdown(self):
+        with self.lock:
+            workers = list(self.workers)
+        for worker in workers:
+            self.__remove(worker, None)
+        message = f"Docker worker pool statistics: {self.stats()}"
+        logging.info(message)
 
-    @classmethod
-    def get_threads(cls):
-        # Try to access the docker daemon. If we cannot.. ask user to turn it on and then exit.
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, running=len(self.workers))
+
+    def __acquire(self, mount_folder):
+        while True:
+            with self.lock:
+                idle = self.idle.setdefault(mount_folder, [])
+                worker = idle.pop() if len(idle) > 0 else None
+                # Workers of folders that are no longer used are removed as new ones are needed.
+                stale = None
+                if worker is None:
+                    for folder, workers in self.idle.items():
+                        if folder != mount_folder and len(workers) > 0:
+                            stale = workers.pop()
+                            break
+            if stale is not None:
+                self.__remove(stale, None)
+            if worker is None:
+                return self.__start(mount_folder)
+            if self.__healthy(worker):
+                return worker
+            self.__remove(worker, 'crashed')
+
+    def __release(self, worker):
+        if worker['jobs'] >= self.max_jobs:
+            self.__remove(worker, 'recycled')
+            return
+        with self.lock:
+            self.idle.setdefault(worker['mount_folder'], []).append(worker)
+
+    def __start(self, mount_folder):
+        container = self.docker_client.containers.run(
+            image=self.image_name,
+            # Keep the container alive. Simulations are run in it with docker exec.
+            entrypoint=['tail', '-f', '/dev/null'],
+            volumes={mount_folder: {'bind': DOCKER_WORKER_MOUNT, 'mode': 'rw'}},
+            detach=True,
+            auto_remove=True
+        )
+        worker = {'container': container, 'mount_folder': mount_folder, 'jobs': 0}
+        with self.lock:
+            self.workers.append(worker)
+            self.counts['started'] += 1
+        message = f"Started docker worker {container.short_id} for {mount_folder}"
+        logging.info(message)
+        return worker
+
+    def __remove(self, worker, reason):
+        with self.lock:
+            if worker not in self.workers:
+                return
+            self.workers.remove(worker)
+            if reason is not None:
+                self.counts[reason] += 1
         try:
-            docker.from_env()
+            worker['container'].remove(force=True)
         except DockerException as err:
-            logging.error(
-                f"Could not access Docker Daemon. Either it is not running, or you do not have permissions to run docker. {err}. Could not get number of cpus used in Docker.")
-            exit(1)
-        # Return number of cpus minus 2 to give a bit of slack.
-        return int(docker.from_env().containers.run(image='alpine', command='nproc --all', remove=True)) - 2
+            # auto_remove may have already removed it.
+            logging.debug(f"Could not remove docker worker {worker['container'].short_id}. {err}")
+
+    @staticmethod
+    def __healthy(worker):
+        try:
+            worker['container'].reload()
+            return worker['container'].status == 'running'
+        except DockerException:
+            return False
+
+
+# Parent of the backends that run datapoints on this machine. The outputs of a datapoint are written to its folder in
+# the local output folder, where btap_data.json and error.txt are read from.
+class LocalBatch(BatchBackend):
+    # This method will run the simulation with the job method of the backend. It passes all the information via the
+    # run_options.yml file. This file was created ahead of this in the local_input_folder. The output similarly will be
+    # placed in the local_output_folder using the datapoint_id as the new folder name.
+    def submit_job(self,
+                   output_folder,
+                   local_btap_data_path,
+                   local_datapoint_input_folder,
+                   local_datapoint_output_folder,
+                   run_options,
+                   timer=None):
+        timer = timer or DatapointTimer()
+        local_error_txt_path = os.path.join(output_folder, run_options[':datapoint_id'], 'error.txt')
+        btap_data = {}
+        # add run options to dict.
+        btap_data.update(run_options)
+        # Start timer to track simulation time.
+        start = time.time()
+        try:
+
+            with timer.span('job'):
+                result = self.job(
+                    run_options=run_options,
+                    local_input_folder=local_datapoint_input_folder,
+                    local_output_folder=output_folder,
+                    detach=False,
+                    timer=timer
+                )
+            # If file was not created...raise an error.
+            if not os.path.isfile(local_btap_data_path):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), local_btap_data_path)
+            # Open the btap Data file in analysis dict.
+            with timer.span('read_outputs'):
+                file = open(local_btap_data_path, 'r')
+                btap_data.update(json.load(file))
+                file.close()
+            # save output url.
+            btap_data['datapoint_output_url'] = 'file:///' + os.path.join(local_datapoint_output_folder)
+            # Store sum of warnings errors and severes.
+            btap_data['eplus_warnings'] = sum(
+                1 for d in btap_data['eplusout_err_table'] if d.get('error_type') == 'warning')
+            btap_data['eplus_severes'] = sum(
+                1 for d in btap_data['eplusout_err_table'] if d.get('error_type') == 'severe')
+            btap_data['eplus_fatals'] = sum(
+                1 for d in btap_data['eplusout_err_table'] if d.get('error_type') == 'fatal')
+            # dump full run_options.yml file into database for convienience.
+            btap_data['run_options'] = yaml.dump(run_options)
+            # Need to zero this in costing btap_data.rb file otherwise may be NA.
+            for item in ['energy_eui_heat recovery_gj_per_m_sq', 'energy_eui_heat rejection_gj_per_m_sq']:
+                if not btap_data.get(item):
+                    btap_data[item] = 0.0
+            # Flag that is was successful.
+            btap_data['success'] = True
+            btap_data['simulation_time'] = time.time() - start
+            return btap_data
+        except Exception as error:
+            error_msg = ''
+            if os.path.exists(local_error_txt_path):
+                with open(local_error_txt_path, 'r') as file:
+                    error_msg = file.read()
+            btap_data = {}
+            btap_data.update(run_options)
+            btap_data['success'] = False
+            btap_data['container_error'] = str(error_msg)
+            btap_data['run_options'] = yaml.dump(run_options)
+            btap_data['datapoint_output_url'] = 'file:///' + os.path.join(local_datapoint_output_folder)
+            return btap_data
+
+    # Runs the simulation of the run_options.yml file in local_input_folder and writes its outputs to a folder named
+    # by the datapoint_id in local_output_folder. Raises an exception if the simulation failed.
+    @abc.abstractmethod
+    def job(self, run_options=None, local_input_folder=None, local_output_folder=None, detach=False, timer=None):
+        pass
+
+
+# Class to manage local Docker batch run.
+class DockerBatch(LocalBatch):
+    # Host capacity is the same for every analysis, so the docker daemon is only asked for it once per process.
+    host_capacity = None
+    host_capacity_lock = threading.Lock()
+
+    # Returns a dict with the number of cpus and the memory (MB) available to docker on the host.
+    @classmethod
+    def get_host_capacity(cls):
+        with cls.host_capacity_lock:
+            if cls.host_capacity is None:
+                # Try to access the docker daemon. If we cannot.. ask user to turn it on and then exit.
+                try:
+                    info = docker.from_env().info()
+                except DockerException as err:
+                    logging.error(
+                        f"Could not access Docker Daemon. Either it is not running, or you do not have permissions to run docker. {err}. Could not get number of cpus used in Docker.")
+                    exit(1)
+                cls.host_capacity = {'cpus': int(info['NCPU']),
+                                     'memory': int(info['MemTotal']) // (1024 * 1024)}
+                message = f"Docker host has {cls.host_capacity['cpus']} cpus and {cls.host_capacity['memory']}MB of memory."
+                logging.info(message)
+            return cls.host_capacity
+
+    # Number of simulations to run at the same time. Uses max_threads if it was given, otherwise the number of cpus minus
+    # DOCKER_RESERVED_CPUS, limited so that every simulation has container_memory MB of the host memory.
+    def get_threads(self):
+        if self.max_threads is not None:
+            return int(self.max_threads)
+        host_capacity = self.get_host_capacity()
+        threads_by_cpus = host_capacity['cpus'] - DOCKER_RESERVED_CPUS
+        threads_by_memory = host_capacity['memory'] // int(self.container_memory)
+        return max(1, min(threads_by_cpus, threads_by_memory))
+
+    @classmethod
+    def from_analysis_config(cls, analysis_config=None, git_api_token=None):
+        return cls(image_name=analysis_config[':image_name'],
+                   git_api_token=git_api_token,
+                   os_standards_branch=analysis_config[':os_standards_branch'],
+                   btap_costing_branch=analysis_config[':btap_costing_branch'],
+                   os_version=analysis_config[':os_version'],
+                   nocache=analysis_config[':nocache'],
+                   max_threads=analysis_config.get(':max_threads'),
+                   container_memory=analysis_config.get(':container_memory'),
+                   warm_pool=analysis_config.get(':docker_warm_pool', False),
+                   warm_pool_max_jobs=analysis_config.get(':docker_warm_pool_max_jobs'))
 
     def __init__(self,
                  # name of docker image created
@@ -971,7 +2117,16 @@ class DockerBatch:
                  # btap_costing branch or revision to be used.
                  btap_costing_branch='master',
                  # openstudio version (used to access old versions if needed)
-                 os_version='3.0.1'):
+                 os_version='3.0.1',
+                 # Number of simulations to run at the same time. Worked out from the host if None.
+                 max_threads=None,
+                 # Memory (MB) allowed for each simulation when working out the number of threads.
+                 container_memory=DOCKER_CONTAINER_MEMORY,
+                 # Run simulations in a pool of long lived containers instead of a new container per simulation.
+                 warm_pool=False,
+                 # Number of simulations a pool container runs before it is replaced.
+                 warm_pool_max_jobs=DOCKER_WARM_POOL_MAX_JOBS):
+        super().__init__()
         # Git api token
         self.git_api_token = git_api_token
         # https://github.com/NREL/openstudio-standards/branches should ideally use nrcan
@@ -984,6 +2139,9 @@ class DockerBatch:
         self.image_name = image_name
         # if nocache set to True.. will build image from scratch.
         self.nocache = nocache
+        # Overrides of the number of threads and the memory per simulation.
+        self.max_threads = max_threads
+        self.container_memory = container_memory or DOCKER_CONTAINER_MEMORY
         # Get the folder of this python file.
         self.dir_path = os.path.dirname(os.path.realpath(__file__))
         # determines folder of docker folder relative to this file.
@@ -1001,14 +2159,36 @@ class DockerBatch:
         file = open(os.path.join(self.dockerfile, 'Dockerfile'), 'wb')
         file.write(r.content)
         file.close()
-        # get a docker client object to run docker commands.
-        self.docker_client = docker.from_env()
+        # Making sure that used installed docker.
+        find_docker = os.system("docker -v")
+        if find_docker != 0:
+            logging.exception("Docker is not installed on this system")
+        # get a docker client object to run docker commands. If we cannot access the docker daemon.. ask user to turn
+        # it on and then exit.
+        try:
+            self.docker_client = docker.from_env()
+        except DockerException as err:
+            logging.error(
+                f"Could not access Docker Daemon. Either it is not running, or you do not have permissions to run docker. {err}")
+            exit(1)
         # initialize image to None.. will assign later.
         self.image = None
+        # Pool of warm containers if requested.
+        self.worker_pool = None
+        if warm_pool:
+            self.worker_pool = DockerWorkerPool(docker_client=self.docker_client,
+                                                image_name=self.image_name,
+                                                max_jobs=warm_pool_max_jobs or DOCKER_WARM_POOL_MAX_JOBS)
+        # On exit deconstructor
+        atexit.register(self.tear_down)
 
     def setup(self):
         self.build_image()
 
+    def tear_down(self):
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+
     def build_image(self):
         # Set timer to track how long it took to build.
         start = time.time()
@@ -1082,122 +2262,967 @@ class DockerBatch:
         # return image.. also is a part of the object.
         return self.image
 
-    # This method will run the simulation with the general command. It passes all the information via the
-    # run_options.yml file. This file was created ahead of this in the local_input_folder which is mounted to the
-    # container. The output similarly will be placed in the local_output_folder using the datapoint_id as the new
-    # folder name.
-
-    def submit_job(self,
-                   output_folder,
-                   local_btap_data_path,
-                   local_datapoint_input_folder,
-                   local_datapoint_output_folder,
-                   run_options):
-        local_error_txt_path = os.path.join(output_folder, run_options[':datapoint_id'], 'error.txt')
-        btap_data = {}
-        # add run options to dict.
-        btap_data.update(run_options)
-        # Start timer to track simulation time.
-        start = time.time()
-        try:
-
-            result = self.job(
-                run_options=run_options,
-                local_input_folder=local_datapoint_input_folder,
-                local_output_folder=output_folder,
-                detach=False
-            )
-            # If file was not created...raise an error.
-            if not os.path.isfile(local_btap_data_path):
-                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), local_btap_data_path)
-            # Open the btap Data file in analysis dict.
-            file = open(local_btap_data_path, 'r')
-            btap_data.update(json.load(file))
-            file.close()
-            # save output url.
-            btap_data['datapoint_output_url'] = 'file:///' + os.path.join(local_datapoint_output_folder)
-            # Store sum of warnings errors and severes.
-            btap_data['eplus_warnings'] = sum(
-                1 for d in btap_data['eplusout_err_table'] if d.get('error_type') == 'warning')
-            btap_data['eplus_severes'] = sum(
-                1 for d in btap_data['eplusout_err_table'] if d.get('error_type') == 'severe')
-            btap_data['eplus_fatals'] = sum(
-                1 for d in btap_data['eplusout_err_table'] if d.get('error_type') == 'fatal')
-            # dump full run_options.yml file into database for convienience.
-            btap_data['run_options'] = yaml.dump(run_options)
-            # Need to zero this in costing btap_data.rb file otherwise may be NA.
-            for item in ['energy_eui_heat recovery_gj_per_m_sq', 'energy_eui_heat rejection_gj_per_m_sq']:
-                if not btap_data.get(item):
-                    btap_data[item] = 0.0
-            # Flag that is was successful.
-            btap_data['success'] = True
-            btap_data['simulation_time'] = time.time() - start
-            return btap_data
-        except Exception as error:
-            error_msg = ''
-            if os.path.exists(local_error_txt_path):
-                with open(local_error_txt_path, 'r') as file:
-                    error_msg = file.read()
-            btap_data = {}
-            btap_data.update(run_options)
-            btap_data['success'] = False
-            btap_data['container_error'] = str(error_msg)
-            btap_data['run_options'] = yaml.dump(run_options)
-            btap_data['datapoint_output_url'] = 'file:///' + os.path.join(local_datapoint_output_folder)
-            return btap_data
+    # Identity of the image that runs the simulations. Used to key the datapoint cache so that a rebuilt image does not
+    # reuse results from the old one.
+    def image_identity(self):
+        if self.image is not None:
+            return self.image.id
+        return f"{self.image_name}:{self.os_version}:{self.os_standards_branch}:{self.btap_costing_branch}"
 
     def job(self,
 
             # run_options dict is used for finding the folder after the simulation is completed to store in the database.
             run_options=None,
 
-            # mount point to container of input file(s)
-            local_input_folder=None,
+            # mount point to container of input file(s)
+            local_input_folder=None,
+
+            # mount point for container to copy simulation files.
+            local_output_folder=None,
+
+            # Don't detach.. hold on to current thread.
+            detach=False,
+
+            # DatapointTimer of the datapoint.
+            timer=None):
+        timer = timer or DatapointTimer()
+
+        # If local i/o folder is not set.. try to use folder where this file is.
+        if local_input_folder == None:
+            local_input_folder = os.path.join(self.dir_path, 'input')
+        if local_output_folder == None:
+            local_output_folder = os.path.join(self.dir_path, 'output')
+
+        # Run the simulation
+        jobName = f"{run_options[':analysis_id']}-{run_options[':datapoint_id']}"
+        message = f"Submitting job {jobName}"
+        logging.info(message)
+        volumes = {
+            local_output_folder: {
+                'bind': '/btap_costing/utilities/btap_cli/output',
+                'mode': 'rw'},
+            local_input_folder: {
+                'bind': '/btap_costing/utilities/btap_cli/input',
+                'mode': 'rw'},
+        }
+        # Run the simulation in a warm container if the pool is used.
+        if self.worker_pool is not None:
+            mount_folder = DockerWorkerPool.mount_folder(local_input_folder, local_output_folder)
+            command = DockerWorkerPool.command(mount_folder, local_input_folder, local_output_folder)
+            run_options['docker_command'] = f"docker exec <worker> sh -c '{command}'"
+            return self.worker_pool.run(local_input_folder, local_output_folder, timer=timer)
+        # Runnning docker command
+        run_options[
+            'docker_command'] = f"docker run --rm -v {local_output_folder}:/btap_costing/utilities/btap_cli/output -v {local_input_folder}:/btap_costing/utilities/btap_cli/input {run_options[':image_name']} bundle exec ruby btap_cli.rb"
+        with timer.span('compute'):
+            result = self.docker_client.containers.run(
+                # Local image name to use.
+                image=run_options[':image_name'],
+
+                # Command issued to container.
+                command='bundle exec ruby btap_cli.rb',
+
+                # host volume mount points and setting to read and write.
+                volumes=volumes,
+                # Will detach from current thread.. don't do it if you don't understand this.
+                detach=detach,
+                # This deletes the container on exit otherwise the container
+                # will bloat your system.
+                auto_remove=True
+            )
+
+        return result
+
+
+# Synthetic simulator used by the local_mock compute environment. Reads the run_options.yml file in local_input_folder
+# and writes a btap_data.json file, and an hourly.csv file if hourly outputs were requested, to a folder named by the
+# datapoint_id in local_output_folder. The outputs are the reference results in template scaled by a response to each
+# option that is not 'NECB_Default', so the same options always give the same outputs. Returns the time (s) the
+# simulation took.
+def run_mock_simulation(local_input_folder, local_output_folder, template, settings, option_keys):
+    start = time.time()
+    with open(os.path.join(local_input_folder, 'run_options.yml'), 'r') as file:
+        run_options = yaml.safe_load(file)
+    datapoint_output_folder = os.path.join(local_output_folder, run_options[':datapoint_id'])
+    os.makedirs(datapoint_output_folder, exist_ok=True)
+    fingerprint = DatapointCache.key(run_options, settings[':seed'])
+    # Outputs depend only on the options. Latency and failures also depend on the datapoint so a rerun can succeed.
+    results_rng = np.random.default_rng([int(settings[':seed']), int(fingerprint[:15], 16)])
+    run_rng = np.random.default_rng([int(settings[':seed']), int(fingerprint[:15], 16),
+                                     uuid.UUID(run_options[':datapoint_id']).int % 2 ** 63])
+
+    time.sleep(float(settings[':latency']) * run_rng.lognormal(0.0, float(settings[':latency_sigma'])))
+    if run_rng.random() < float(settings[':failure_rate']):
+        message = f"local_mock simulation of datapoint {run_options[':datapoint_id']} failed."
+        with open(os.path.join(datapoint_output_folder, 'error.txt'), 'w') as file:
+            file.write(message)
+        raise FailedSimulationException(message)
+
+    # Each option moves energy use and equipment cost in opposite directions by a fixed amount for its value.
+    energy_factor = 1.0
+    cost_factor = 1.0
+    for key in option_keys:
+        value = run_options.get(key)
+        if value is None or value == 'NECB_Default':
+            continue
+        digest = hashlib.md5(f"{key}={value}".encode('utf-8')).digest()
+        response = digest[0] / 255.0
+        energy_factor *= 0.88 + 0.18 * response
+        cost_factor *= 1.08 - 0.1 * response
+    btap_data = {}
+    for column, value in template.items():
+        if isinstance(value, float):
+            if column.startswith(LOCAL_MOCK_ENERGY_PREFIXES):
+                value = value * energy_factor * (1.0 + results_rng.normal(0.0, 0.01))
+            elif column.startswith(LOCAL_MOCK_COST_PREFIXES):
+                value = value * cost_factor * (1.0 + results_rng.normal(0.0, 0.01))
+        btap_data[column] = value
+    btap_data['eplusout_err_table'] = [{'error_type': 'warning', 'message': f"local_mock warning {number}"}
+                                       for number in range(results_rng.poisson(template.get('eplus_warnings') or 50))]
+    btap_data.pop('eplus_warnings', None)
+
+    # Hourly outputs follow a daily and a yearly cycle around the annual electricity use.
+    if settings[':hourly_outputs']:
+        names = [output_variable['variable'] for output_variable in run_options.get(':output_variables') or []]
+        names += [output_meter['name'] for output_meter in run_options.get(':output_meters') or []]
+        if len(names) > 0:
+            hours = np.arange(8760)
+            profile = (1.0 + 0.5 * np.sin(2.0 * np.pi * hours / 24.0)) * (1.0 + 0.3 * np.cos(2.0 * np.pi * hours / 8760.0))
+            annual = (btap_data.get('energy_eui_electricity_gj_per_m_sq') or 1.0) * \
+                     (btap_data.get('bldg_conditioned_floor_area_m_sq') or 1.0) * 10 ** 9
+            rows = [[run_options[':datapoint_id'], name, '', 'J'] + list(annual * profile / profile.sum() *
+                                                                        results_rng.uniform(0.5, 1.5))
+                    for name in names]
+            pd.DataFrame(rows, columns=['datapoint_id', 'Name', 'KeyValue', 'Units'] + list(hours + 1)).to_csv(
+                os.path.join(datapoint_output_folder, 'hourly.csv'), index=False)
+
+    with open(os.path.join(datapoint_output_folder, 'btap_data.json'), 'w') as file:
+        json.dump(btap_data, file)
+    return time.time() - start
+
+
+# Local stand-in for a simulation backend. Runs run_mock_simulation in a process pool instead of the btap_cli image, so
+# analyses and benchmarks of the orchestration can run without docker or network access. Set :compute_environment to
+# local_mock to use it.
+class LocalMockBatch(LocalBatch):
+    # The reference results are read once per process and shared by all analyses.
+    templates = None
+    templates_lock = threading.Lock()
+
+    @classmethod
+    def from_analysis_config(cls, analysis_config=None, git_api_token=None):
+        return cls(settings=analysis_config.get(':local_mock'),
+                   analysis_keys=list(analysis_config.keys()))
+
+    def __init__(self,
+                 # Overrides of LOCAL_MOCK_DEFAULTS.
+                 settings=None,
+                 # Keys of the analysis configuration. They are not building options and do not change the outputs.
+                 analysis_keys=None):
+        super().__init__()
+        self.settings = dict(LOCAL_MOCK_DEFAULTS)
+        self.settings.update(settings or {})
+        self.excluded_keys = set(DATAPOINT_CACHE_IGNORED_KEYS) | set(analysis_keys or []) | {
+            ':output_variables', ':output_meters', ':run_annual_simulation', ':enable_costing', ':image_name',
+            ':building_type', ':template', ':primary_heating_fuel', ':epw_file'}
+        self.executor = None
+        # On exit deconstructor
+        atexit.register(self.tear_down)
+
+    # Returns dicts of the reference results by building_type, template, primary_heating_fuel and epw_file, and by
+    # building_type alone.
+    @classmethod
+    def get_templates(cls):
+        with cls.templates_lock:
+            if cls.templates is None:
+                df = pd.read_excel(BASELINE_RESULTS)
+                columns = [column for column in df.columns
+                           if not column.startswith(':') and not column.startswith('baseline_') and
+                           column not in LOCAL_MOCK_IGNORED_COLUMNS]
+                keys = df[[':building_type', ':template', ':primary_heating_fuel', ':epw_file']].itertuples(
+                    index=False, name=None)
+                templates = {'datapoint': {}, 'building_type': {}}
+                for key, record in zip(keys, df[columns].to_dict('records')):
+                    record = {column: value for column, value in record.items() if not pd.isna(value)}
+                    templates['datapoint'].setdefault(key, record)
+                    templates['building_type'].setdefault(key[0], record)
+                cls.templates = templates
+            return cls.templates
+
+    def get_threads(self):
+        return int(self.settings[':threads'] or os.cpu_count())
+
+    def image_identity(self):
+        return f"local_mock-{self.settings[':seed']}"
+
+    def setup(self):
+        self.get_templates()
+        # The simulator mostly sleeps, so it runs in threads. Forking worker processes from a process that already runs
+        # the analysis threads could deadlock on the locks those threads hold.
+        self.executor = ThreadPoolExecutor(max_workers=self.get_threads(), thread_name_prefix='local_mock')
+
+    def tear_down(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    # Returns the reference results that match the datapoint, falling back to its building type and then to any
+    # reference building.
+    def template(self, run_options):
+        templates = self.get_templates()
+        key = tuple(run_options.get(name) for name in
+                    [':building_type', ':template', ':primary_heating_fuel', ':epw_file'])
+        template = templates['datapoint'].get(key) or templates['building_type'].get(run_options.get(':building_type'))
+        if template is None:
+            template = next(iter(templates['building_type'].values()))
+        return template
+
+    def job(self, run_options=None, local_input_folder=None, local_output_folder=None, detach=False, timer=None):
+        if self.executor is None:
+            self.setup()
+        option_keys = sorted(key for key in run_options.keys() if key not in self.excluded_keys)
+        start = time.time()
+        future = self.executor.submit(run_mock_simulation, local_input_folder, local_output_folder,
+                                      self.template(run_options), self.settings, option_keys)
+        compute = future.result()
+        # Time waiting for a free worker of the pool, like the queue of a real backend.
+        if timer is not None:
+            timer.record('compute', compute)
+            timer.record('queue_wait', time.time() - start - compute)
+        return compute
+
+
+# Compute environments that can be selected with :compute_environment in input.yml.
+BATCH_BACKENDS = {'aws_batch': AWSBatch, 'local': DockerBatch, 'local_mock': LocalMockBatch}
+
+
+# Creates and sets up the backend of the :compute_environment of the analysis configuration.
+def create_batch(analysis_config=None, git_api_token=None):
+    compute_environment = analysis_config[':compute_environment']
+    if compute_environment not in BATCH_BACKENDS:
+        message = f"Unknown :compute_environment {compute_environment}. Allowed values are {list(BATCH_BACKENDS.keys())}."
+        logging.error(message)
+        print(message)
+        exit(1)
+    batch = BATCH_BACKENDS[compute_environment].from_analysis_config(analysis_config=analysis_config,
+                                                                   git_api_token=git_api_token)
+    batch.setup()
+    return batch
+
 
-            # mount point for container to copy simulation files.
-            local_output_folder=None,
+# Persistent on-disk cache of datapoint results. Datapoints are keyed by a hash of the run_options that change the
+# simulation and the identity of the image that ran it, so a repeated scenario returns the stored btap_data.json and
+# output files instead of being simulated again.
+class DatapointCache:
+    def __init__(self,
+                 # Folder where the cache entries are kept. Shared by all analyses on this machine.
+                 cache_folder=DATAPOINT_CACHE_FOLDER,
+                 # Maximum size of the cache in GB. Least recently used entries are evicted above this.
+                 max_size_gb=DATAPOINT_CACHE_MAX_SIZE_GB):
+        self.cache_folder = cache_folder
+        self.max_size_bytes = int(float(max_size_gb) * 1024 ** 3)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(self.cache_folder, exist_ok=True)
+        # Measure the size of the cache once. It is then kept up to date as entries are stored and evicted.
+        self.size_bytes = sum(self.__entry_size(entry) for entry in self.__entries())
+
+    # Creates the cache key from the run_options and the image identity. Keys that do not affect the simulation are
+    # ignored and custom osm files are hashed by content.
+    @staticmethod
+    def key(run_options, image_identity, osm_file=None):
+        options = {key: value for key, value in run_options.items() if key not in DATAPOINT_CACHE_IGNORED_KEYS}
+        options['image_identity'] = image_identity
+        if osm_file is not None:
+            with open(osm_file, 'rb') as file:
+                options['osm_file_sha256'] = hashlib.sha256(file.read()).hexdigest()
+        canonical = json.dumps(options, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    # Returns the cached btap_data dict for the key or None. If a local output folder is given, the cached output
+    # files are copied into it.
+    def get(self, key, local_datapoint_output_folder=None):
+        entry = self.__entry_folder(key)
+        btap_data_path = os.path.join(entry, 'btap_data.json')
+        if not os.path.isfile(btap_data_path):
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            with open(btap_data_path, 'r') as file:
+                btap_data = json.load(file)
+            cached_output_folder = os.path.join(entry, 'output')
+            if local_datapoint_output_folder is not None and os.path.isdir(cached_output_folder):
+                shutil.copytree(cached_output_folder, local_datapoint_output_folder, dirs_exist_ok=True)
+            # Touch the entry so it is the most recently used for eviction.
+            os.utime(btap_data_path)
+        except (OSError, ValueError) as err:
+            # A cache entry that cannot be read is treated as a miss. It will be replaced when the datapoint is stored.
+            logging.warning(f"Could not read datapoint cache entry {entry}. {err}")
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return btap_data
+
+    # Stores a successful btap_data dict and, if given, a copy of the local datapoint output folder.
+    def put(self, key, btap_data, local_datapoint_output_folder=None):
+        entry = self.__entry_folder(key)
+        temp_entry = f"{entry}.{uuid.uuid4()}.tmp"
+        try:
+            os.makedirs(temp_entry)
+            if local_datapoint_output_folder is not None and os.path.isdir(local_datapoint_output_folder):
+                shutil.copytree(local_datapoint_output_folder, os.path.join(temp_entry, 'output'))
+            with open(os.path.join(temp_entry, 'btap_data.json'), 'w') as outfile:
+                json.dump(btap_data, outfile, default=str)
+            # Replace any previous entry. The rename makes the new entry visible all at once.
+            removed_size = 0
+            if os.path.isdir(entry):
+                removed_size = self.__remove_entry(entry)
+            os.rename(temp_entry, entry)
+        except OSError as err:
+            logging.warning(f"Could not store datapoint cache entry {entry}. {err}")
+            shutil.rmtree(temp_entry, ignore_errors=True)
+            return
+        with self.lock:
+            self.stores += 1
+            self.size_bytes += self.__entry_size(entry) - removed_size
+            over_limit = self.size_bytes > self.max_size_bytes
+        if over_limit:
+            self.evict()
+
+    # Removes least recently used entries until the cache is below 90% of the maximum size.
+    def evict(self):
+        with self.lock:
+            entries = sorted(self.__entries(), key=lambda entry: self.__entry_mtime(entry))
+            for entry in entries:
+                if self.size_bytes <= 0.9 * self.max_size_bytes:
+                    break
+                self.size_bytes -= self.__remove_entry(entry)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                    'stores': self.stores,
+                    'evictions': self.evictions,
+                    'size_gb': self.size_bytes / 1024 ** 3}
+
+    def __entry_folder(self, key):
+        # Two character prefix folders keep the number of entries per folder small.
+        return os.path.join(self.cache_folder, key[:2], key)
+
+    def __entries(self):
+        return [entry for entry in glob.glob(os.path.join(self.cache_folder, '*', '*'))
+                if os.path.isdir(entry) and not entry.endswith('.tmp')]
+
+    def __entry_mtime(self, entry):
+        try:
+            return os.path.getmtime(os.path.join(entry, 'btap_data.json'))
+        except OSError:
+            return 0.0
+
+    def __entry_size(self, entry):
+        size = 0
+        for root, dirs, files in os.walk(entry):
+            for file in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass
+        return size
+
+    def __remove_entry(self, entry):
+        size = self.__entry_size(entry)
+        shutil.rmtree(entry, ignore_errors=True)
+        return size
+
+
+# Append-only store of datapoint results. Rows are kept in a SQLite table in WAL mode, and each row is committed as soon
+# as it is saved so results survive a crash. Post-processing reads the whole table back in a single scan instead of
+# reading one csv file per datapoint.
+class ResultsDatabase:
+    def __init__(self, database_path=None):
+        self.database_path = database_path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.database_path), exist_ok=True)
+        # The connection is shared by the analysis threads. Access is serialized with the lock.
+        self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            # Flush to disk on every commit.
+            self.connection.execute('PRAGMA synchronous=FULL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS btap_data ('
+                                    'row_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                    'datapoint_id TEXT, '
+                                    'success INTEGER, '
+                                    'data TEXT, '
+                                    'fingerprint TEXT)')
+            # Databases created before fingerprints were stored do not have the column.
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(btap_data)').fetchall()]
+            if 'fingerprint' not in columns:
+                self.connection.execute('ALTER TABLE btap_data ADD COLUMN fingerprint TEXT')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS btap_data_fingerprint ON btap_data (fingerprint)')
+            # Ledger of the datapoints that were submitted, so an interrupted analysis can re-attach to its jobs.
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                                    'fingerprint TEXT PRIMARY KEY, '
+                                    'datapoint_id TEXT, '
+                                    'job_name TEXT, '
+                                    'job_id TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_job_name ON jobs (job_name)')
+            self.connection.commit()
+
+    # Appends a datapoint row. The row is a dict of the top level values of btap_data.
+    def add(self, row):
+        data = json.dumps(row, default=self.__json_default)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT INTO btap_data (datapoint_id, success, data, fingerprint) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        (row.get(':datapoint_id'), 1 if row.get('success') == True else 0, data,
+                                         row.get('datapoint_fingerprint')))
+
+    # Appends many datapoint rows in a single transaction.
+    def add_many(self, rows):
+        values = [(row.get(':datapoint_id'), 1 if row.get('success') == True else 0,
+                   json.dumps(row, default=self.__json_default), row.get('datapoint_fingerprint')) for row in rows]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('INSERT INTO btap_data (datapoint_id, success, data, fingerprint) '
+                                            'VALUES (?, ?, ?, ?)', values)
+
+    # Number of rows. Set success to True or False to count only successful or failed datapoints.
+    def count(self, success=None):
+        with self.lock:
+            if success is None:
+                return self.connection.execute('SELECT COUNT(*) FROM btap_data').fetchone()[0]
+            return self.connection.execute('SELECT COUNT(*) FROM btap_data WHERE success = ?',
+                                           (1 if success else 0,)).fetchone()[0]
+
+    # Returns the last successful row saved for a datapoint fingerprint or None.
+    def get(self, fingerprint):
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM btap_data WHERE fingerprint = ? AND success = 1 '
+                                          'ORDER BY row_id DESC LIMIT 1', (fingerprint,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # Deletes the rows of failed datapoints and returns their datapoint ids. Used when an analysis is resumed so the
+    # failed datapoints are run again.
+    def delete_failed(self):
+        with self.lock:
+            with self.connection:
+                rows = self.connection.execute('SELECT datapoint_id FROM btap_data WHERE success = 0').fetchall()
+                self.connection.execute('DELETE FROM btap_data WHERE success = 0')
+        return [row[0] for row in rows]
+
+    # Records a datapoint that is about to be submitted.
+    def add_job(self, fingerprint, datapoint_id, job_name):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO jobs (fingerprint, datapoint_id, job_name, job_id) '
+                                        'VALUES (?, ?, ?, NULL)', (fingerprint, datapoint_id, job_name))
+
+    # Records the id the compute environment gave to a submitted job.
+    def set_job_id(self, job_name, job_id):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('UPDATE jobs SET job_id = ? WHERE job_name = ?', (job_id, job_name))
+
+    # Returns a dict with the datapoint_id, job_name and job_id submitted for a fingerprint or None.
+    def get_job(self, fingerprint):
+        with self.lock:
+            row = self.connection.execute('SELECT datapoint_id, job_name, job_id FROM jobs WHERE fingerprint = ?',
+                                          (fingerprint,)).fetchone()
+        return None if row is None else {'datapoint_id': row[0], 'job_name': row[1], 'job_id': row[2]}
+
+    def get_job_id(self, job_name):
+        with self.lock:
+            row = self.connection.execute('SELECT job_id FROM jobs WHERE job_name = ?', (job_name,)).fetchone()
+        return None if row is None else row[0]
+
+    # Reads all rows as dicts in the order they were saved.
+    def read_rows(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT data FROM btap_data ORDER BY row_id').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    # Reads all rows into a dataframe in the order they were saved.
+    def read_dataframe(self):
+        return pd.DataFrame.from_records(self.read_rows())
+
+    # Exports the rows in the previous layout of one csv file per datapoint. Failed datapoints are also written to the
+    # failures folder if given.
+    def export_csv(self, database_folder, failures_folder=None):
+        os.makedirs(database_folder, exist_ok=True)
+        df = self.read_dataframe()
+        for index in range(len(df.index)):
+            row_df = df.iloc[[index]].dropna(axis=1, how='all')
+            datapoint_id = row_df[':datapoint_id'].iloc[0]
+            row_df.to_csv(os.path.join(database_folder, f"{datapoint_id}.csv"))
+            if failures_folder is not None and row_df['success'].iloc[0] != True:
+                os.makedirs(failures_folder, exist_ok=True)
+                row_df.to_csv(os.path.join(failures_folder, f"{datapoint_id}.csv"))
+        message = f"Exported {len(df.index)} datapoint csv files to {database_folder}"
+        logging.info(message)
+        print(message)
 
-            # Don't detach.. hold on to current thread.
-            detach=False):
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # The database can be used in a with block that closes it.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def __json_default(value):
+        # numpy scalars are stored as python values, anything else as a string.
+        if isinstance(value, np.generic):
+            return value.item()
+        return str(value)
+
+
+# Predicts the simulation time of datapoints from the simulation times of earlier datapoints. The simulation time is the
+# compute span of a datapoint, the time its simulation ran without the queue wait and file transfers, so the estimate
+# does not depend on how busy the backend was. The simulation times of all analyses on this machine are kept in a SQLite
+# table with the features of their run_options. A gradient boosting model is trained on the log of the times of the
+# compute environment of the analysis. String options such as :building_type, :epw_file and :ecm_system_name are one
+# hot encoded, numbers are kept as they are and lists such as :output_variables are replaced by their length.
+class RuntimeEstimator:
+    def __init__(self, history_path=RUNTIME_HISTORY_PATH, compute_environment=None):
+        self.history_path = history_path
+        self.compute_environment = compute_environment
+        self.lock = threading.Lock()
+        self.vectorizer = None
+        self.model = None
+        os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+        # Other analyses may be writing to the history. Wait for their transactions instead of failing.
+        self.connection = sqlite3.connect(self.history_path, timeout=60.0, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS compute_times ('
+                                    'row_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                    'compute_environment TEXT, '
+                                    'features TEXT, '
+                                    'compute_time REAL, '
+                                    'updated REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS compute_times_compute_environment '
+                                    'ON compute_times (compute_environment)')
+            self.connection.commit()
+
+    # Returns the features of a datapoint from its run_options. Keys that do not change the simulation are ignored.
+    @staticmethod
+    def features(run_options):
+        features = {}
+        for key, value in run_options.items():
+            if key in DATAPOINT_CACHE_IGNORED_KEYS or value is None or isinstance(value, dict):
+                continue
+            if isinstance(value, list):
+                features[f"{key}_count"] = len(value)
+            elif isinstance(value, (bool, int, float, np.number)):
+                features[key] = float(value)
+            else:
+                features[key] = str(value)
+        return features
+
+    # Adds the simulation time (the compute span) of a datapoint to the history.
+    def put(self, run_options, compute_time):
+        data = json.dumps(self.features(run_options), sort_keys=True)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT INTO compute_times (compute_environment, features, '
+                                        'compute_time, updated) VALUES (?, ?, ?, ?)',
+                                        (self.compute_environment, data, float(compute_time), time.time()))
+
+    # Number of simulation times of the compute environment in the history.
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM compute_times WHERE compute_environment = ?',
+                                           (self.compute_environment,)).fetchone()[0]
+
+    # Trains the model on the most recent simulation times of the compute environment. Returns False if there are not
+    # enough of them.
+    def fit(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT features, compute_time FROM compute_times '
+                                           'WHERE compute_environment = ? AND compute_time > 0 '
+                                           'ORDER BY row_id DESC LIMIT ?',
+                                           (self.compute_environment, RUNTIME_ESTIMATOR_MAX_TRAINING_POINTS)).fetchall()
+        if len(rows) < RUNTIME_ESTIMATOR_MIN_SAMPLES:
+            message = f"Runtime estimator has {len(rows)} simulation times for {self.compute_environment}. " \
+                      f"{RUNTIME_ESTIMATOR_MIN_SAMPLES} are needed to order the scenarios."
+            logging.info(message)
+            print(message)
+            return False
+        vectorizer = DictVectorizer(sparse=False)
+        x = vectorizer.fit_transform([json.loads(row[0]) for row in rows])
+        y = np.log([row[1] for row in rows])
+        model = GradientBoostingRegressor(n_estimators=200, max_depth=3, learning_rate=0.05, subsample=0.8,
+                                          random_state=1).fit(x, y)
+        with self.lock:
+            self.vectorizer = vectorizer
+            self.model = model
+        message = f"Runtime estimator trained on {len(rows)} simulation times for {self.compute_environment}."
+        logging.info(message)
+        print(message)
+        return True
+
+    # Returns the predicted simulation times (s) of a list of run_options. Options that were never seen in the history
+    # are ignored.
+    def predict(self, run_options_list):
+        with self.lock:
+            vectorizer, model = self.vectorizer, self.model
+        if len(run_options_list) == 0:
+            return np.array([])
+        x = vectorizer.transform([self.features(run_options) for run_options in run_options_list])
+        return np.exp(model.predict(x))
+
+    # Generator of (run_options, predicted simulation time) with the longest predicted datapoints first. The scenarios
+    # are ordered in blocks of RUNTIME_ORDER_BLOCK_SIZE.
+    def longest_first(self, scenarios):
+        scenarios = iter(scenarios)
+        while True:
+            block = list(itertools.islice(scenarios, RUNTIME_ORDER_BLOCK_SIZE))
+            if len(block) == 0:
+                return
+            predictions = self.predict(block)
+            for index in np.argsort(-predictions, kind='stable'):
+                yield block[index], float(predictions[index])
+
+    # Makespan (s) of running the times on the number of workers, each time starting on the first free worker in the
+    # order given.
+    @staticmethod
+    def makespan(times, workers):
+        finish_times = [0.0] * max(int(workers), 1)
+        for seconds in times:
+            heapq.heappush(finish_times, heapq.heappop(finish_times) + seconds)
+        return max(finish_times)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Times the phases of a datapoint, from writing its inputs to saving its result. Each phase is a named span that adds up
+# the seconds spent in it. The spans are saved in btap_data as span_<name>_s columns.
+class DatapointTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
 
-        # If local i/o folder is not set.. try to use folder where this file is.
-        if local_input_folder == None:
-            local_input_folder = os.path.join(self.dir_path, 'input')
-        if local_output_folder == None:
-            local_output_folder = os.path.join(self.dir_path, 'output')
+    # Context manager that adds the time spent in it to the span name.
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    # Adds seconds measured elsewhere, for example from the timestamps of an AWS Batch job, to the span name.
+    def record(self, name, seconds):
+        if seconds is None:
+            return
+        with self.lock:
+            self.spans[name] = self.spans.get(name, 0.0) + max(float(seconds), 0.0)
+
+    # Returns the seconds recorded in the span name, or None if it was not recorded.
+    def seconds(self, name):
+        with self.lock:
+            return self.spans.get(name)
+
+    # Returns the span_<name>_s columns of the spans.
+    def to_dict(self):
+        with self.lock:
+            return {f"{DATAPOINT_SPAN_PREFIX}{name}{DATAPOINT_SPAN_SUFFIX}": round(seconds, 3)
+                    for name, seconds in self.spans.items()}
+
+    # True if a btap_data key is a span column.
+    @staticmethod
+    def is_span(key):
+        return key.startswith(DATAPOINT_SPAN_PREFIX) and key.endswith(DATAPOINT_SPAN_SUFFIX)
+
+
+# Thread safe counts of the completed and failed datapoints of an analysis. It is seeded once from the results database
+# and updated as each result is saved, so progress can be reported without scanning the disk. It also provides the
+# throughput and estimated time remaining of the datapoints run in this session.
+class ProgressTracker:
+    def __init__(self, completed=0, failed=0):
+        self.lock = threading.Lock()
+        self.completed = completed
+        self.failed = failed
+        # Datapoints completed before this session are not counted in the throughput.
+        self.initial_completed = completed
+        self.start_time = time.time()
+
+    # Restart the clock used for throughput when the datapoints start to run.
+    def start(self):
+        with self.lock:
+            self.initial_completed = self.completed
+            self.start_time = time.time()
+
+    def record(self, success):
+        with self.lock:
+            self.completed += 1
+            if not success:
+                self.failed += 1
+
+    def get_completed(self):
+        with self.lock:
+            return self.completed
+
+    def get_failed(self):
+        with self.lock:
+            return self.failed
+
+    # Returns a dict with the counts, elapsed time, throughput in datapoints per hour and the estimated seconds
+    # remaining to reach total datapoints.
+    def stats(self, total=None):
+        with self.lock:
+            completed = self.completed
+            failed = self.failed
+            completed_in_session = self.completed - self.initial_completed
+        elapsed = time.time() - self.start_time
+        throughput = completed_in_session * 3600.0 / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if total is not None and completed_in_session > 0:
+            eta = max(total - completed, 0) * elapsed / completed_in_session
+        return {'completed': completed,
+                'failed': failed,
+                'elapsed': elapsed,
+                'throughput_per_hour': throughput,
+                'eta': eta}
+
+    # Short summary for the log and progress bar.
+    def message(self, total=None):
+        stats = self.stats(total)
+        eta = 'unknown' if stats['eta'] is None else str(datetime.timedelta(seconds=round(stats['eta'])))
+        return f"TotalRuns:{total}\tCompleted:{stats['completed']}\tFailed:{stats['failed']}\t" \
+               f"Elapsed Time: {str(datetime.timedelta(seconds=round(stats['elapsed'])))}\t" \
+               f"Throughput: {stats['throughput_per_hour']:.1f}/h\tETA: {eta}"
+
+    # Updates a tqdm progress bar with the failures, throughput and estimated time remaining.
+    def update_progress_bar(self, pbar, total=None):
+        stats = self.stats(total)
+        eta = 'unknown' if stats['eta'] is None else str(datetime.timedelta(seconds=round(stats['eta'])))
+        pbar.set_postfix_str(f"Failed:{stats['failed']}, {stats['throughput_per_hour']:.1f} runs/h, ETA {eta}")
+        pbar.update(1)
+
+
+# Compact store of the hourly outputs of an analysis. Each variable is kept as a float32 .npy block with one row per
+# datapoint KeyValue and one column per hour. An index.json file maps each datapoint_id to its rows in every block.
+# Blocks are opened memory mapped, so slicing by variable or datapoint, concatenation and load-duration analysis only
+# read the rows they need from disk.
+class HourlyResultsStore:
+    def __init__(self, store_folder=None):
+        self.store_folder = store_folder
+        self.index_path = os.path.join(store_folder, HOURLY_STORE_INDEX_FILENAME)
+        self.blocks = {}
+        self.index = None
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as file:
+                self.index = json.load(file)
+
+    # Converts hourly.csv files into the store, replacing its previous contents. The files are read twice, first to
+    # count the rows of each variable and then to fill the blocks, so a single file is held in memory at a time.
+    def build(self, csv_paths):
+        os.makedirs(self.store_folder, exist_ok=True)
+        # The index is written last. A store without an index is incomplete and is treated as empty.
+        if os.path.isfile(self.index_path):
+            os.remove(self.index_path)
+        self.index = None
+        self.blocks = {}
+
+        # First pass. Count the rows of each variable and check that all files have the same hours.
+        hours = None
+        row_counts = {}
+        units = {}
+        valid_paths = []
+        for csv_path in csv_paths:
+            if os.stat(csv_path).st_size == 0:
+                continue
+            file_hours = list(pd.read_csv(csv_path, nrows=0).columns[4:])
+            if hours is None:
+                hours = file_hours
+            elif file_hours != hours:
+                message = f"Hourly output {csv_path} does not have the same hours as the other datapoints. Skipping."
+                logging.error(message)
+                continue
+            df = pd.read_csv(csv_path, usecols=['Name', 'Units'])
+            for name, count in df['Name'].value_counts(sort=False).items():
+                row_counts[name] = row_counts.get(name, 0) + int(count)
+                units.setdefault(name, df.loc[df['Name'] == name, 'Units'].iloc[0])
+            valid_paths.append(csv_path)
+        if hours is None:
+            return self
+
+        # Second pass. Copy the rows of each file into the blocks.
+        variables = {}
+        blocks = {}
+        offsets = {}
+        for number, name in enumerate(row_counts.keys()):
+            file_name = f"variable_{number}.npy"
+            blocks[name] = np.lib.format.open_memmap(os.path.join(self.store_folder, file_name), mode='w+',
+                                                     dtype=np.float32, shape=(row_counts[name], len(hours)))
+            offsets[name] = 0
+            variables[name] = {'file': file_name,
+                               'units': str(units[name]),
+                               'rows': row_counts[name],
+                               'key_values': [],
+                               'datapoints': {}}
+        datapoint_ids = []
+        for csv_path in valid_paths:
+            df = pd.read_csv(csv_path)
+            datapoint_id = str(df['datapoint_id'].iloc[0])
+            datapoint_ids.append(datapoint_id)
+            for name, group in df.groupby('Name', sort=False):
+                start = offsets[name]
+                stop = start + len(group.index)
+                blocks[name][start:stop] = group[hours].to_numpy(dtype=np.float32)
+                variables[name]['key_values'].extend(group['KeyValue'].astype(str).tolist())
+                variables[name]['datapoints'][datapoint_id] = [start, stop]
+                offsets[name] = stop
+        for block in blocks.values():
+            block.flush()
+        del blocks
+
+        index = {'hours': hours, 'datapoints': datapoint_ids, 'variables': variables}
+        with open(self.index_path + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        self.index = index
+        message = f"Saved hourly outputs of {len(datapoint_ids)} datapoints to {self.store_folder}"
+        logging.info(message)
+        return self
+
+    def get_hours(self):
+        return [] if self.index is None else self.index['hours']
+
+    def get_datapoints(self):
+        return [] if self.index is None else self.index['datapoints']
+
+    def get_variables(self):
+        return [] if self.index is None else list(self.index['variables'].keys())
+
+    # Returns the hourly values of a variable as a read only memory mapped array with one row per KeyValue. Only the rows
+    # of datapoint_id are returned if it is given.
+    def get(self, variable, datapoint_id=None):
+        block = self.__block(variable)
+        if datapoint_id is None:
+            return block
+        start, stop = self.__rows(variable, datapoint_id)
+        return block[start:stop]
+
+    def get_key_values(self, variable, datapoint_id=None):
+        key_values = self.index['variables'][variable]['key_values']
+        if datapoint_id is None:
+            return key_values
+        start, stop = self.__rows(variable, datapoint_id)
+        return key_values[start:stop]
+
+    # Returns the hourly values of a variable in the hourly.csv layout.
+    def to_dataframe(self, variable, datapoint_id=None):
+        datapoints = self.index['variables'][variable]['datapoints']
+        datapoint_ids = [datapoint_id] if datapoint_id is not None else list(datapoints.keys())
+        ids = []
+        for row_datapoint_id in datapoint_ids:
+            start, stop = self.__rows(variable, row_datapoint_id)
+            ids.extend([row_datapoint_id] * (stop - start))
+        df = pd.DataFrame(self.get(variable, datapoint_id), columns=self.get_hours())
+        df.insert(0, 'datapoint_id', ids)
+        df.insert(1, 'Name', variable)
+        df.insert(2, 'KeyValue', self.get_key_values(variable, datapoint_id))
+        df.insert(3, 'Units', self.index['variables'][variable]['units'])
+        return df
 
-        # Run the simulation
-        jobName = f"{run_options[':analysis_id']}-{run_options[':datapoint_id']}"
-        message = f"Submitting job {jobName}"
+    # Writes the hourly values of all datapoints to a single csv file in the hourly.csv layout. It is written one
+    # datapoint and variable at a time.
+    def export_csv(self, output_file, variables=None):
+        variables = self.get_variables() if variables is None else variables
+        with open(output_file, 'w', newline='') as file:
+            pd.DataFrame(columns=['datapoint_id', 'Name', 'KeyValue', 'Units'] + self.get_hours()).to_csv(file,
+                                                                                                      index=False)
+            for variable in variables:
+                for datapoint_id in self.index['variables'][variable]['datapoints'].keys():
+                    self.to_dataframe(variable, datapoint_id).to_csv(file, header=False, index=False)
+        message = f"Exported hourly outputs to {output_file}"
         logging.info(message)
-        volumes = {
-            local_output_folder: {
-                'bind': '/btap_costing/utilities/btap_cli/output',
-                'mode': 'rw'},
-            local_input_folder: {
-                'bind': '/btap_costing/utilities/btap_cli/input',
-                'mode': 'rw'},
-        }
-        # Runnning docker command
-        run_options[
-            'docker_command'] = f"docker run --rm -v {local_output_folder}:/btap_costing/utilities/btap_cli/output -v {local_input_folder}:/btap_costing/utilities/btap_cli/input {run_options[':image_name']} bundle exec ruby btap_cli.rb"
-        result = self.docker_client.containers.run(
-            # Local image name to use.
-            image=run_options[':image_name'],
-
-            # Command issued to container.
-            command='bundle exec ruby btap_cli.rb',
-
-            # host volume mount points and setting to read and write.
-            volumes=volumes,
-            # Will detach from current thread.. don't do it if you don't understand this.
-            detach=detach,
-            # This deletes the container on exit otherwise the container
-            # will bloat your system.
-            auto_remove=True
-        )
 
-        return result
+    # Load-duration curve of a variable. The KeyValues of each datapoint are summed and the hours are sorted from the
+    # highest to the lowest value. Returns a dataframe with a row per datapoint and a column per ranked hour.
+    def load_duration(self, variable, datapoint_ids=None):
+        datapoints = self.index['variables'][variable]['datapoints']
+        datapoint_ids = list(datapoints.keys()) if datapoint_ids is None else datapoint_ids
+        curves = np.zeros((len(datapoint_ids), len(self.get_hours())), dtype=np.float64)
+        for row, datapoint_id in enumerate(datapoint_ids):
+            profile = self.get(variable, datapoint_id).sum(axis=0, dtype=np.float64)
+            curves[row] = -np.sort(-profile)
+        return pd.DataFrame(curves, index=pd.Index(datapoint_ids, name='datapoint_id'))
+
+    def __rows(self, variable, datapoint_id):
+        return self.index['variables'][variable]['datapoints'].get(datapoint_id, [0, 0])
+
+    def __block(self, variable):
+        if variable not in self.blocks:
+            self.blocks[variable] = np.load(os.path.join(self.store_folder, self.index['variables'][variable]['file']),
+                                            mmap_mode='r')
+        return self.blocks[variable]
+
+
+# Encoder between the options of the building_options variables and integers. The options of each variable are sorted
+# and numbered from 0 as sklearn's LabelEncoder did, so designs keep the same integers. The options are kept in a padded
+# table of strings with a row per variable, so a whole matrix of designs is decoded with one numpy indexing operation.
+# encode does the reverse lookup from option values, for example the results of an analysis, back to integers.
+class OptionEncoder:
+    def __init__(self, variables=None):
+        # Names of the variables in the column order of the designs.
+        self.keys = list(variables.keys())
+        options = [[str(option) for option in np.unique(np.asarray(value))] for value in variables.values()]
+        self.number_of_options = np.array([len(variable_options) for variable_options in options], dtype=int)
+        self.table = np.full((len(options), max(self.number_of_options, default=0)), None, dtype=object)
+        for row, variable_options in enumerate(options):
+            self.table[row, :len(variable_options)] = variable_options
+        # Integer of each option of each variable for the reverse lookup.
+        self.lookup = [{option: number for number, option in enumerate(variable_options)} for variable_options in options]
+
+    def number_of_variables(self):
+        return len(self.keys)
+
+    # Largest integer of each variable.
+    def upper_bounds(self):
+        return self.number_of_options - 1
+
+    # Returns the option strings of an (n_designs, n_variables) array of integers, or of a single design.
+    def decode(self, x):
+        x = np.asarray(x, dtype=int)
+        if x.ndim == 1:
+            return self.decode(x[np.newaxis, :])[0]
+        if x.shape[1] != len(self.keys):
+            raise ValueError(f"Designs have {x.shape[1]} variables but the encoder has {len(self.keys)}.")
+        if np.any(x < 0) or np.any(x > self.upper_bounds()):
+            raise ValueError("Design integers are outside of the options of the variables.")
+        return self.table[np.arange(len(self.keys)), x]
+
+    # Returns the integers of option values. values is a dataframe with a column per variable, such as btap_data
+    # results, or an (n_designs, n_variables) array. Options that are not in the encoder are returned as -1.
+    def encode(self, values):
+        if isinstance(values, pd.DataFrame):
+            values = values[self.keys]
+        df = pd.DataFrame(np.asarray(values, dtype=object).reshape(-1, len(self.keys)), columns=self.keys)
+        x = np.empty(df.shape, dtype=int)
+        for column, key in enumerate(self.keys):
+            x[:, column] = df[key].astype(str).map(self.lookup[column]).fillna(-1).to_numpy(dtype=int)
+        return x
 
 
 # Parent Analysis class from with all analysis inherit
@@ -1273,19 +3298,10 @@ class BTAPAnalysis():
         self.building_options = building_options
         self.project_root = project_root  # os.path.dirname(analysis_config_file)
         self.baseline_results = baseline_results
-
-        # Making sure that used installed docker.
-        find_docker = os.system("docker -v")
-        if find_docker != 0:
-            logging.exception("Docker is not installed on this system")
-
-        # Try to access the docker daemon. If we cannot.. ask user to turn it on and then exit.
-        try:
-            docker.from_env()
-        except DockerException as err:
-            logging.error(
-                f"Could not access Docker Daemon. Either it is not running, or you do not have permissions to run docker. {err}")
-            exit(1)
+        # Dataframe of the post-processed results. Set by generate_output_file.
+        self.results_df = None
+        # Priority of the datapoints of this analysis for the worker slots of the batch. Lower runs first.
+        self.priority = 0
 
         # Check user selected public version.. if so force costing to be turned off.
         if self.analysis_config[':image_name'] == 'btap_public_cli':
@@ -1296,47 +3312,46 @@ class BTAPAnalysis():
         # Create required paths and folders for analysis
         self.create_paths_folders()
 
-        # If batch object has not been pass/created.. make one.
-        # This really should be replaced with a https://en.wikipedia.org/wiki/Factory_method_pattern.
+        # If batch object has not been pass/created.. make one for the :compute_environment. The analysis tears down
+        # a batch it owns when it is done.
+        self.owns_batch = False
         if self.batch == None:
-            if self.analysis_config[':compute_environment'] == 'aws_batch':
-                # If aws batch object was not passed.. create it.
-
-                # Start batch queue if required.
-                # create aws image, set up aws compute env and create workflow queue.
-                self.batch = AWSBatch(
-                    analysis_id=self.analysis_config[':analysis_id'],
-                    btap_image_name=self.analysis_config[':image_name'],
-                    rebuild_image=self.analysis_config[':nocache'],
-                    git_api_token=git_api_token,
-                    os_version=self.analysis_config[':os_version'],
-                    btap_costing_branch=self.analysis_config[':btap_costing_branch'],
-                    os_standards_branch=self.analysis_config[':os_standards_branch'],
-                )
-                self.batch.setup()
-            else:
-                self.batch = DockerBatch(image_name=self.analysis_config[':image_name'],
-                                         git_api_token=git_api_token,
-                                         os_standards_branch=self.analysis_config[':os_standards_branch'],
-                                         btap_costing_branch=self.analysis_config[':btap_costing_branch'],
-                                         os_version=self.analysis_config[':os_version'],
-                                         nocache=self.analysis_config[':nocache'])
-                self.batch.setup()
+            self.batch = create_batch(analysis_config=self.analysis_config, git_api_token=git_api_token)
+            self.owns_batch = True
+
+        # Let the batch record and re-attach to the jobs of this analysis.
+        self.batch.register_job_ledger(self.analysis_config[':analysis_id'], self.results_database)
+
+        # Set up the persistent datapoint result cache if requested in the input file.
+        self.datapoint_cache = None
+        if self.use_datapoint_cache():
+            self.datapoint_cache = DatapointCache(
+                cache_folder=self.analysis_config.get(':datapoint_cache_folder') or DATAPOINT_CACHE_FOLDER,
+                max_size_gb=self.analysis_config.get(':datapoint_cache_max_size_gb') or DATAPOINT_CACHE_MAX_SIZE_GB)
+            message = f"Using datapoint cache at {self.datapoint_cache.cache_folder}"
+            logging.info(message)
+            print(message)
+
+        # Set up the runtime estimator if requested in the input file. It records the simulation times of the analysis
+        # and orders parametric scenarios longest predicted first.
+        self.runtime_estimator = None
+        if self.analysis_config.get(':runtime_estimator', False):
+            self.runtime_estimator = RuntimeEstimator(
+                history_path=self.analysis_config.get(':runtime_history_path') or RUNTIME_HISTORY_PATH,
+                compute_environment=self.analysis_config[':compute_environment'])
+            message = f"Using runtime history at {self.runtime_estimator.history_path}"
+            logging.info(message)
+            print(message)
+
+    # True if the datapoints of this analysis are taken from and stored in the datapoint cache.
+    def use_datapoint_cache(self):
+        return self.analysis_config.get(':datapoint_cache', False) == True
 
     def get_num_of_runs_failed(self):
-        if os.path.isdir(self.failures_folder):
-            return len([name for name in os.listdir(self.failures_folder) if
-                        os.path.isfile(os.path.join(self.failures_folder, name))])
-        else:
-            return 0
+        return self.progress.get_failed()
 
     def get_num_of_runs_completed(self):
-
-        if os.path.isdir(self.database_folder):
-            return len([name for name in os.listdir(self.database_folder) if
-                        os.path.isfile(os.path.join(self.database_folder, name))])
-        else:
-            return 0
+        return self.progress.get_completed()
 
     # This methods sets the pathnames and creates the input and output folders for the analysis. It also initilizes the
     # sql database.
@@ -1345,6 +3360,10 @@ class BTAPAnalysis():
         # Create analysis folder
         os.makedirs(self.project_root, exist_ok=True)
 
+        # Keep the results of a previous run of the analysis and only run the datapoints that are missing.
+        # The analysis_id of the run to resume is found by btap_batch.
+        self.resume = self.analysis_config.get(':resume', False) == True
+
         # Create unique id for the analysis if not given.
         if not ':analysis_id' in self.analysis_config or self.analysis_config[':analysis_id'] == None:
             self.analysis_config[':analysis_id'] = str(uuid.uuid4())
@@ -1364,12 +3383,15 @@ class BTAPAnalysis():
         self.analysis_id_folder = os.path.join(self.analysis_name_folder,
                                                self.analysis_config[':analysis_id'])
 
+        if self.resume and os.path.isdir(self.analysis_id_folder):
+            message = f'Resuming analysis in: {self.analysis_id_folder}'
+            logging.info(message)
+            print(message)
         # Tell log we are deleting previous runs.
-        message = f'Deleting previous runs from: {self.analysis_name_folder}'
-        logging.info(message)
-        print(message)
-        # Check if folder exists
-        if os.path.isdir(self.analysis_name_folder):
+        elif os.path.isdir(self.analysis_name_folder):
+            message = f'Deleting previous runs from: {self.analysis_name_folder}'
+            logging.info(message)
+            print(message)
             # Remove old folder
             try:
                 shutil.rmtree(self.analysis_name_folder)
@@ -1406,9 +3428,29 @@ class BTAPAnalysis():
         logging.info(f"local mounted database_folder folder:{self.database_folder}")
         logging.info(f"local mounted failures_folder folder:{self.failures_folder}")
 
+        # Results of each datapoint are appended to this database as they complete.
+        self.results_database = ResultsDatabase(os.path.join(self.database_folder, RESULTS_DATABASE_FILENAME))
+        logging.info(f"results database:{self.results_database.database_path}")
+        # Datapoints that failed before the analysis was resumed, for example because it was interrupted, are run again.
+        if self.resume:
+            failed_datapoint_ids = self.results_database.delete_failed()
+            for datapoint_id in failed_datapoint_ids:
+                failure_path = os.path.join(self.failures_folder, f"{datapoint_id}.csv")
+                if os.path.isfile(failure_path):
+                    os.remove(failure_path)
+            if len(failed_datapoint_ids) > 0:
+                message = f"{len(failed_datapoint_ids)} datapoints that failed will be run again."
+                logging.info(message)
+                print(message)
+        # Count datapoints already in the database once. The counts are then kept as results are saved.
+        self.progress = ProgressTracker(completed=self.results_database.count(),
+                                        failed=self.results_database.count(success=False))
+
     def run_datapoint(self, run_options):
         # Start timer to track simulation time.
         start = time.time()
+        # Times the phases of the datapoint.
+        timer = DatapointTimer()
 
         # Save run options to a unique folder. Run options is modified to contain datapoint id, analysis_id and
         # other run information.
@@ -1425,6 +3467,26 @@ class BTAPAnalysis():
         run_options[':output_meters'] = self.analysis_config[':output_meters']
         run_options[':algorithm_type'] = self.analysis_config[':algorithm'][':type']
 
+        # Custom osm file if required.
+        local_osm_dict = self.get_local_osm_files()
+        local_osm_file = local_osm_dict.get(run_options[':building_type'])
+
+        # Fingerprint of the simulation inputs. Used to find datapoints that were run before the analysis was resumed.
+        fingerprint = DatapointCache.key(run_options, None, osm_file=local_osm_file)
+        if self.resume:
+            btap_data = self.results_database.get(fingerprint)
+            if btap_data is not None:
+                logging.info(f"Datapoint {btap_data.get(':datapoint_id')} was completed before the analysis was resumed.")
+                btap_data['datapoint_resumed'] = True
+                return btap_data
+            # Reuse the datapoint id of a datapoint that was submitted before the interruption so its job can be
+            # re-attached to.
+            job = self.results_database.get_job(fingerprint)
+            if job is not None:
+                run_options[':datapoint_id'] = job['datapoint_id']
+        self.results_database.add_job(fingerprint, run_options[':datapoint_id'],
+                                      f"{run_options[':analysis_id']}-{run_options[':datapoint_id']}")
+
         # Local Paths
         local_datapoint_input_folder = os.path.join(self.input_folder, run_options[':datapoint_id'])
         local_datapoint_output_folder = os.path.join(self.output_folder, run_options[':datapoint_id'])
@@ -1432,48 +3494,112 @@ class BTAPAnalysis():
         # Create path to btap_data.json file.
         local_btap_data_path = os.path.join(self.output_folder, run_options[':datapoint_id'], 'btap_data.json')
 
-        # Save run_option file for this simulation.
-        os.makedirs(local_datapoint_input_folder, exist_ok=True)
-        logging.info(f'saving simulation input file here:{local_run_option_file}')
-        with open(local_run_option_file, 'w') as outfile:
-            yaml.dump(run_options, outfile, encoding=('utf-8'))
-
-        # Save custom osm file if required.
-        local_osm_dict = self.get_local_osm_files()
-        if run_options[':building_type'] in local_osm_dict:
-            shutil.copy(local_osm_dict[run_options[':building_type']], local_datapoint_input_folder)
-            logging.info(
-                f"Copying osm file from {local_osm_dict[run_options[':building_type']]} to {local_datapoint_input_folder}")
+        timer.record('prepare', time.time() - start)
+
+        # Return the cached result if this datapoint has been simulated before with the same image.
+        cache_key = None
+        if self.datapoint_cache is not None:
+            with timer.span('cache_lookup'):
+                cache_key = self.datapoint_cache.key(run_options, self.batch.image_identity(), osm_file=local_osm_file)
+                btap_data = self.datapoint_cache.get(cache_key,
+                                                     local_datapoint_output_folder=local_datapoint_output_folder)
+            if btap_data is not None:
+                logging.info(f"Datapoint cache hit {cache_key} for datapoint {run_options[':datapoint_id']}")
+                btap_data = self.cached_datapoint_result(btap_data, run_options, local_datapoint_output_folder)
+                btap_data['datapoint_fingerprint'] = fingerprint
+                timer.record('datapoint', time.time() - start)
+                btap_data.update(timer.to_dict())
+                return btap_data
 
-        # Submit Job to batch
-        return self.batch.submit_job(self.output_folder,
-                                     local_btap_data_path,
-                                     local_datapoint_input_folder,
-                                     local_datapoint_output_folder,
-                                     run_options)
+        # Save run_option file for this simulation.
+        with timer.span('write_inputs'):
+            os.makedirs(local_datapoint_input_folder, exist_ok=True)
+            logging.info(f'saving simulation input file here:{local_run_option_file}')
+            with open(local_run_option_file, 'w') as outfile:
+                yaml.dump(run_options, outfile, encoding=('utf-8'))
+
+            # Save custom osm file if required.
+            if local_osm_file is not None:
+                shutil.copy(local_osm_file, local_datapoint_input_folder)
+                logging.info(
+                    f"Copying osm file from {local_osm_file} to {local_datapoint_input_folder}")
+
+        # Submit Job to batch once a worker slot of the batch is free.
+        worker_slots = self.batch.get_worker_slots()
+        with timer.span('worker_slot'):
+            worker_slots.acquire(self.priority, group=self.analysis_config[':analysis_name'])
+        try:
+            btap_data = self.batch.submit_job(self.output_folder,
+                                              local_btap_data_path,
+                                              local_datapoint_input_folder,
+                                              local_datapoint_output_folder,
+                                              run_options,
+                                              timer=timer)
+        finally:
+            worker_slots.release(group=self.analysis_config[':analysis_name'])
+        btap_data['datapoint_fingerprint'] = fingerprint
+
+        # Add the compute span to the history of the runtime estimator. The simulation_time of a backend also has the
+        # queue wait and file transfers, which depend on the load of the backend rather than on the datapoint.
+        compute_time = timer.seconds('compute')
+        if self.runtime_estimator is not None and btap_data['success'] == True and compute_time is not None:
+            self.runtime_estimator.put(run_options, compute_time)
+
+        # Store successful simulations in the cache. Output files are only kept for local runs, S3 runs keep their url.
+        if cache_key is not None and btap_data['success'] == True and btap_data.get('eplus_fatals', 0) == 0:
+            with timer.span('cache_store'):
+                cached_output_folder = None
+                if btap_data['datapoint_output_url'].startswith('file:///'):
+                    cached_output_folder = local_datapoint_output_folder
+                self.datapoint_cache.put(cache_key, btap_data, local_datapoint_output_folder=cached_output_folder)
+        timer.record('datapoint', time.time() - start)
+        btap_data.update(timer.to_dict())
+        return btap_data
+
+    # Updates a cached btap_data dict so that it belongs to this analysis and datapoint.
+    def cached_datapoint_result(self, btap_data, run_options, local_datapoint_output_folder):
+        # The spans of the cached run do not apply to this datapoint.
+        btap_data = {key: value for key, value in btap_data.items() if not DatapointTimer.is_span(key)}
+        btap_data.update(run_options)
+        btap_data['run_options'] = yaml.dump(run_options)
+        # Cached local output files were copied into this datapoint's output folder. S3 outputs stay where they were.
+        if btap_data['datapoint_output_url'].startswith('file:///'):
+            btap_data['datapoint_output_url'] = 'file:///' + os.path.join(local_datapoint_output_folder)
+        btap_data['datapoint_cache_hit'] = True
+        return btap_data
 
     def save_results_to_database(self, results):
+        # Results of datapoints completed before the analysis was resumed are already in the database.
+        if results.get('datapoint_resumed', False):
+            return results
         if results['success'] == True:
             # If container completed with success don't save container output.
             results['container_output'] = None
             if results['eplus_fatals'] > 0:
                 # If we had fatal errors..the run was not successful after all.
                 results['success'] = False
-        # This method organizes the data structure of the dataframe to fit into a report table.
-        df = self.sort_results(results)
+        # This method organizes the data structure of the results to fit into a report table.
+        start = time.time()
+        dp_values = self.get_result_values(results)
+        dp_values[f"{DATAPOINT_SPAN_PREFIX}serialize{DATAPOINT_SPAN_SUFFIX}"] = round(time.time() - start, 3)
 
         # Save datapoint row information to disc in case of catastrophic failure or when C.K. likes to hit Ctrl-C
-
-        pathlib.Path(self.database_folder).mkdir(parents=True, exist_ok=True)
-        df.to_csv(os.path.join(self.database_folder, f"{results[':datapoint_id']}.csv"))
+        self.results_database.add(dp_values)
+        self.progress.record(results['success'] == True)
 
         # Save failures to a folder as well.
 
         if results['success'] == False:
-            df.to_csv(os.path.join(self.failures_folder, f"{results[':datapoint_id']}.csv"))
+            pathlib.Path(self.failures_folder).mkdir(parents=True, exist_ok=True)
+            pd.DataFrame([dp_values]).to_csv(os.path.join(self.failures_folder, f"{results[':datapoint_id']}.csv"))
         return results
 
     def sort_results(self, results):
+        # Convert dp_values to dataframe
+        df = pd.DataFrame([self.get_result_values(results)])
+        return df
+
+    def get_result_values(self, results):
         # Set up dict for top/high level data from btap_data.json output
         dp_values = {}
         # Set up arrays for tabular information contained in btap_date.json
@@ -1492,13 +3618,21 @@ class BTAPAnalysis():
             else:
                 # otherwise store the key.
                 dp_values[key] = results[key]
-        # Convert dp_values to dataframe and add to sql table named 'btap_data'
         logging.info(f'obtained dp_values= {dp_values}')
-        df = pd.DataFrame([dp_values])
-        return df
+        return dp_values
 
     def shutdown_analysis(self):
-        self.generate_output_file(baseline_results=self.baseline_results)
+        if self.datapoint_cache is not None:
+            message = f"Datapoint cache statistics: {self.datapoint_cache.stats()}"
+            logging.info(message)
+            print(message)
+        if self.runtime_estimator is not None:
+            self.runtime_estimator.close()
+        try:
+            self.generate_output_file(baseline_results=self.baseline_results)
+        finally:
+            if self.owns_batch:
+                self.batch.tear_down()
 
     # This method creates a encoder and decoder of the simulation options to integers.  The ML and AI routines use float,
     # conventionally for optimization problems. Since most of the analysis that we do are discrete options for designers
@@ -1511,8 +3645,8 @@ class BTAPAnalysis():
 
         # Create a dict of the constants.
         self.constants = {}
-        # Create a dict of encoders/decoders.
-        self.option_encoder = {}
+        # Create a dict of the options of the variables.
+        variables = {}
 
         # Keep track of total possible scenarios to tell user.
         self.number_of_possible_designs = 1
@@ -1521,15 +3655,15 @@ class BTAPAnalysis():
             # If the options for that building charecteristic are > 1 it is a variable to be take part in optimization.
             if isinstance(value, list) and len(value) > 1:
                 self.number_of_possible_designs *= len(value)
-                # Create the encoder for the building option / key.
-                self.option_encoder[key] = {}
-                self.option_encoder[key]['encoder'] = preprocessing.LabelEncoder().fit(value)
+                variables[key] = value
             elif isinstance(value, list) and len(value) == 1:
                 # add the constant to the constant hash.
                 self.constants[key] = value[0]
             else:
                 # Otherwise warn user that nothing was provided.
                 raise (f"building option {key} was set to empty. Pleace enter a value for it.")
+        # Create the encoder/decoder of the variables.
+        self.option_encoder = OptionEncoder(variables)
 
         # Return the variables.. but the return value is not really use since these are access via the object variable self anyways.
         return self.constants, self.option_encoder
@@ -1538,34 +3672,27 @@ class BTAPAnalysis():
     def number_of_variables(self):
         # Returns the number of variables Note this is not a class variable self like the others. That is because this method is used in the
         # problem definition and we need to avoid thread variable issues.
-        return len(self.option_encoder)
+        return self.option_encoder.number_of_variables()
 
     # Convience variable to get the upper limit integers of all the variable as an ordered list.
     def x_u(self):
-        # Set up return list.
-        x_u = []
-        # iterage throug each key in the encoder list.
-        for key in self.option_encoder:
-            # get the max value, which is the length minus 1 since the enumeration starts at 0.
-            x_u.append(len(self.option_encoder[key]['encoder'].classes_) - 1)
         # Returns the list of max values.. Note this is not a class variable self like the others. That is because this method is used in the
         # problem definition and we need to avoid thread variable issues.
-        return x_u
+        return self.option_encoder.upper_bounds().tolist()
 
     # This method takes an ordered list of ints and converts it to a run_options input file.
     def generate_run_option_file(self, x):
-        # Create dict that will be the basis of the run_options.yml file.
-        run_options = {}
         # Make sure options are the same length as the encoder.
-        if len(x) != len(self.option_encoder):
+        if len(x) != self.option_encoder.number_of_variables():
             raise ('input is larger than the encoder was set to.')
+        # get the actual values for the run_options
+        return self.generate_run_option_file_from_options(self.option_encoder.decode(x))
 
-        # interate though both the encoder key and x input list at the same time
-        for key_name, x_option in zip(self.option_encoder.keys(), x):
-            # encoder/decoder for the building option key.
-            encoder = self.option_encoder[key_name]['encoder']
-            # get the actual value for the run_options
-            run_options[key_name] = str(encoder.inverse_transform([x_option])[0])
+    # This method takes the decoded option strings of a design, in the order of the encoder variables, and converts them
+    # to a run_options input file.
+    def generate_run_option_file_from_options(self, options):
+        # Create dict that will be the basis of the run_options.yml file.
+        run_options = dict(zip(self.option_encoder.keys, options))
         # Tell user the options through std out.
         run_options[':scenario'] = 'optimize'
         run_options[':algorithm_type'] = self.analysis_config[':algorithm'][':type']
@@ -1583,15 +3710,21 @@ class BTAPAnalysis():
 
     def generate_output_file(self, baseline_results=None):
 
-        # Process csv file to create single dataframe with all simulation results
-        PostProcessResults(baseline_results=baseline_results,
-                           database_folder=self.database_folder,
-                           results_folder=self.results_folder).run()
+        # Export the database in the previous layout of one csv file per datapoint if requested.
+        if self.analysis_config.get(':export_database_csv', False):
+            self.results_database.export_csv(self.database_folder)
+
+        # Process csv file to create single dataframe with all simulation results. The dataframe is kept so it can be
+        # used as the baseline of other analyses without reading it back from the excel file.
+        self.results_df = PostProcessResults(baseline_results=baseline_results,
+                                             database_folder=self.database_folder,
+                                             results_folder=self.results_folder,
+                                             output_variables=self.analysis_config[':output_variables']).run()
         excel_path = os.path.join(self.results_folder, 'output.xlsx')
 
         # If this is an aws_batch run, copy the excel file to s3 for storage.
         if self.analysis_config[':compute_environment'] == 'aws_batch':
-            self.credentials = AWSCredentials()
+            self.credentials = AWSCredentials.shared()
             target_path = os.path.join(self.credentials.user_name, self.analysis_config[':analysis_name'],
                                        self.analysis_config[':analysis_id'], 'results', 'output.xlsx')
             # s3 likes forward slashes.
@@ -1620,6 +3753,7 @@ class BTAPParametric(BTAPAnalysis):
                          batch=batch,
                          baseline_results=baseline_results)
         self.scenarios = []
+        self.number_of_scenarios = None
 
     def run(self):
         # Compute all the scenarios for paramteric run.
@@ -1639,11 +3773,12 @@ class BTAPParametric(BTAPAnalysis):
             self.shutdown_analysis()
 
     # This method will compute all the possible scenarios from the input file for a parametric run.
-    # This will return a list of scenario lists.
+    # This will return a generator of the scenarios. They are only created when they are submitted, so very large grids
+    # do not have to fit in memory.
     def compute_scenarios(self):
 
         # Set up storage lists
-        l_of_l_of_values = []
+        l_of_values = []
         keys = []
 
         # Iterate through each option set in yml file.
@@ -1651,77 +3786,125 @@ class BTAPParametric(BTAPAnalysis):
 
             # Check to see if the value is a list. In other words are there more than one option for that charecteristic.
             if (isinstance(value, list)):
-
-                # Create new array to list
-                new_list = []
-                for item in value:
-                    # Create an indidual item for the option as a keyword/value array.
-                    new_list.append([str(key), item])
-
                 # Append list to the lists of options
-                l_of_l_of_values.append(new_list)
+                l_of_values.append(value)
 
                 # append key to keys
-                keys.append(key)
+                keys.append(str(key))
 
-        # to compute all possible permutations done by a python package called itertools.
-        scenarios = list(itertools.product(*l_of_l_of_values))
-        # go through each option scenario
-        for items in scenarios:
-            # Create an options hash to store the options
-            run_options = {}
+        # The number of permutations is known from the length of each option list.
+        self.number_of_scenarios = math.prod(len(values) for values in l_of_values)
+        self.scenarios = self.generate_scenarios(keys, l_of_values)
+        message = f'Number of Scenarios {self.number_of_scenarios}'
+        logging.info(message)
+        return self.scenarios
 
-            # Go through each item
-            for item in items:
-                # Save that charecteristic to the options hash
-                run_options[item[0]] = item[1]
-            run_options[':algorithm_type'] = self.analysis_config[':algorithm'][':type']
-            self.scenarios.append(run_options)
-            message = f'Number of Scenarios {len(self.scenarios)}'
-            logging.info(message)
+    # Generator of all possible permutations done by a python package called itertools.
+    def generate_scenarios(self, keys, l_of_values):
+        algorithm_type = self.analysis_config[':algorithm'][':type']
+        for values in itertools.product(*l_of_values):
+            # Create an options hash to store the options
+            run_options = dict(zip(keys, values))
+            run_options[':algorithm_type'] = algorithm_type
+            yield run_options
 
-        return self.scenarios
+    # Number of scenarios to run. Scenarios that are created as a list are counted, generated scenarios are counted
+    # when they are computed.
+    def get_number_of_scenarios(self):
+        if self.number_of_scenarios is None:
+            return len(self.scenarios)
+        return self.number_of_scenarios
 
     def run_all_scenarios(self):
         # Failed runs counter.
         failed_datapoints = 0
 
         # Total number of runs.
-        self.file_number = len(self.scenarios)
+        self.file_number = self.get_number_of_scenarios()
 
         # Keep track of simulation time.
         threaded_start = time.time()
-        # Using all your processors minus 1.
-        print(f'Using {self.batch.get_threads()} threads.')
+        # The worker slots of the backend are shared with the other analyses running on it, so this analysis only
+        # starts threads for its share of the slots.
+        worker_slots = self.batch.get_worker_slots()
+        group = self.analysis_config[':analysis_name']
+        worker_slots.join(group)
+        threads = worker_slots.share()
+        print(f'Using {threads} threads.')
+        # Submit the longest predicted datapoints first so that a long datapoint does not run alone at the end.
+        scenarios = ((run_options, None) for run_options in self.scenarios)
+        if self.runtime_estimator is not None and self.runtime_estimator.fit():
+            scenarios = self.runtime_estimator.longest_first(self.scenarios)
+        # Predicted simulation times in submission order and the simulation times of the datapoints that were run.
+        predicted_times = []
+        simulation_times = []
+        self.progress.start()
         time.sleep(0.01)
-        with tqdm.tqdm(desc=f"Failed:{self.get_num_of_runs_failed()}: Progress Bar", total=len(self.scenarios),
-                       colour='green') as pbar:
-            with concurrent.futures.ThreadPoolExecutor(self.batch.get_threads()) as executor:
-                futures = []
-                # go through each option scenario
-                for run_options in self.scenarios:
-                    # Create an options hash to store the options
-
-                    # Executes docker simulation in a thread
-                    futures.append(executor.submit(self.run_datapoint, run_options=run_options))
-                # Bring simulation thread back to main thread
-                for future in concurrent.futures.as_completed(futures):
-                    # Save results to database.
-                    self.save_results_to_database(future.result())
-
-                    # Track failures.
-                    if not future.result()['success']:
-                        failed_datapoints += 1
-
-                    # Update user.
-                    message = f'TotalRuns:{self.file_number}\tCompleted:{self.get_num_of_runs_completed()}\tFailed:{self.get_num_of_runs_failed()}\tElapsed Time: {str(datetime.timedelta(seconds=round(time.time() - threaded_start)))}'
-                    logging.info(message)
-                    pbar.update(1)
+        try:
+            with tqdm.tqdm(desc=f"Failed:{self.get_num_of_runs_failed()}: Progress Bar", total=self.file_number,
+                           colour='green') as pbar:
+                with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                    futures = {}
+                    while True:
+                        # Only keep a window of datapoints submitted to the executor. New scenarios are taken from the
+                        # scenario generator as datapoints complete. The window follows the share of the slots, which
+                        # shrinks as other analyses start on the backend.
+                        max_submitted = worker_slots.share() * SCENARIO_SUBMISSION_WINDOW_FACTOR
+                        for run_options, predicted_time in itertools.islice(scenarios,
+                                                                            max(0, max_submitted - len(futures))):
+                            # Executes docker simulation in a thread
+                            futures[executor.submit(self.run_datapoint, run_options=run_options)] = predicted_time
+                        if len(futures) == 0:
+                            break
+                        # Bring simulation thread back to main thread
+                        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            predicted_time = futures.pop(future)
+                            if predicted_time is not None:
+                                future.result()['predicted_simulation_time'] = predicted_time
+                                predicted_times.append(predicted_time)
+                                compute_column = f"{DATAPOINT_SPAN_PREFIX}compute{DATAPOINT_SPAN_SUFFIX}"
+                                if future.result().get(compute_column) is not None and \
+                                        not future.result().get('datapoint_cache_hit', False) and \
+                                        not future.result().get('datapoint_resumed', False):
+                                    simulation_times.append(future.result()[compute_column])
+                            # Save results to database.
+                            self.save_results_to_database(future.result())
+
+                            # Track failures.
+                            if not future.result()['success']:
+                                failed_datapoints += 1
+
+                            # Update user.
+                            message = self.progress.message(total=self.file_number)
+                            logging.info(message)
+                            self.progress.update_progress_bar(pbar, total=self.file_number)
+        finally:
+            worker_slots.leave(group)
 
         # At end of runs update for users.
         message = f'{self.file_number} Simulations completed. No. of failures = {self.get_num_of_runs_failed()} Total Time: {str(datetime.timedelta(seconds=round(time.time() - threaded_start)))}'
         logging.info(message)
         print(message)
+        if len(predicted_times) > 0:
+            self.save_runtime_summary(predicted_times, simulation_times, threads, time.time() - threaded_start)
+
+    # Saves the predicted and actual makespan of the datapoints to the results folder. The predicted makespan assumes the
+    # datapoints start on the first free thread in the order they were submitted.
+    def save_runtime_summary(self, predicted_times, simulation_times, threads, actual_makespan):
+        summary = {'datapoints': len(predicted_times),
+                   'threads': threads,
+                   'predicted_makespan_s': RuntimeEstimator.makespan(predicted_times, threads),
+                   'actual_makespan_s': actual_makespan,
+                   'predicted_total_s': sum(predicted_times),
+                   'simulated_total_s': sum(simulation_times)}
+        os.makedirs(self.results_folder, exist_ok=True)
+        pd.DataFrame([summary]).to_csv(os.path.join(self.results_folder, RUNTIME_SUMMARY_FILENAME), index=False)
+        message = f"Predicted makespan {summary['predicted_makespan_s']:.1f}s, actual makespan " \
+                  f"{summary['actual_makespan_s']:.1f}s. Predicted simulation time {summary['predicted_total_s']:.1f}s, " \
+                  f"simulated {summary['simulated_total_s']:.1f}s."
+        logging.info(message)
+        print(message)
 
 
 # Optimization problem definition class using Pymoo
@@ -1765,28 +3948,10 @@ class BTAPProblem(ElementwiseProblem):
             *args,
             **kwargs):
 
-        # Converts discrete integers contains in x argument back into values that btap understands. So for example. if x was a list
-        # of zeros, it would convert this to the dict of the first item in each list of the variables in the building_options
-        # section of the input yml file.
-        run_options = self.btap_optimization.generate_run_option_file(x.tolist())
-
-        # Run simulation
-        results = self.btap_optimization.run_datapoint(run_options)
+        # Run the simulation of the options in x and get the objective function results.
+        objectives = self.btap_optimization.evaluate(x.tolist())
 
-        # Saves results to database if successful or not.
-        self.btap_optimization.save_results_to_database(results)
-        analysis_id = self.btap_optimization.analysis_config[':analysis_id']
-        message = f'{self.btap_optimization.get_num_of_runs_completed()} simulations completed of {self.btap_optimization.max_number_of_simulations}. No. of failures = {self.btap_optimization.get_num_of_runs_failed()}'
-        logging.info(message)
-        self.btap_optimization.pbar.update(1)
         # Pass back objective function results.
-        objectives = []
-        for objective in self.btap_optimization.analysis_config[':algorithm'][':minimize_objectives']:
-            if not (objective in results):
-                raise FailedSimulationException(
-                    f"Objective value {objective} not found in results of simulation. Most likely due to failure of simulation runs. Stopping optimization")
-            objectives.append(results[objective])
-
         out["F"] = np.column_stack(objectives)
 
 
@@ -1811,6 +3976,10 @@ class BTAPOptimization(BTAPAnalysis):
     def run(self):
 
         message = "success"
+        # The worker slots of the backend are shared with the other analyses running on it, so the optimization only
+        # starts threads for its share of the slots.
+        worker_slots = self.batch.get_worker_slots()
+        worker_slots.join(self.analysis_config[':analysis_name'])
         try:
             # Create options encoder. This method creates an object to translate variable options
             # from a list of object to a list of integers. Pymoo and most optimizers operate on floats and strings.
@@ -1830,6 +3999,7 @@ class BTAPOptimization(BTAPAnalysis):
             message = f"Unknown Error.{err} {traceback.format_exc()}"
             logging.error(message)
         finally:
+            worker_slots.leave(self.analysis_config[':analysis_name'])
             self.shutdown_analysis()
             return message
 
@@ -1856,7 +4026,8 @@ class BTAPOptimization(BTAPAnalysis):
             prob = self.analysis_config[':algorithm'][':prob']
             eta = self.analysis_config[':algorithm'][':eta']
 
-            message = f'Using {self.batch.get_threads()} threads.'
+            threads = self.batch.get_worker_slots().share()
+            message = f'Using {threads} threads.'
             logging.info(message)
             print(message)
             # Sometime the progress bar appears before the print statement above. This paused the execution slightly.
@@ -1866,8 +4037,9 @@ class BTAPOptimization(BTAPAnalysis):
             with tqdm.tqdm(desc=f"Optimization Progress", total=self.max_number_of_simulations, colour='green') as pbar:
                 # Need to make pbar available to the __evaluate method.
                 self.pbar = pbar
+                self.progress.start()
                 # Create thread pool object.
-                with ThreadPool(self.batch.get_threads()) as pool:
+                with ThreadPool(threads) as pool:
                     # Create pymoo problem. Pass self for helper methods and set up a starmap multithread pool.
                     problem = BTAPProblem(btap_optimization=self, runner=pool.starmap,
                                           func_eval=starmap_parallelized_eval)
@@ -1889,6 +4061,30 @@ class BTAPOptimization(BTAPAnalysis):
                     # Let the user know the runtime.
                     print('Execution Time:', self.res.exec_time)
 
+    # Runs the simulation of x, an ordered list of option integers, saves its results and returns the values of the
+    # :minimize_objectives.
+    def evaluate(self, x):
+        # Converts discrete integers contains in x argument back into values that btap understands. So for example. if x was a list
+        # of zeros, it would convert this to the dict of the first item in each list of the variables in the building_options
+        # section of the input yml file.
+        run_options = self.generate_run_option_file(x)
+
+        # Run simulation
+        results = self.run_datapoint(run_options)
+
+        # Saves results to database if successful or not.
+        self.save_results_to_database(results)
+        message = self.progress.message(total=self.max_number_of_simulations)
+        logging.info(message)
+        self.progress.update_progress_bar(self.pbar, total=self.max_number_of_simulations)
+        objectives = []
+        for objective in self.analysis_config[':algorithm'][':minimize_objectives']:
+            if not (objective in results):
+                raise FailedSimulationException(
+                    f"Objective value {objective} not found in results of simulation. Most likely due to failure of simulation runs. Stopping optimization")
+            objectives.append(results[objective])
+        return objectives
+
     # convieniance interface to get number of minimized objectives.
     def number_of_minimize_objectives(self):
         # Returns the number of variables Note this is not a class variable self like the others. That is because this method is used in the
@@ -1896,6 +4092,257 @@ class BTAPOptimization(BTAPAnalysis):
         return len(self.analysis_config[':algorithm'][':minimize_objectives'])
 
 
+# Class to manage asynchronous (steady state) optimization analysis. Instead of waiting for a whole generation to finish,
+# a new candidate is proposed as soon as any simulation finishes, so every thread is kept busy and a slow simulation
+# does not hold up the others. Candidates are bred from a rolling archive of the best :population designs, which are
+# ranked with the non-dominated sorting and crowding distance of NSGA-II.
+class BTAPAsyncOptimization(BTAPOptimization):
+    def run_analysis(self):
+        print(f"Running Algorithm {self.analysis_config[':algorithm']}")
+        print(f"Number of Variables: {self.number_of_variables()}")
+        print(f"Number of minima objectives: {self.number_of_minimize_objectives()}")
+        print(f"Number of possible designs: {self.number_of_possible_designs}")
+        self.pop_size = int(self.analysis_config[':algorithm'][':population'])
+        n_gen = int(self.analysis_config[':algorithm'][':n_generations'])
+        # Probability that a candidate is a crossover of its two parents rather than a copy of the first one.
+        self.prob = float(self.analysis_config[':algorithm'][':prob'])
+        self.max_number_of_simulations = min(self.number_of_possible_designs, self.pop_size * n_gen)
+        self.random = np.random.default_rng(1)
+        self.upper_bounds = np.array(self.x_u(), dtype=int)
+
+        # Archive of the best evaluated designs with their objectives, NSGA-II rank and crowding distance.
+        self.archive_x = np.zeros((0, self.number_of_variables()), dtype=int)
+        self.archive_f = np.zeros((0, self.number_of_minimize_objectives()))
+        self.archive_rank = np.zeros(0, dtype=int)
+        self.archive_crowding = np.zeros(0)
+        # Designs that have been submitted, so none is simulated twice.
+        self.submitted = set()
+
+        worker_slots = self.batch.get_worker_slots()
+        threads = min(worker_slots.share(), self.max_number_of_simulations)
+        message = f'Using {threads} threads.'
+        logging.info(message)
+        print(message)
+        print("Starting Simulations.")
+        # Sometime the progress bar appears before the print statement above. This paused the execution slightly.
+        time.sleep(0.01)
+        start = time.time()
+
+        # Set up progress bar tracker.
+        with tqdm.tqdm(desc=f"Optimization Progress", total=self.max_number_of_simulations, colour='green') as pbar:
+            # Need to make pbar available to the evaluate method.
+            self.pbar = pbar
+            self.progress.start()
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                futures = {}
+                # Fill every thread, then propose new candidates as simulations finish. Fewer candidates are kept
+                # running when the share of the slots shrinks because other analyses started on the backend.
+                for _ in range(threads):
+                    self.submit_candidate(executor, futures)
+                while len(futures) > 0:
+                    done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        x = futures.pop(future)
+                        # Raises FailedSimulationException if the simulation failed, like the generational optimization.
+                        self.update_archive(x, future.result())
+                    while len(futures) < min(threads, worker_slots.share()) and \
+                            self.submit_candidate(executor, futures):
+                        pass
+        print('Execution Time:', time.time() - start)
+        message = f"Archive has {int(np.sum(self.archive_rank == 0))} non-dominated designs."
+        logging.info(message)
+        print(message)
+
+    # Submits a new candidate if the simulation budget is not used up. Returns False if nothing was submitted.
+    def submit_candidate(self, executor, futures):
+        if len(self.submitted) >= self.max_number_of_simulations:
+            return False
+        x = self.propose_candidate()
+        if x is None:
+            return False
+        self.submitted.add(tuple(x))
+        futures[executor.submit(self.evaluate, x)] = x
+        return True
+
+    # Returns the next design to simulate as a list of option integers, or None if no new design could be found.
+    # Random designs are used until :population designs have been submitted. After that, two parents are picked from
+    # the archive by binary tournament and combined with uniform crossover and random reset mutation. Subclasses can
+    # override this to change how candidates are proposed.
+    def propose_candidate(self):
+        for attempt in range(ASYNC_OPTIMIZATION_MAX_PROPOSAL_ATTEMPTS):
+            if len(self.submitted) < self.pop_size or len(self.archive_x) < 2:
+                x = self.random_candidate()
+            else:
+                x = self.offspring_candidate()
+            if tuple(x) not in self.submitted:
+                return x
+        return None
+
+    def random_candidate(self):
+        return [int(value) for value in self.random.integers(0, self.upper_bounds + 1)]
+
+    def offspring_candidate(self):
+        first = self.archive_x[self.tournament()]
+        second = self.archive_x[self.tournament()]
+        child = first.copy()
+        if self.random.random() < self.prob:
+            from_second = self.random.random(len(child)) < 0.5
+            child[from_second] = second[from_second]
+        # Each variable is reset to a random option with a probability of one over the number of variables.
+        mutate = self.random.random(len(child)) < 1.0 / len(child)
+        child[mutate] = self.random.integers(0, self.upper_bounds[mutate] + 1)
+        return [int(value) for value in child]
+
+    # Binary tournament. The lower rank wins, then the larger crowding distance.
+    def tournament(self):
+        first, second = self.random.integers(0, len(self.archive_x), 2)
+        if self.archive_rank[first] != self.archive_rank[second]:
+            return first if self.archive_rank[first] < self.archive_rank[second] else second
+        return first if self.archive_crowding[first] >= self.archive_crowding[second] else second
+
+    # Adds an evaluated design to the archive and keeps the best :population designs by rank and crowding distance.
+    def update_archive(self, x, objectives):
+        archive_x = np.vstack([self.archive_x, np.array(x, dtype=int)])
+        archive_f = np.vstack([self.archive_f, np.array(objectives, dtype=float)])
+        fronts = NonDominatedSorting().do(archive_f)
+        survivors = []
+        for front in fronts:
+            crowding = calc_crowding_distance(archive_f[front])
+            if len(survivors) + len(front) > self.pop_size:
+                # Keep the most spread out designs of the last front that fits.
+                front = front[np.argsort(-crowding)][:self.pop_size - len(survivors)]
+            survivors.extend(front)
+            if len(survivors) >= self.pop_size:
+                break
+        survivors = np.array(survivors, dtype=int)
+        self.archive_x = archive_x[survivors]
+        self.archive_f = archive_f[survivors]
+        # Rank and crowding distance of the survivors for the tournaments.
+        self.archive_rank = np.zeros(len(survivors), dtype=int)
+        self.archive_crowding = np.zeros(len(survivors))
+        for rank, front in enumerate(NonDominatedSorting().do(self.archive_f)):
+            self.archive_rank[front] = rank
+            self.archive_crowding[front] = calc_crowding_distance(self.archive_f[front])
+
+
+# Class to manage surrogate assisted optimization analysis. It runs like the asynchronous optimization, but a Gaussian
+# process model of each objective is trained on the simulated designs. Each time a design is needed, a number of
+# offspring are bred and the model picks the one to simulate by the non-dominated rank of its lower confidence bound,
+# which favours designs that are either predicted to be good or that the model is unsure about. The model is retrained
+# as results come in and its prediction error on the simulated designs is reported.
+class BTAPSurrogateOptimization(BTAPAsyncOptimization):
+    def run_analysis(self):
+        # Number of offspring screened by the model for each simulation.
+        self.surrogate_candidates = int(self.analysis_config[':algorithm'].get(':surrogate_candidates') or
+                                        SURROGATE_CANDIDATES)
+        self.models = None
+        self.trained_on = 0
+        # Simulated designs and their objectives.
+        self.history_x = []
+        self.history_f = []
+        # Model predictions of the submitted designs and the errors of the ones that have been simulated.
+        self.predictions = {}
+        self.prediction_records = []
+        super().run_analysis()
+        self.save_prediction_records()
+
+    def propose_candidate(self):
+        if self.models is None:
+            return super().propose_candidate()
+        candidates = []
+        for attempt in range(ASYNC_OPTIMIZATION_MAX_PROPOSAL_ATTEMPTS):
+            x = self.offspring_candidate()
+            if tuple(x) not in self.submitted and x not in candidates:
+                candidates.append(x)
+            if len(candidates) >= self.surrogate_candidates:
+                break
+        if len(candidates) == 0:
+            return super().propose_candidate()
+        mean, std = self.predict(np.array(candidates, dtype=int))
+        lower_bound = mean - SURROGATE_CONFIDENCE * std
+        # Rank the candidates together with the archive and pick the best ranked, most spread out candidate.
+        f = np.vstack([self.archive_f, lower_bound])
+        rank = np.zeros(len(f), dtype=int)
+        crowding = np.zeros(len(f))
+        for front_rank, front in enumerate(NonDominatedSorting().do(f)):
+            rank[front] = front_rank
+            crowding[front] = calc_crowding_distance(f[front])
+        candidate_rank = rank[len(self.archive_f):]
+        candidate_crowding = crowding[len(self.archive_f):]
+        best = np.lexsort((-candidate_crowding, candidate_rank))[0]
+        self.predictions[tuple(candidates[best])] = mean[best]
+        return candidates[best]
+
+    def update_archive(self, x, objectives):
+        super().update_archive(x, objectives)
+        self.history_x.append(list(x))
+        self.history_f.append([float(objective) for objective in objectives])
+        prediction = self.predictions.pop(tuple(x), None)
+        if prediction is not None:
+            self.prediction_records.append({'x': list(x),
+                                            'predicted': [float(value) for value in prediction],
+                                            'simulated': self.history_f[-1]})
+        # Retrain once there is a population of results and then every SURROGATE_RETRAIN_INTERVAL results.
+        if len(self.history_x) >= self.pop_size and len(self.history_x) - self.trained_on >= SURROGATE_RETRAIN_INTERVAL:
+            self.train()
+
+    # Fits a Gaussian process to each objective on the most recent SURROGATE_MAX_TRAINING_POINTS simulated designs.
+    def train(self):
+        x = self.features(np.array(self.history_x[-SURROGATE_MAX_TRAINING_POINTS:], dtype=int))
+        f = np.array(self.history_f[-SURROGATE_MAX_TRAINING_POINTS:], dtype=float)
+        models = []
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            for objective in range(f.shape[1]):
+                kernel = ConstantKernel() * RBF() + WhiteKernel()
+                models.append(GaussianProcessRegressor(kernel=kernel, normalize_y=True, random_state=1).fit(x, f[:, objective]))
+        self.models = models
+        self.trained_on = len(self.history_x)
+        message = f"Surrogate model trained on {len(x)} designs. Mean absolute prediction error: {self.prediction_error()}"
+        logging.info(message)
+
+    # Returns the predicted mean and standard deviation of each objective for an array of designs.
+    def predict(self, x):
+        features = self.features(x)
+        mean = np.zeros((len(x), len(self.models)))
+        std = np.zeros((len(x), len(self.models)))
+        for objective, model in enumerate(self.models):
+            mean[:, objective], std[:, objective] = model.predict(features, return_std=True)
+        return mean, std
+
+    # One hot encoding of the option integers, since the options of a variable are categories and not ordered values.
+    def features(self, x):
+        offsets = np.concatenate([[0], np.cumsum(self.upper_bounds + 1)[:-1]])
+        features = np.zeros((len(x), int(np.sum(self.upper_bounds + 1))))
+        features[np.arange(len(x))[:, None], offsets + x] = 1.0
+        return features
+
+    # Mean absolute error of the model predictions of each objective on the designs that were simulated afterwards.
+    def prediction_error(self):
+        if len(self.prediction_records) == 0:
+            return None
+        predicted = np.array([record['predicted'] for record in self.prediction_records])
+        simulated = np.array([record['simulated'] for record in self.prediction_records])
+        errors = np.abs(predicted - simulated).mean(axis=0)
+        return dict(zip(self.analysis_config[':algorithm'][':minimize_objectives'], errors.tolist()))
+
+    # Saves the predicted and simulated objectives of the designs chosen by the model to the results folder.
+    def save_prediction_records(self):
+        message = f"Surrogate model mean absolute prediction error: {self.prediction_error()}"
+        logging.info(message)
+        print(message)
+        if len(self.prediction_records) == 0:
+            return
+        objectives = self.analysis_config[':algorithm'][':minimize_objectives']
+        rows = []
+        for record in self.prediction_records:
+            row = dict(zip(self.option_encoder.keys, self.option_encoder.decode(record['x'])))
+            row.update({f"predicted_{objective}": value for objective, value in zip(objectives, record['predicted'])})
+            row.update({f"simulated_{objective}": value for objective, value in zip(objectives, record['simulated'])})
+            rows.append(row)
+        pd.DataFrame(rows).to_csv(os.path.join(self.results_folder, SURROGATE_PREDICTIONS_FILENAME), index=False)
+
+
 # Class to manage lhs runs. Uses Scipy.. Please see link for options explanation
 # https://scikit-optimize.github.io/stable/auto_examples/sampler/initial-sampling-method.html
 class BTAPSamplingLHS(BTAPParametric):
@@ -1917,12 +4364,13 @@ class BTAPSamplingLHS(BTAPParametric):
         lhs = Lhs(lhs_type=self.analysis_config[':algorithm'][':lhs_type'], criterion=None)
         # Get samples
         samples = lhs.generate(space.dimensions, n_samples=self.analysis_config[':algorithm'][':n_samples'])
+        # Converts discrete integers of all the samples back into values that btap understands. So for example. if x was
+        # a list of zeros, it would convert this to the dict of the first item in each list of the variables in the
+        # building_options section of the input yml file.
+        samples_options = self.option_encoder.decode(samples)
         # create run_option for each scenario.
-        for x in samples:
-            # Converts discrete integers contains in x argument back into values that btap understands. So for example. if x was a list
-            # of zeros, it would convert this to the dict of the first item in each list of the variables in the building_options
-            # section of the input yml file.
-            run_options = self.generate_run_option_file(x)
+        for options in samples_options:
+            run_options = self.generate_run_option_file_from_options(options)
             run_options[':scenario'] = 'lhs'
             self.scenarios.append(run_options)
         return self.scenarios
@@ -1943,68 +4391,100 @@ class BTAPIntegratedDesignProcess:
         self.git_api_token = git_api_token
         self.batch = batch
         self.baseline_results = baseline_results
+        # The IDP tears down a batch it owns once all its stages are done.
+        self.owns_batch = False
 
-    # While not a child of BTAPAnalysis, have the same run method for consistency.
+    # While not a child of BTAPAnalysis, have the same run method for consistency. The stages do not depend on each
+    # other, so they run at the same time on the worker slots of the batch. The small elimination stage has the highest
+    # priority and the optimization uses the capacity the other stages leave idle.
     def run(self):
-        # excel file container.
-        output_excel_files = []
-
-        # Elimination block
-        analysis_suffix = '_elim'
-        algorithm_type = 'elimination'
-        temp_analysis_config = copy.deepcopy(self.analysis_config)
-        temp_building_options = copy.deepcopy(self.building_options)
-        temp_analysis_config[':algorithm'][':type'] = algorithm_type
-        temp_analysis_config[':analysis_name'] = temp_analysis_config[':analysis_name'] + analysis_suffix
-        bb = BTAPElimination(analysis_config=temp_analysis_config,
-                             building_options=temp_building_options,
-                             project_root=self.project_root,
-                             git_api_token=self.git_api_token,
-                             batch=self.batch,
-                             baseline_results=self.baseline_results)
-        print(f"running {algorithm_type} stage")
-        bb.run()
-        output_excel_files.append(os.path.join(bb.results_folder, 'output.xlsx'))
+        scheduler = StageScheduler()
+        scheduler.add_stage('elimination', partial(self.create_stage, BTAPElimination, 'elimination', '_elim'),
+                            priority=0)
+        scheduler.add_stage('sensitivity', partial(self.create_stage, BTAPSensitivity, 'sensitivity', '_sens'),
+                            priority=1)
+        scheduler.add_stage('nsga2', partial(self.create_stage, BTAPOptimization, 'nsga2', '_opt'),
+                            priority=2)
+        try:
+            stages = scheduler.run()
+        finally:
+            if self.owns_batch:
+                self.batch.tear_down()
 
-        # Sensitivity block
-        analysis_suffix = '_sens'
-        algorithm_type = 'sensitivity'
-        temp_analysis_config = copy.deepcopy(self.analysis_config)
-        temp_building_options = copy.deepcopy(self.building_options)
-        temp_analysis_config[':algorithm'][':type'] = algorithm_type
-        temp_analysis_config[':analysis_name'] = temp_analysis_config[':analysis_name'] + analysis_suffix
-        bb = BTAPSensitivity(analysis_config=temp_analysis_config,
-                             building_options=temp_building_options,
-                             project_root=self.project_root,
-                             git_api_token=self.git_api_token,
-                             batch=self.batch,
-                             baseline_results=self.baseline_results)
-        print(f"running {algorithm_type} stage")
-        bb.run()
-        output_excel_files.append(os.path.join(bb.results_folder, 'output.xlsx'))
+        # Output results from all analysis into top level output excel.
+        df = pd.concat([analysis.results_df for analysis in stages.values() if analysis.results_df is not None],
+                       ignore_index=True)
+        df.to_excel(excel_writer=os.path.join(self.project_root, 'output.xlsx'), sheet_name='btap_data')
 
-        # Sensitivity block
-        analysis_suffix = '_opt'
-        algorithm_type = 'nsga2'
+    def create_stage(self, analysis_class, algorithm_type, analysis_suffix):
         temp_analysis_config = copy.deepcopy(self.analysis_config)
         temp_building_options = copy.deepcopy(self.building_options)
         temp_analysis_config[':algorithm'][':type'] = algorithm_type
         temp_analysis_config[':analysis_name'] = temp_analysis_config[':analysis_name'] + analysis_suffix
-        bb = BTAPOptimization(analysis_config=temp_analysis_config,
+        return analysis_class(analysis_config=temp_analysis_config,
                               building_options=temp_building_options,
                               project_root=self.project_root,
                               git_api_token=self.git_api_token,
                               batch=self.batch,
                               baseline_results=self.baseline_results)
-        print(f"running {algorithm_type} stage")
-        bb.run()
-        output_excel_files.append(os.path.join(bb.results_folder, 'output.xlsx'))
 
-        # Output results from all analysis into top level output excel.
-        df = pd.DataFrame()
-        for file in output_excel_files:
-            df = df.append(pd.read_excel(file), ignore_index=True)
-        df.to_excel(excel_writer=os.path.join(bb.project_root, 'output.xlsx'), sheet_name='btap_data')
+
+# Runs the stages of a workflow as a graph. A stage is an analysis that starts in its own thread as soon as the stages
+# it depends on are done, so independent stages run at the same time. Their datapoints share the worker slots of the
+# batch and the priority of a stage decides which one gets a free slot first.
+class StageScheduler:
+    def __init__(self):
+        self.stages = {}
+
+    # create_analysis is called in the stage thread and returns the analysis to run. Lower priorities run first.
+    def add_stage(self, name, create_analysis, priority=0, depends_on=None):
+        for dependency in depends_on or []:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on {dependency}, which must be added before it.")
+        self.stages[name] = {'create_analysis': create_analysis,
+                             'priority': priority,
+                             'depends_on': list(depends_on or [])}
+
+    def run_stage(self, name):
+        stage = self.stages[name]
+        analysis = stage['create_analysis']()
+        analysis.priority = stage['priority']
+        print(f"running {name} stage")
+        analysis.run()
+        return analysis
+
+    # Runs all the stages and returns a dict of the analysis of each stage in the order they were added. Stages that
+    # depend on a failed stage are not run. The error of the first failed stage is raised once the others are done.
+    def run(self):
+        analyses = {}
+        errors = []
+        pending = list(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.stages)), thread_name_prefix='stage') as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for name in [name for name in pending
+                             if all(dependency in analyses for dependency in self.stages[name]['depends_on'])]:
+                    pending.remove(name)
+                    running[executor.submit(self.run_stage, name)] = name
+                if len(running) == 0:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        message = f"Stage {name} failed: {future.exception()}"
+                        logging.error(message)
+                        print(message)
+                        errors.append(future.exception())
+                    else:
+                        analyses[name] = future.result()
+        if len(pending) > 0:
+            message = f"Stages {pending} were not run because a stage they depend on failed."
+            logging.error(message)
+            print(message)
+        if len(errors) > 0:
+            raise errors[0]
+        return {name: analyses[name] for name in self.stages if name in analyses}
 
 
 # Class to manage Elimination analysis
@@ -2101,6 +4581,11 @@ class BTAPPreflight(BTAPParametric):
 
 # Class to run reference simulations.. Based on building_type, epw_file, primary_heating_fuel_type
 class BTAPReference(BTAPParametric):
+    # With :reference_library, reference datapoints already simulated by other analyses are taken from the datapoint
+    # cache, even if the cache is not used by the other stages of the analysis.
+    def use_datapoint_cache(self):
+        return super().use_datapoint_cache() or self.analysis_config.get(':reference_library', False) == True
+
     def compute_scenarios(self):
         # Create default options scenario. Uses first value of all arrays.
         # precheck osm files for errors.
@@ -2132,12 +4617,20 @@ class PostProcessResults():
     def __init__(self,
                  baseline_results=BASELINE_RESULTS,
                  database_folder=None,
-                 results_folder=None
+                 results_folder=None,
+                 output_variables=None
                  ):
 
-        filepaths = [os.path.join(database_folder, f) for f in os.listdir(database_folder) if f.endswith('.csv')]
-        btap_data_df = pd.concat(map(pd.read_csv, filepaths))
-        btap_data_df.reset_index()
+        database_path = os.path.join(database_folder, RESULTS_DATABASE_FILENAME)
+        if os.path.isfile(database_path):
+            # Read all datapoints from the results database in one scan.
+            with ResultsDatabase(database_path) as database:
+                btap_data_df = database.read_dataframe()
+        else:
+            # Analyses run before the results database saved one csv file per datapoint.
+            filepaths = [os.path.join(database_folder, f) for f in os.listdir(database_folder) if f.endswith('.csv')]
+            btap_data_df = pd.concat(map(pd.read_csv, filepaths))
+            btap_data_df.reset_index()
 
         if isinstance(btap_data_df, pd.DataFrame):
             self.btap_data_df = btap_data_df
@@ -2145,18 +4638,21 @@ class PostProcessResults():
             self.btap_data_df = pd.read_excel(open(btap_data_df, 'rb'), sheet_name='btap_data')
         self.baseline_results = baseline_results
         self.results_folder = results_folder
+        # :output_variables of the analysis. Read from the input.yml file of the analysis if not given.
+        self.output_variables = output_variables
 
     def run(self):
         self.reference_comparisons()
+        self.save_timing_summary()
         self.get_files(file_paths=['run_dir/run/in.osm', 'run_dir/run/eplustbl.htm', 'hourly.csv'])
+        self.save_hourly_results_store()
         self.save_excel_output()
         self.operation_on_hourly_output()
         return self.btap_data_df
 
     # This method gets files from the run folders into the results folders.  This is both for S3 and local analyses.
-    # This is all done serially...if this is too slow, we should implement a parallel method using threads.. While probably
-    # Not an issue for local analyses, it may be needed for large run. Here is an example of somebody with an example of parallel
-    # downloads from S3 using threads.  https://emasquil.github.io/posts/multithreading-boto3/
+    # The files of the datapoints are collected in parallel with a pool of threads, and the ones that could not be
+    # collected are reported as failed downloads.
     def get_files(self, file_paths=None):
         for file_path in file_paths:
             pathlib.Path(os.path.dirname(self.results_folder)).mkdir(parents=True, exist_ok=True)
@@ -2166,7 +4662,7 @@ class PostProcessResults():
             logging.info(message)
             bin_folder = os.path.join(self.results_folder, filename)
             os.makedirs(bin_folder, exist_ok=True)
-            s3 = boto3.resource('s3')
+            s3 = S3TransferManager.shared()
             func = partial(self.download_file, bin_folder, extension, file_path, s3)
             files = self.btap_data_df['datapoint_output_url'].tolist()
             failed_downloads = []
@@ -2214,20 +4710,62 @@ class PostProcessResults():
             message = f"Getting file from S3 bucket {bucket} at path {s3_file_path} to {target_on_local}"
             logging.info(message)
             try:
-                s3.Bucket(bucket).download_file(s3_file_path, target_on_local)
+                s3.download_file(bucket, s3_file_path, target_on_local)
             except botocore.exceptions.ClientError as e:
                 if e.response['Error']['Code'] == "404":
                     print("The object does not exist.")
+                    return
                 else:
                     raise
-            # Copy output files ('run_dir/run/in.osm', 'run_dir/run/eplustbl.htm', 'hourly.csv') to s3 for storage.
-            self.credentials = AWSCredentials()
+            # Copy output files ('run_dir/run/in.osm', 'run_dir/run/eplustbl.htm', 'hourly.csv') to the results folder
+            # on s3 for storage. This is done on S3 itself rather than uploading the downloaded file again.
+            self.credentials = AWSCredentials.shared()
             target_path_on_aws = os.path.join("/".join(s3_file_path.split("/")[:3]),'results', file_path, row[':datapoint_id'] + extension)
             target_path_on_aws = target_path_on_aws.replace('\\', '/') # s3 likes forward slashes.
-            message = "Uploading %s..." % target_path_on_aws
-            logging.info(message)
-            S3().upload_file(target_on_local, self.credentials.account_id, target_path_on_aws)
-
+            s3.copy_object(bucket, s3_file_path, self.credentials.account_id, target_path_on_aws)
+
+
+    # Converts the hourly.csv files of the datapoints to the HourlyResultsStore in the results/hourly folder.
+    def save_hourly_results_store(self):
+        hourly_folder = os.path.join(self.results_folder, 'hourly.csv')
+        if not os.path.isdir(hourly_folder) or ':datapoint_id' not in self.btap_data_df.columns:
+            return
+        csv_paths = [os.path.join(hourly_folder, f"{datapoint_id}.csv") for datapoint_id in
+                     self.btap_data_df[':datapoint_id'].tolist()]
+        csv_paths = [csv_path for csv_path in csv_paths if os.path.isfile(csv_path)]
+        if len(csv_paths) == 0:
+            return
+        HourlyResultsStore(os.path.join(self.results_folder, HOURLY_STORE_FOLDER)).build(csv_paths)
+
+    # Saves the total, mean, percentiles and maximum of the time spent in each phase of the datapoints to the timing
+    # summary file in the results folder. The phases are the span_<name>_s columns saved by DatapointTimer.
+    def save_timing_summary(self):
+        if not isinstance(self.btap_data_df, pd.DataFrame):
+            return
+        rows = []
+        for column in [column for column in self.btap_data_df.columns if DatapointTimer.is_span(column)]:
+            values = pd.to_numeric(self.btap_data_df[column], errors='coerce').dropna().to_numpy()
+            if len(values) == 0:
+                continue
+            row = {'phase': column[len(DATAPOINT_SPAN_PREFIX):-len(DATAPOINT_SPAN_SUFFIX)],
+                   'datapoints': len(values),
+                   'total_s': values.sum(),
+                   'mean_s': values.mean()}
+            for percentile in TIMING_SUMMARY_PERCENTILES:
+                row[f"p{percentile}_s"] = np.percentile(values, percentile)
+            row['max_s'] = values.max()
+            rows.append(row)
+        if len(rows) == 0:
+            return
+        df = pd.DataFrame(rows).sort_values('total_s', ascending=False)
+        # Share of the total time of the datapoints spent in each phase. Phases can overlap, compute is part of job.
+        datapoint_total = df.loc[df['phase'] == 'datapoint', 'total_s'].sum()
+        if datapoint_total > 0:
+            df['share_of_datapoint'] = df['total_s'] / datapoint_total
+        df.to_csv(os.path.join(self.results_folder, TIMING_SUMMARY_FILENAME), index=False)
+        message = f"Time spent in each phase of the datapoints:\n{df.round(3).to_string(index=False)}"
+        logging.info(message)
+        print(message)
 
     def save_excel_output(self):
         # Create excel object
@@ -2242,156 +4780,220 @@ class PostProcessResults():
                 message = 'No simulations completed.'
                 logging.error(message)
 
-    # The below operation_on_hourly_output method is for performing operations on hourly output; for instance, sum of hourly data
+    # The below operation_on_hourly_output method is for performing operations on hourly output; for instance, sum of
+    # hourly data. Each hourly.csv file is read once, all the operations in :output_variables are applied to its numpy
+    # array, and files are reduced in parallel. The results of all datapoints are written to a single
+    # sum_hourly_res.csv file in the hourly.csv results folder.
     def operation_on_hourly_output(self):
-        # Find the directory of results
-        dir_results = self.results_folder
-
-        # Go through each folder in the results folder.
-        for folder_in_results_name in os.listdir(dir_results):
-            # Find path of the results folder
-            folder_in_results_path = os.path.join(self.results_folder, folder_in_results_name)
-            if folder_in_results_name == 'hourly.csv':
-                # Find path of the folder where the .yml file is
-                yml_file_folder_path = "\\".join(folder_in_results_path.split("\\")[:-4])
-                # Find path of the .yml file
-                yml_file_path = os.path.join(yml_file_folder_path, 'input.yml')
-                # Get inputs in the .yml file
-                analysis_config, building_options = load_btap_yml_file(yml_file_path)
-                # Get variables specified in the :output_variables variable
-                output_var = analysis_config[':output_variables']
-                # Get number of variables specified in the :output_variables variable
-                output_var_length = len(output_var)
-
-                datapoint_number = 0.0
-                df_output = []
-                for file_object in os.listdir(folder_in_results_path):
-                    # Set path of the output file that will be generated by the operation_on_hourly_output method
-                    output_file = os.path.join(folder_in_results_path, "sum_hourly_res.csv")
-
-                    if file_object != 'sum_hourly_res.csv':
-                        # Find path of the datapoint in the hourly.csv folder of the results folder
-                        datapoint_path = os.path.join(folder_in_results_path, file_object)
-
-                        # Check if the datapoint is empty or not
-                        if os.stat(datapoint_path).st_size == 0:
-                            datapoint_empty = True
-                        else:
-                            datapoint_empty = False
-
-                        # Go through datapoint if it is not empty
-                        if datapoint_empty == False:
-
-                            # Read the datapoint csv file
-                            df = pd.read_csv(datapoint_path)
-
-                            # Get column headers of the df
-                            df_columns = df.columns
-
-                            # Create an empty dataframe with the 'df_columns' column headers
-                            if datapoint_number == 0.0:
-                                df_output = []
-                                df_output = pd.DataFrame(columns=df_columns)
-
-                            # Go through each variable of output_var; Do below items for only the ones that their value for 'operation' in the .yml file is not '*'
-                            for count_operation_var in range(0,output_var_length):
-                                operation_var = output_var[count_operation_var]['variable']
-                                operation_case = output_var[count_operation_var]['operation']
-                                operation_unit = output_var[count_operation_var]['unit']
-                                if operation_var not in df_output['Name']:
-                                    df_operation_var = df.loc[df['Name'] == operation_var]
-                                    if operation_case == 'sum':
-                                        if operation_unit == 'GJ':
-                                            value_sum = df_operation_var.iloc[:,4:].sum(axis=0) / 10**9
-                                            value_sum['Units'] = 'GJ'
-                                        elif operation_unit == 'kWh':
-                                            value_sum = 277.778 * df_operation_var.iloc[:,4:].sum(axis=0) / 10**9
-                                            value_sum['Units'] = 'kWh'
-                                        elif operation_unit != '*':
-                                            message = f"Unknown unit for the sum operation on hourly outputs. Allowed units are GJ and kWh."
-                                            logging.error(message)
-                                        value_sum['datapoint_id'] = df_operation_var['datapoint_id'].iloc[0]
-                                        value_sum['Name'] = df_operation_var['Name'].iloc[0]
-                                        value_sum['KeyValue'] = ""
-                                        df_output = df_output.append(value_sum, True)
-                                    elif operation_case != '*':
-                                        message = f"Unknown operation type on hourly outputs. Allowed operation type is sum."
-                                        logging.error(message)
-                            # Go to the next datapoint
-                            datapoint_number += 1.0
-
-                if len(df_output) > 0.0:
-
-                    # Save the df_output as the output_file
-                    df_output.to_csv(output_file, index=False)
-
-                    # Copy sum_hourly_res.csv to s3 for storage if run on AWS.
-                    try:
-                        sum_hourly_res_path = os.path.join(self.results_folder, 'hourly.csv', 'sum_hourly_res.csv')
-                        self.credentials = AWSCredentials()
-                        target_path_on_aws = os.path.join(self.credentials.user_name, "\\".join(sum_hourly_res_path.split("\\")[-5:]))
-                        target_path_on_aws = target_path_on_aws.replace('\\', '/')  # s3 likes forward slashes.
-                        message = "Uploading %s..." % target_path_on_aws
-                        logging.info(message)
-                        S3().upload_file(sum_hourly_res_path, self.credentials.account_id, target_path_on_aws)
-                    except:
-                        print('Run locally. No need to copy sum_hourly_res.csv to s3')
+        hourly_folder = os.path.join(self.results_folder, 'hourly.csv')
+        if not os.path.isdir(hourly_folder):
+            return
+        output_file = os.path.join(hourly_folder, HOURLY_OPERATIONS_FILENAME)
+
+        # Get variables specified in the :output_variables variable. If they were not given, read them from the input.yml
+        # file in the project folder of the analysis.
+        output_variables = self.output_variables
+        if output_variables is None:
+            yml_file_path = os.path.join(pathlib.Path(self.results_folder).parents[2], 'input.yml')
+            analysis_config, building_options = load_btap_yml_file(yml_file_path)
+            output_variables = analysis_config[':output_variables']
+
+        # Only the variables with an operation other than '*' are reduced.
+        operations = []
+        for output_variable in output_variables:
+            operation = output_variable.get('operation', '*')
+            unit = output_variable.get('unit', '*')
+            if operation == '*':
+                continue
+            if operation not in HOURLY_OPERATIONS:
+                message = f"Unknown operation type {operation} on hourly outputs. Allowed operation types are {HOURLY_OPERATIONS}."
+                logging.error(message)
+                continue
+            if unit not in HOURLY_UNIT_CONVERSIONS:
+                message = f"Unknown unit {unit} for the {operation} operation on hourly outputs. Allowed units are {list(HOURLY_UNIT_CONVERSIONS.keys())}."
+                logging.error(message)
+                continue
+            operations.append({'variable': output_variable['variable'],
+                               'operation': operation,
+                               'unit': unit,
+                               'percentile': output_variable.get('percentile', 50)})
+        if len(operations) == 0:
+            return
+
+        datapoint_paths = [os.path.join(hourly_folder, file) for file in os.listdir(hourly_folder)
+                           if file.endswith('.csv') and file != HOURLY_OPERATIONS_FILENAME and
+                           os.stat(os.path.join(hourly_folder, file)).st_size > 0]
+        if len(datapoint_paths) == 0:
+            return
+
+        # The files are reduced in threads. Forking worker processes from a process that already runs the analysis
+        # threads could deadlock, and spawned processes would re-import the script that started the analysis.
+        max_workers = min(len(datapoint_paths), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            df_outputs = list(executor.map(partial(reduce_hourly_output_file, operations=operations), datapoint_paths,
+                                           chunksize=max(1, len(datapoint_paths) // (max_workers * 4))))
+        df_outputs = [df for df in df_outputs if len(df.index) > 0]
+        if len(df_outputs) == 0:
+            return
+
+        # Save the df_output as the output_file
+        df_output = pd.concat(df_outputs, ignore_index=True)
+        df_output.to_csv(output_file, index=False)
+        message = f"Saved operations on hourly outputs to {output_file}"
+        logging.info(message)
 
+        # Copy sum_hourly_res.csv to s3 for storage if run on AWS.
+        if self.btap_data_df['datapoint_output_url'].astype(str).str.startswith('https://s3').any():
+            self.credentials = AWSCredentials.shared()
+            # Keep the analysis_name/analysis_id/results/hourly.csv/ structure under the user folder.
+            target_path_on_aws = '/'.join((self.credentials.user_name,) + pathlib.Path(output_file).parts[-5:])
+            message = "Uploading %s..." % target_path_on_aws
+            logging.info(message)
+            S3().upload_file(output_file, self.credentials.account_id, target_path_on_aws)
+
+    # Reads the baseline results. They can be a dataframe, a results database, a csv file or an excel file with a
+    # btap_data sheet.
+    @staticmethod
+    def read_baseline_results(baseline_results):
+        if isinstance(baseline_results, pd.DataFrame):
+            return baseline_results
+        extension = pathlib.Path(baseline_results).suffix.lower()
+        if extension == '.sqlite':
+            with ResultsDatabase(baseline_results) as database:
+                return database.read_dataframe()
+        if extension == '.csv':
+            return pd.read_csv(baseline_results)
+        with open(baseline_results, 'rb') as file:
+            return pd.read_excel(file, sheet_name='btap_data')
+
+    # Adds the differences of each datapoint with the baseline datapoint of its archetype. The baseline is indexed by
+    # REFERENCE_KEY_COLUMNS and aligned to the datapoints, so only the compared columns are read and no merged copy of
+    # both tables is made. Comparisons with a column missing from either table are skipped.
     def reference_comparisons(self):
-        if self.baseline_results != None:
-            file = open(self.baseline_results, 'rb')
-            self.baseline_df = pd.read_excel(file, sheet_name='btap_data')
-            file.close()
-            merge_columns = [':building_type', ':template', ':primary_heating_fuel', ':epw_file']
-            df = pd.merge(self.btap_data_df, self.baseline_df, how='left', left_on=merge_columns,
-                          right_on=merge_columns).reset_index()  # Note: in this case, the 'x' suffix stands for the proposed building; and 'y' stands for the baseline (reference) building
-
-            if (('cost_utility_neb_total_cost_per_m_sq_y' in df.columns) and ('cost_utility_neb_total_cost_per_m_sq_x' in df.columns)):
-                self.btap_data_df['baseline_savings_energy_cost_per_m_sq'] = round(
-                    (df['cost_utility_neb_total_cost_per_m_sq_y'] - df[
-                        'cost_utility_neb_total_cost_per_m_sq_x']), 1).values
-
-            self.btap_data_df['baseline_difference_energy_eui_electricity_gj_per_m_sq'] = round(
-                (df['energy_eui_electricity_gj_per_m_sq_y'] - df[
-                    'energy_eui_electricity_gj_per_m_sq_x']), 1).values
-
-            self.btap_data_df['baseline_difference_energy_eui_natural_gas_gj_per_m_sq'] = round(
-                (df['energy_eui_natural_gas_gj_per_m_sq_y'] - df[
-                    'energy_eui_natural_gas_gj_per_m_sq_x']), 1).values
-
-            self.btap_data_df['baseline_difference_energy_eui_additional_fuel_gj_per_m_sq'] = round(
-                (df['energy_eui_additional_fuel_gj_per_m_sq_y'] - df[
-                    'energy_eui_additional_fuel_gj_per_m_sq_x']), 1).values
-
-            if (('cost_equipment_total_cost_per_m_sq_y' in df.columns) and ('cost_equipment_total_cost_per_m_sq_x' in df.columns)):
-                self.btap_data_df['baseline_difference_cost_equipment_total_cost_per_m_sq'] = round(
-                    (df['cost_equipment_total_cost_per_m_sq_y'] - df[
-                        'cost_equipment_total_cost_per_m_sq_x']), 1).values
-
-            if (('baseline_difference_cost_equipment_total_cost_per_m_sq' in df.columns) and ('baseline_savings_energy_cost_per_m_sq' in df.columns)):
-                self.btap_data_df['baseline_simple_payback_years'] = round(
-                    (self.btap_data_df['baseline_difference_cost_equipment_total_cost_per_m_sq'] / self.btap_data_df[
-                        'baseline_savings_energy_cost_per_m_sq']), 1).values
-
-            self.btap_data_df['baseline_peak_electric_percent_better'] = round(
-                ((df['energy_peak_electric_w_per_m_sq_y'] - df[
-                    'energy_peak_electric_w_per_m_sq_x']) * 100.0 / df['energy_peak_electric_w_per_m_sq_y']), 1).values
-
-            self.btap_data_df['baseline_energy_percent_better'] = round(((df['energy_eui_total_gj_per_m_sq_y'] - df[
-                'energy_eui_total_gj_per_m_sq_x']) * 100 / df['energy_eui_total_gj_per_m_sq_y']), 1).values
-
-            self.btap_data_df['baseline_necb_tier'] = pd.cut(self.btap_data_df['baseline_energy_percent_better'],
-                                                             bins=[-1000.0, -0.001, 25.00, 50.00, 60.00, 1000.0],
-                                                             labels=['non_compliant', 'tier_1', 'tier_2', 'tier_3',
-                                                                     'tier_4']).values
-
-            self.btap_data_df['baseline_ghg_percent_better'] = round(((df['cost_utility_ghg_total_kg_per_m_sq_y'] - df[
-                'cost_utility_ghg_total_kg_per_m_sq_x']) * 100 / df['cost_utility_ghg_total_kg_per_m_sq_y']), 1).values
-
-            if (('npv_total_per_m_sq_y' in df.columns) and ('npv_total_per_m_sq_x' in df.columns)):
-                self.btap_data_df['baseline_difference_npv_total_per_m_sq'] = round(
-                    (df['npv_total_per_m_sq_y'] - df[
-                        'npv_total_per_m_sq_x']), 1).values
+        if self.baseline_results is None:
+            return
+        baseline_df = self.read_baseline_results(self.baseline_results)
+        if len(baseline_df.index) == 0 or not set(REFERENCE_KEY_COLUMNS).issubset(baseline_df.columns) or \
+                not set(REFERENCE_KEY_COLUMNS).issubset(self.btap_data_df.columns):
+            message = 'The baseline results do not have any reference datapoints to compare with.'
+            logging.warning(message)
+            print(message)
+            return
+        compared_columns = [column for _, column, _ in REFERENCE_DIFFERENCE_COLUMNS
+                            if column in baseline_df.columns and column in self.btap_data_df.columns]
+        # Use the successful run of each archetype if there is one.
+        if 'success' in baseline_df.columns:
+            baseline_df = baseline_df.sort_values('success', key=lambda success: success == True, kind='stable')
+        baseline_df = baseline_df.drop_duplicates(subset=REFERENCE_KEY_COLUMNS, keep='last')
+        baseline_df = baseline_df.set_index(
+            pd.MultiIndex.from_frame(baseline_df[REFERENCE_KEY_COLUMNS].astype(str)))[compared_columns]
+        keys = pd.MultiIndex.from_frame(self.btap_data_df[REFERENCE_KEY_COLUMNS].astype(str))
+        baseline = baseline_df.reindex(keys).apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        proposed = self.btap_data_df[compared_columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+        comparisons = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name, column, percent in REFERENCE_DIFFERENCE_COLUMNS:
+                if column not in compared_columns:
+                    continue
+                index = compared_columns.index(column)
+                difference = baseline[:, index] - proposed[:, index]
+                if percent:
+                    difference = difference * 100.0 / baseline[:, index]
+                comparisons[name] = np.round(difference, 1)
+                # The payback and the NECB tier are derived from the differences before them. The cost difference is
+                # the baseline minus the proposed cost, so the extra cost of the proposed design is its negative.
+                if name == 'baseline_difference_cost_equipment_total_cost_per_m_sq' and \
+                        'baseline_savings_energy_cost_per_m_sq' in comparisons:
+                    comparisons['baseline_simple_payback_years'] = np.round(
+                        -comparisons[name] / comparisons['baseline_savings_energy_cost_per_m_sq'], 1)
+                if name == 'baseline_energy_percent_better':
+                    comparisons['baseline_necb_tier'] = pd.cut(comparisons[name],
+                                                               bins=[-1000.0, -0.001, 25.00, 50.00, 60.00, 1000.0],
+                                                               labels=['non_compliant', 'tier_1', 'tier_2', 'tier_3',
+                                                                       'tier_4'])
+        comparisons = pd.DataFrame(comparisons, index=self.btap_data_df.index)
+        # Add all the columns at once. Adding them one at a time fragments the dataframe.
+        self.btap_data_df = pd.concat(
+            [self.btap_data_df.drop(columns=comparisons.columns, errors='ignore'), comparisons], axis=1)
+
+
+# Applies the operations on hourly outputs to one hourly.csv file. The first four columns of the file are datapoint_id,
+# Name, KeyValue and Units, followed by one column per hour. The rows of each variable (one per KeyValue) are reduced
+# to a single hourly profile with the operation and converted to the requested unit. Each output row also has the hour
+# and value of the peak of its profile. This is a module function so it can run in a worker process.
+def reduce_hourly_output_file(datapoint_path, operations=None):
+    # Only the rows of the variables that have operations are converted to numbers, and only the datapoint_id, Name and
+    # Units columns are kept from the others. Reading the wide hourly files with pandas was most of the time spent.
+    variables = set(operation['variable'] for operation in operations)
+    datapoint_id = None
+    names = []
+    units = []
+    rows = []
+    with open(datapoint_path, 'r', newline='') as file:
+        reader = csv.reader(file)
+        hour_columns = next(reader, [])[4:]
+        for row in reader:
+            if len(row) < 4 or row[1] not in variables:
+                continue
+            datapoint_id = row[0]
+            names.append(row[1])
+            units.append(row[3])
+            try:
+                rows.append(np.array(row[4:], dtype=float))
+            except ValueError:
+                # Empty hours are read as nan.
+                rows.append(pd.to_numeric(pd.Series(row[4:]), errors='coerce').to_numpy(dtype=float))
+    if len(rows) == 0:
+        return pd.DataFrame()
+    # The reductions are done on a numpy array. Wide hourly frames are slow to filter and reduce in pandas.
+    names = np.array(names)
+    units = np.array(units)
+    values = np.vstack(rows)
+
+    outputs = []
+    hourly_outputs = []
+    for operation in operations:
+        selected = names == operation['variable']
+        if not selected.any():
+            continue
+        rows = values[selected]
+        case = operation['operation']
+        if case in ['sum', 'peak_hour']:
+            reduced = rows.sum(axis=0)
+        elif case == 'percentile':
+            reduced = np.quantile(rows, float(operation['percentile']) / 100.0, axis=0)
+        else:
+            reduced = getattr(rows, case)(axis=0)
+        reduced = reduced * HOURLY_UNIT_CONVERSIONS[operation['unit']]
+        # The peak_hour operation only reports the peak, not the hourly profile.
+        hourly_outputs.append(np.full(len(hour_columns), np.nan) if case == 'peak_hour' else reduced)
+        if case == 'percentile':
+            case = f"percentile_{operation['percentile']}"
+        outputs.append({'datapoint_id': datapoint_id,
+                        'Name': operation['variable'],
+                        'KeyValue': '',
+                        'Units': operation['unit'] if operation['unit'] != '*' else units[selected][0],
+                        'Operation': case,
+                        'PeakHour': hour_columns[int(np.argmax(reduced))],
+                        'PeakValue': reduced.max()})
+    if len(outputs) == 0:
+        return pd.DataFrame()
+    return pd.concat([pd.DataFrame(outputs), pd.DataFrame(np.vstack(hourly_outputs), columns=hour_columns)], axis=1)
+
+
+# Returns the analysis_id of the most recent run of an analysis that has a results database, or None. The folders of
+# its stages (e.g. _ref, _elim) are also searched. Used to resume an analysis when :analysis_id was not set in the input
+# file.
+def find_resumable_analysis_id(project_root, analysis_name):
+    database_paths = []
+    for suffix in ['', '_ref', '_elim', '_sens', '_opt']:
+        database_paths += glob.glob(os.path.join(project_root, f"{analysis_name}{suffix}", '*', 'results', 'database',
+                                                 RESULTS_DATABASE_FILENAME))
+    if len(database_paths) == 0:
+        return None
+    database_path = max(database_paths, key=os.path.getmtime)
+    return pathlib.Path(database_path).parents[2].name
 
 
 # Helper method to load input.yml file into data structures required by btap_batch
@@ -2419,13 +5021,18 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
     analysis_config, building_options = load_btap_yml_file(analysis_config_file)
     project_root = os.path.dirname(analysis_config_file)
 
+    # When resuming, use the analysis_id of the previous run so its folder and AWS jobs are found again.
+    resume = analysis_config.get(':resume', False) == True
+    if resume and analysis_config.get(':analysis_id') is None:
+        analysis_config[':analysis_id'] = find_resumable_analysis_id(project_root, analysis_config[':analysis_name'])
+
     # Set Analysis Id if not set
     if (not ':analysis_id' in analysis_config) or analysis_config[':analysis_id'] is None:
         analysis_config[':analysis_id'] = str(uuid.uuid4())
 
     logfile = os.path.join(project_root, f"{analysis_config[':analysis_id']}.log")
-    # remove old logfile if it is there.
-    if os.path.exists(logfile):
+    # remove old logfile if it is there. A resumed analysis appends to it.
+    if os.path.exists(logfile) and not resume:
         os.remove(logfile)
 
     logging.basicConfig(filename=logfile,
@@ -2442,29 +5049,11 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
 
 
 
-    if analysis_config[':compute_environment'] == 'aws_batch' and batch is None:
-        # create aws image, set up aws compute env and create workflow queue.
-
-        batch = AWSBatch(
-            analysis_id=analysis_config[':analysis_id'],
-            btap_image_name=analysis_config[':image_name'],
-            rebuild_image=analysis_config[':nocache'],
-            git_api_token=git_api_token,
-            os_version=analysis_config[':os_version'],
-            btap_costing_branch=analysis_config[':btap_costing_branch'],
-            os_standards_branch=analysis_config[':os_standards_branch']
-        )
-        # Create batch queue on aws.
-        batch.setup()
-    elif analysis_config[':compute_environment'] == 'local' and batch is None:
-        batch = DockerBatch(image_name=analysis_config[':image_name'],
-                            git_api_token=git_api_token,
-                            os_standards_branch=analysis_config[':os_standards_branch'],
-                            btap_costing_branch=analysis_config[':btap_costing_branch'],
-                            os_version=analysis_config[':os_version'],
-                            nocache=analysis_config[':nocache'])
-        # Create batch queue on docker desktop.
-        batch.setup()
+    # Create the backend that runs the datapoints of all the analyses. A backend that was passed in is shared with
+    # other analyses and is torn down by its owner.
+    owns_batch = batch is None
+    if batch is None:
+        batch = create_batch(analysis_config=analysis_config, git_api_token=git_api_token)
 
     baseline_results = None
     # Ensure reference run is executed in all other cases unless :run_reference is false.
@@ -2485,7 +5074,8 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
                            batch=batch)
         print(f"running {algorithm_type} stage")
         bb.run()
-        baseline_results = os.path.join(bb.results_folder, 'output.xlsx')
+        # Pass the reference results in memory.
+        baseline_results = bb.results_df
 
     # pre-flight
     if analysis_config[':algorithm'][':type'] == 'pre-flight':
@@ -2497,7 +5087,7 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
             git_api_token=git_api_token,
             batch=batch
         )
-        return opt
+        analysis = opt
     elif analysis_config[':algorithm'][':type'] == 'reference':
         # Run reference simulations first.
         analysis_suffix = '_ref'
@@ -2513,9 +5103,10 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
                            batch=batch)
         print(f"running {algorithm_type} stage")
         bb.run()
+        analysis = None
     # LHS
     elif analysis_config[':algorithm'][':type'] == 'sampling-lhs':
-        return BTAPSamplingLHS(analysis_config=analysis_config,
+        analysis = BTAPSamplingLHS(analysis_config=analysis_config,
                                building_options=building_options,
                                project_root=project_root,
                                git_api_token=git_api_token,
@@ -2523,15 +5114,31 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
                                baseline_results=baseline_results)
     # nsga2
     elif analysis_config[':algorithm'][':type'] == 'nsga2':
-        return BTAPOptimization(analysis_config=analysis_config,
+        analysis = BTAPOptimization(analysis_config=analysis_config,
                                 building_options=building_options,
                                 project_root=project_root,
                                 git_api_token=git_api_token,
                                 batch=batch,
                                 baseline_results=baseline_results)
+    # asynchronous nsga2
+    elif analysis_config[':algorithm'][':type'] == 'nsga2_async':
+        analysis = BTAPAsyncOptimization(analysis_config=analysis_config,
+                                     building_options=building_options,
+                                     project_root=project_root,
+                                     git_api_token=git_api_token,
+                                     batch=batch,
+                                     baseline_results=baseline_results)
+    # surrogate assisted nsga2
+    elif analysis_config[':algorithm'][':type'] == 'surrogate_nsga2':
+        analysis = BTAPSurrogateOptimization(analysis_config=analysis_config,
+                                         building_options=building_options,
+                                         project_root=project_root,
+                                         git_api_token=git_api_token,
+                                         batch=batch,
+                                         baseline_results=baseline_results)
     # parametric
     elif analysis_config[':algorithm'][':type'] == 'parametric':
-        return BTAPParametric(analysis_config=analysis_config,
+        analysis = BTAPParametric(analysis_config=analysis_config,
                               building_options=building_options,
                               project_root=project_root,
                               git_api_token=git_api_token,
@@ -2539,7 +5146,7 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
                               baseline_results=baseline_results)
     # elimination
     elif analysis_config[':algorithm'][':type'] == 'elimination':
-        return BTAPElimination(analysis_config=analysis_config,
+        analysis = BTAPElimination(analysis_config=analysis_config,
                                building_options=building_options,
                                project_root=project_root,
                                git_api_token=git_api_token,
@@ -2547,7 +5154,7 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
                                baseline_results=baseline_results)
     # Sensitivity
     elif analysis_config[':algorithm'][':type'] == 'sensitivity':
-        return BTAPSensitivity(analysis_config=analysis_config,
+        analysis = BTAPSensitivity(analysis_config=analysis_config,
                                building_options=building_options,
                                project_root=project_root,
                                git_api_token=git_api_token,
@@ -2555,7 +5162,7 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
                                baseline_results=baseline_results)
     # IDP
     elif analysis_config[':algorithm'][':type'] == 'idp':
-        return BTAPIntegratedDesignProcess(analysis_config=analysis_config,
+        analysis = BTAPIntegratedDesignProcess(analysis_config=analysis_config,
                                            building_options=building_options,
                                            project_root=project_root,
                                            git_api_token=git_api_token,
@@ -2564,15 +5171,137 @@ def btap_batch(analysis_config_file=None, git_api_token=None, batch=None):
     # osm_batch
     elif analysis_config[':algorithm'][':type'] == 'osm_batch':
         # Need to force this to use the NECB2011 standards class for now.
-        return BTAPParametric(analysis_config=analysis_config,
+        analysis = BTAPParametric(analysis_config=analysis_config,
                               building_options=building_options,
                               project_root=project_root,
                               git_api_token=git_api_token,
                               batch=batch)
     else:
-        message = f'Unknown algorithm type. Allowed types are nsga2 and parametric. Exiting'
+        message = f'Unknown algorithm type. Allowed types are nsga2, nsga2_async, surrogate_nsga2 and parametric. Exiting'
         print(message)
         logging.error(message)
         exit(1)
-    if not batch is None:
+    # The analysis tears down a batch created here once it has run. A batch that was passed in is torn down by its
+    # owner.
+    if analysis is None:
+        if owns_batch:
+            batch.tear_down()
+        return None
+    analysis.owns_batch = owns_batch
+    return analysis
+
+
+# Runs many analyses at the same time on one backend. The analyses are the input file analysis_config_file with each of
+# the overrides applied. An override is a dict with an optional :analysis_configuration and :building_options whose
+# keys replace the ones of the input file, and it should set a unique :analysis_name. All the analyses share the
+# backend created from the input file and its worker slots, so together they never run more datapoints than the
+# backend has capacity for, and a free slot goes to the analysis with the fewest running datapoints. The rows of all
+# the analyses, including their reference and IDP stages, are combined in one results database in
+# MULTI_ANALYSIS_RESULTS_FOLDER. Returns the path of that database.
+def btap_batch_multi(analysis_config_file=None, overrides=None, git_api_token=None, max_parallel_analyses=None):
+    analysis_config, building_options = load_btap_yml_file(analysis_config_file)
+    project_root = os.path.dirname(analysis_config_file)
+    overrides = overrides or [{}]
+
+    logfile = os.path.join(project_root, f"{MULTI_ANALYSIS_RESULTS_FOLDER}.log")
+    if os.path.exists(logfile):
+        os.remove(logfile)
+    logging.basicConfig(filename=logfile,
+                        filemode='a',
+                        format='%(asctime)s, %(levelname)-8s [%(filename)s:%(lineno)d:%(funcName)s] %(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.DEBUG)
+    message = f"Log file created: {logfile}"
+    print(message)
+    logging.info(message)
+
+    # Write the input file of each analysis.
+    analyses = []
+    for index, override in enumerate(overrides):
+        config = copy.deepcopy(analysis_config)
+        options = copy.deepcopy(building_options)
+        config_override = override.get(':analysis_configuration', {})
+        changed_keys = [key for key in MULTI_ANALYSIS_SHARED_KEYS
+                        if key in config_override and config_override[key] != analysis_config.get(key)]
+        if len(changed_keys) > 0:
+            message = f"The analyses share one backend. Overrides cannot change {changed_keys}. Exiting"
+            logging.error(message)
+            print(message)
+            exit(1)
+        config.update(config_override)
+        options.update(override.get(':building_options', {}))
+        if ':analysis_name' not in config_override:
+            config[':analysis_name'] = f"{analysis_config[':analysis_name']}_{index}"
+        # A resumed analysis keeps the analysis_id of its previous run, which btap_batch finds from its folders.
+        if config.get(':resume', False) == True:
+            config[':analysis_id'] = None
+        else:
+            config[':analysis_id'] = str(uuid.uuid4())
+        input_file = os.path.join(project_root, f"{config[':analysis_name']}.yml")
+        with open(input_file, 'w') as outfile:
+            yaml.dump({':analysis_configuration': config, ':building_options': options}, outfile)
+        analyses.append((config[':analysis_name'], config[':analysis_id'], input_file))
+    names = [name for name, _, _ in analyses]
+    if len(set(names)) != len(names):
+        message = f"Each analysis needs a unique :analysis_name. Got {names}. Exiting"
+        logging.error(message)
+        print(message)
+        exit(1)
+
+    batch = create_batch(analysis_config=analysis_config, git_api_token=git_api_token)
+    message = f"Running {len(analyses)} analyses on one {analysis_config[':compute_environment']} backend with " \
+              f"{batch.get_threads()} worker slots."
+    logging.info(message)
+    print(message)
+
+    # Returns the analysis_id the analysis ran with.
+    def run_analysis(name, input_file):
+        analysis = btap_batch(analysis_config_file=input_file, git_api_token=git_api_token, batch=batch)
+        if analysis is None:
+            return find_resumable_analysis_id(project_root, name)
+        analysis.run()
+        return analysis.analysis_config[':analysis_id']
+
+    failed_analyses = []
+    analysis_ids = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel_analyses or len(analyses),
+                                thread_name_prefix='analysis') as executor:
+            futures = {executor.submit(run_analysis, name, input_file): name for name, _, input_file in analyses}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    message = f"Analysis {futures[future]} failed: {future.exception()}"
+                    logging.error(message)
+                    print(message)
+                    failed_analyses.append(futures[future])
+                else:
+                    analysis_ids[futures[future]] = future.result()
+                    message = f"Analysis {futures[future]} completed."
+                    logging.info(message)
+                    print(message)
+    finally:
         batch.tear_down()
+    analyses = [(name, analysis_ids.get(name) or analysis_id, input_file) for name, analysis_id, input_file in analyses]
+
+    # Combine the results databases of the analyses and their stages.
+    combined_path = os.path.join(project_root, MULTI_ANALYSIS_RESULTS_FOLDER, RESULTS_DATABASE_FILENAME)
+    if os.path.isfile(combined_path):
+        os.remove(combined_path)
+    combined = ResultsDatabase(combined_path)
+    for name, analysis_id, _ in analyses:
+        if analysis_id is None:
+            continue
+        for database_path in sorted(glob.glob(os.path.join(project_root, f"{name}*", analysis_id, 'results',
+                                                           'database', RESULTS_DATABASE_FILENAME))):
+            with ResultsDatabase(database_path) as database:
+                combined.add_many(database.read_rows())
+    message = f"Combined {combined.count()} datapoints of {len(analyses) - len(failed_analyses)} analyses in " \
+              f"{combined_path}"
+    combined.close()
+    logging.info(message)
+    print(message)
+    if len(failed_analyses) > 0:
+        message = f"Analyses that failed: {failed_analyses}"
+        logging.error(message)
+        print(message)
+    return combined_path
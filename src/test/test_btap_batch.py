@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 import src.btap_batch as btap
 import os
 import yaml
@@ -6,6 +7,10 @@ from pathlib import Path
 import warnings
 import shutil
 import uuid
+import glob
+import pandas as pd
+import threading
+import time
 
 class TestBTAPBatch(unittest.TestCase):
     first_test = True
@@ -157,6 +162,396 @@ class TestBTAPBatch(unittest.TestCase):
     def test_parametric(self):
         self.run_analysis(input_file=os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..','examples','parametric', 'input.yml'))
 
+
+# Runs the analyses with the local_mock compute environment. Does not need docker, AWS or a git token.
+class TestLocalMockBatch(unittest.TestCase):
+
+    def run_analysis(self, input_file=None, failure_rate=0.0, analysis_configuration=None):
+        basename = Path(os.path.dirname(input_file)).stem
+        with open(input_file, 'r') as stream:
+            analysis = yaml.safe_load(stream)
+        analysis[':analysis_configuration'][':compute_environment'] = 'local_mock'
+        analysis[':analysis_configuration'][':local_mock'] = {':latency': 0.01, ':failure_rate': failure_rate}
+        analysis[':analysis_configuration'][':run_reference'] = False
+        analysis[':analysis_configuration'].update(analysis_configuration or {})
+
+        test_output_folder = os.path.join(os.getcwd(), 'test_output', f'local_mock_{basename}')
+        if os.path.isdir(test_output_folder):
+            shutil.rmtree(test_output_folder)
+        shutil.copytree(os.path.dirname(input_file), test_output_folder)
+        test_configuration_file = os.path.join(test_output_folder, 'input.yml')
+        with open(test_configuration_file, 'w') as outfile:
+            yaml.dump(analysis, outfile, default_flow_style=False)
+
+        bb = btap.btap_batch(analysis_config_file=test_configuration_file, git_api_token=None)
+        bb.run()
+        excel_path = os.path.join(bb.project_root, bb.analysis_config[':analysis_name'], bb.analysis_config[':analysis_id'], 'results', 'output.xlsx')
+        assert os.path.isfile(excel_path), 'Output.xlsx was not created'
+        assert bb.batch.executor is None, 'The batch created for the analysis was not torn down'
+        return excel_path
+
+    def test_parametric(self):
+        self.run_analysis(input_file=os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..','examples','parametric', 'input.yml'))
+
+    def test_failures(self):
+        excel_path = self.run_analysis(input_file=os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..','examples','parametric', 'input.yml'), failure_rate=1.0)
+        failures_folder = os.path.join(os.path.dirname(excel_path), 'failures')
+        assert len(os.listdir(failures_folder)) > 0, 'Failures were not recorded'
+
+    def test_resume_failed_datapoints(self):
+        input_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..','examples','parametric', 'input.yml')
+        excel_path = self.run_analysis(input_file=input_file, failure_rate=1.0)
+        # Resume the analysis without failures. The datapoints that failed are run again.
+        test_configuration_file = os.path.join(os.getcwd(), 'test_output', 'local_mock_parametric', 'input.yml')
+        with open(test_configuration_file, 'r') as stream:
+            analysis = yaml.safe_load(stream)
+        analysis[':analysis_configuration'][':resume'] = True
+        analysis[':analysis_configuration'][':local_mock'][':failure_rate'] = 0.0
+        with open(test_configuration_file, 'w') as outfile:
+            yaml.dump(analysis, outfile, default_flow_style=False)
+        bb = btap.btap_batch(analysis_config_file=test_configuration_file, git_api_token=None)
+        bb.run()
+        assert bb.analysis_config[':analysis_id'] in excel_path, 'The previous run was not resumed'
+        df = pd.read_excel(excel_path, sheet_name='btap_data')
+        assert df['success'].all(), 'Failed datapoints were not run again'
+        assert len(os.listdir(os.path.join(os.path.dirname(excel_path), 'failures'))) == 0, 'Old failures were kept'
+
+    def test_reference_library(self):
+        cache_folder = os.path.join(os.getcwd(), 'test_output', 'reference_cache')
+        if os.path.isdir(cache_folder):
+            shutil.rmtree(cache_folder)
+        configuration = {':run_reference': True, ':reference_library': True, ':datapoint_cache_folder': cache_folder}
+        input_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..','examples','parametric', 'input.yml')
+        self.run_analysis(input_file=input_file, analysis_configuration=configuration)
+        references = len(glob.glob(os.path.join(cache_folder, '*', '*')))
+        assert references > 0, 'References were not added to the cache'
+        # The second analysis takes all its references from the cache, so none are simulated again.
+        excel_path = self.run_analysis(input_file=input_file, analysis_configuration=configuration)
+        assert len(glob.glob(os.path.join(cache_folder, '*', '*'))) == references, 'References were simulated again'
+        analysis_folder = Path(excel_path).parents[2]
+        reference_excel_path = os.path.join(f"{analysis_folder}_ref", Path(excel_path).parents[1].name, 'results',
+                                            'output.xlsx')
+        df = pd.read_excel(reference_excel_path, sheet_name='btap_data')
+        assert df['datapoint_cache_hit'].all(), 'References were not taken from the cache'
+        assert df['datapoint_output_url'].str.contains(f"{Path(excel_path).parents[1].name}").all(), \
+            'References point to the output folder of another analysis'
+        # Only the references are cached, not the datapoints of the analysis.
+        df = pd.read_excel(excel_path, sheet_name='btap_data')
+        assert 'datapoint_cache_hit' not in df.columns, 'Datapoints of the analysis were cached'
+        assert df['baseline_energy_percent_better'].notna().all(), 'Baseline comparisons are missing'
+
+    def test_runtime_estimator(self):
+        history_path = os.path.join(os.getcwd(), 'test_output', 'runtime_history.sqlite')
+        for path in glob.glob(f"{history_path}*"):
+            os.remove(path)
+        # Seed the history so the estimator is trained before the scenarios are submitted.
+        estimator = btap.RuntimeEstimator(history_path, compute_environment='local_mock')
+        for index in range(btap.RUNTIME_ESTIMATOR_MIN_SAMPLES):
+            estimator.put({':template': ['NECB2011', 'NECB2017'][index % 2]}, 1.0 + index % 2)
+        # A single thread runs the datapoints in the order they are submitted.
+        configuration = {':runtime_estimator': True, ':runtime_history_path': history_path,
+                         ':local_mock': {':latency': 0.01, ':threads': 1}}
+        input_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..','examples','parametric', 'input.yml')
+        excel_path = self.run_analysis(input_file=input_file, analysis_configuration=configuration)
+        assert estimator.count() > btap.RUNTIME_ESTIMATOR_MIN_SAMPLES, 'Simulation times were not added to the history'
+        estimator.close()
+        summary_path = os.path.join(os.path.dirname(excel_path), btap.RUNTIME_SUMMARY_FILENAME)
+        assert os.path.isfile(summary_path), 'Runtime summary was not created'
+        df = pd.read_excel(excel_path, sheet_name='btap_data')
+        assert df['predicted_simulation_time'].notna().all(), 'Predicted simulation times are missing'
+        with btap.ResultsDatabase(os.path.join(os.path.dirname(excel_path), 'database',
+                                               btap.RESULTS_DATABASE_FILENAME)) as database:
+            predicted_times = database.read_dataframe()['predicted_simulation_time'].tolist()
+        assert predicted_times == sorted(predicted_times, reverse=True), 'Scenarios were not submitted longest first'
+        assert predicted_times[0] > predicted_times[-1], 'The history did not change the predictions'
+
+    def test_multi_analyses(self):
+        input_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..','examples','parametric', 'input.yml')
+        test_output_folder = os.path.join(os.getcwd(), 'test_output', 'local_mock_multi_analyses')
+        if os.path.isdir(test_output_folder):
+            shutil.rmtree(test_output_folder)
+        os.makedirs(test_output_folder)
+        with open(input_file, 'r') as stream:
+            analysis = yaml.safe_load(stream)
+        analysis[':analysis_configuration'][':compute_environment'] = 'local_mock'
+        analysis[':analysis_configuration'][':local_mock'] = {':latency': 0.01}
+        analysis[':analysis_configuration'][':run_reference'] = False
+        test_configuration_file = os.path.join(test_output_folder, 'input.yml')
+        with open(test_configuration_file, 'w') as outfile:
+            yaml.dump(analysis, outfile, default_flow_style=False)
+        overrides = [{':analysis_configuration': {':analysis_name': f'multi_{fuel}'},
+                      ':building_options': {':primary_heating_fuel': [fuel]}} for fuel in ['Electricity', 'NaturalGas']]
+        database_path = btap.btap_batch_multi(analysis_config_file=test_configuration_file, overrides=overrides)
+        with btap.ResultsDatabase(database_path) as database:
+            df = database.read_dataframe()
+        assert sorted(df[':analysis_name'].unique()) == ['multi_Electricity', 'multi_NaturalGas'], 'Analyses are missing from the combined results'
+        # Resuming keeps the analysis folders of the first run instead of starting new ones.
+        analysis[':analysis_configuration'][':resume'] = True
+        with open(test_configuration_file, 'w') as outfile:
+            yaml.dump(analysis, outfile, default_flow_style=False)
+        database_path = btap.btap_batch_multi(analysis_config_file=test_configuration_file, overrides=overrides)
+        for name in ['multi_Electricity', 'multi_NaturalGas']:
+            assert len(os.listdir(os.path.join(test_output_folder, name))) == 1, f'{name} was not resumed in its folder'
+        with btap.ResultsDatabase(database_path) as database:
+            assert len(database.read_dataframe()) == len(df), 'Resumed analyses were not combined'
+
+    def test_multi_optimizations(self):
+        input_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..','examples','optimization', 'input.yml')
+        test_output_folder = os.path.join(os.getcwd(), 'test_output', 'local_mock_multi_optimizations')
+        if os.path.isdir(test_output_folder):
+            shutil.rmtree(test_output_folder)
+        os.makedirs(test_output_folder)
+        with open(input_file, 'r') as stream:
+            analysis = yaml.safe_load(stream)
+        analysis[':analysis_configuration'][':compute_environment'] = 'local_mock'
+        analysis[':analysis_configuration'][':local_mock'] = {':latency': 0.01, ':threads': 4}
+        analysis[':analysis_configuration'][':run_reference'] = False
+        analysis[':analysis_configuration'][':algorithm'][':type'] = 'nsga2_async'
+        test_configuration_file = os.path.join(test_output_folder, 'input.yml')
+        with open(test_configuration_file, 'w') as outfile:
+            yaml.dump(analysis, outfile, default_flow_style=False)
+        overrides = [{':analysis_configuration': {':analysis_name': f'multi_opt_{index}'}} for index in range(2)]
+        # Record the groups that share the slots each time an analysis sizes its threads.
+        shares = []
+        share = btap.WorkerSlots.share
+
+        def recording_share(slots):
+            shares.append(set(slots.active_groups))
+            return share(slots)
+
+        with mock.patch.object(btap.WorkerSlots, 'share', recording_share):
+            database_path = btap.btap_batch_multi(analysis_config_file=test_configuration_file, overrides=overrides)
+        with btap.ResultsDatabase(database_path) as database:
+            df = database.read_dataframe()
+        assert sorted(df[':analysis_name'].unique()) == ['multi_opt_0', 'multi_opt_1'], 'Optimizations are missing from the combined results'
+        for name in ['multi_opt_0', 'multi_opt_1']:
+            assert any(name in groups for groups in shares), f'{name} did not size its threads from the worker slots'
+
+class TestPostProcessResults(unittest.TestCase):
+
+    def test_reference_comparisons(self):
+        keys = {':building_type': 'SmallOffice', ':template': 'NECB2017', ':primary_heating_fuel': 'Electricity',
+                ':epw_file': 'CAN_ON_Toronto.epw'}
+        baseline = pd.DataFrame([dict(keys, success=True, cost_equipment_total_cost_per_m_sq=5.0,
+                                      cost_utility_neb_total_cost_per_m_sq=10.0, energy_eui_total_gj_per_m_sq=1.0)])
+        proposed = pd.DataFrame([dict(keys, success=True, cost_equipment_total_cost_per_m_sq=9.0,
+                                      cost_utility_neb_total_cost_per_m_sq=8.0, energy_eui_total_gj_per_m_sq=0.7)])
+        results = btap.PostProcessResults.__new__(btap.PostProcessResults)
+        results.btap_data_df = proposed
+        results.baseline_results = baseline
+        results.reference_comparisons()
+        row = results.btap_data_df.iloc[0]
+        assert row['baseline_savings_energy_cost_per_m_sq'] == 2.0, 'Energy cost savings are wrong'
+        assert row['baseline_difference_cost_equipment_total_cost_per_m_sq'] == -4.0, 'Cost difference is wrong'
+        # Paying 4 more to save 2 a year pays back in 2 years.
+        assert row['baseline_simple_payback_years'] == 2.0, 'Payback is wrong'
+        assert row['baseline_energy_percent_better'] == 30.0, 'Energy percent better is wrong'
+        assert row['baseline_necb_tier'] == 'tier_2', 'NECB tier is wrong'
+
+
+class TestBatchBackend(unittest.TestCase):
+
+    def test_incomplete_backend(self):
+        # A backend that does not implement submit_job cannot be created.
+        class IncompleteBatch(btap.BatchBackend):
+            @classmethod
+            def from_analysis_config(cls, analysis_config=None, git_api_token=None):
+                return cls()
+
+            def get_threads(self):
+                return 2
+
+            def image_identity(self):
+                return 'incomplete'
+
+        with self.assertRaises(TypeError):
+            IncompleteBatch()
+        batch = btap.LocalMockBatch(settings={':threads': 3})
+        assert batch.get_worker_slots() is batch.get_worker_slots(), 'Worker slots are not shared'
+
+    def test_aws_job_image(self):
+        # The job definition pins the image digest once it is known instead of the mutable tag.
+        batch = btap.AWSBatch.__new__(btap.AWSBatch)
+        batch.image_full_name = '123456789012.dkr.ecr.ca-central-1.amazonaws.com/btap_cli:user'
+        batch.image_digest = None
+        assert batch.job_image() == batch.image_full_name, 'The tag should be used without a digest'
+        batch.image_digest = 'sha256:abc123'
+        assert batch.job_image() == '123456789012.dkr.ecr.ca-central-1.amazonaws.com/btap_cli@sha256:abc123', \
+            'The digest was not used in the job definition image'
+
+    def test_aws_failed_job_without_error_file(self):
+        # A job that ran out of memory never writes error.txt. It is recorded as a failed datapoint.
+        test_output_folder = os.path.join(os.getcwd(), 'test_output', 'aws_failed_job')
+        if os.path.isdir(test_output_folder):
+            shutil.rmtree(test_output_folder)
+        batch = btap.AWSBatch.__new__(btap.AWSBatch)
+        batch.credentials = mock.Mock(account_id='123456789012', user_name='user')
+        batch.job_resource_profiles = {}
+        batch.job_resource_lock = threading.Lock()
+
+        def job(job_description=None, **kwargs):
+            job_description.update({'status': 'FAILED', 'statusReason': 'OutOfMemoryError: Container killed'})
+            return 'FAILED'
+
+        batch.job = job
+        transfer_manager = mock.Mock()
+        transfer_manager.read_object.side_effect = Exception('NoSuchKey')
+        run_options = {':analysis_id': 'analysis', ':analysis_name': 'aws', ':datapoint_id': 'datapoint',
+                       ':building_type': 'Hospital'}
+        with mock.patch.object(btap, 'S3'), \
+                mock.patch.object(btap.S3TransferManager, 'shared', return_value=transfer_manager):
+            btap_data = batch.submit_job(test_output_folder,
+                                         os.path.join(test_output_folder, 'output', 'datapoint', 'btap_data.json'),
+                                         os.path.join(test_output_folder, 'input', 'datapoint'),
+                                         os.path.join(test_output_folder, 'output', 'datapoint'),
+                                         run_options)
+        assert btap_data['success'] == False, 'The failed job was not recorded as a failure'
+        assert 'OutOfMemoryError' in btap_data['container_error'], 'The status reason of the job was not kept'
+        assert transfer_manager.read_object.call_count == 1, 'btap_data.json was downloaded for a failed job'
+
+    def test_aws_job_memory_history(self):
+        # The memory a building type was raised to is kept for the next analyses.
+        test_output_folder = os.path.join(os.getcwd(), 'test_output', 'job_memory_history')
+        if os.path.isdir(test_output_folder):
+            shutil.rmtree(test_output_folder)
+        history_path = os.path.join(test_output_folder, 'job_memory_history.sqlite')
+
+        def create_batch():
+            batch = btap.AWSBatch.__new__(btap.AWSBatch)
+            batch.job_resource_profiles = dict((key, dict(value)) for key, value in btap.JOB_RESOURCE_PROFILES.items())
+            batch.job_resource_lock = threading.Lock()
+            batch.job_memory_history = btap.JobMemoryHistory(history_path)
+            batch.seed_job_memory(batch.job_memory_history.get())
+            return batch
+
+        batch = create_batch()
+        resources = batch.job_resources('Hospital')
+        assert resources == {':vcpus': 1, ':memory': 8000}, f'Unexpected Hospital resources {resources}'
+        assert batch.raise_job_memory('Hospital', resources), 'Memory was not raised'
+        batch.job_memory_history.close()
+        batch = create_batch()
+        assert batch.job_resources('Hospital')[':memory'] == 16000, 'Memory was not seeded from the history'
+        assert batch.job_resources('Warehouse')[':memory'] == btap.CONTAINER_MEMORY, 'Other building types changed'
+        batch.job_memory_history.put('Hospital', 4000)
+        assert batch.job_memory_history.get()['Hospital'] == 16000, 'The history lost the larger memory'
+        batch.job_memory_history.close()
+
+
+class TestAWSBatchJobPoller(unittest.TestCase):
+
+    def test_finished_and_missing_jobs(self):
+        polls = {'count': 0}
+
+        # Fake describe_jobs. job_1 runs for two polls and succeeds, job_2 is never returned.
+        def describe_jobs(job_ids):
+            polls['count'] += 1
+            status = 'RUNNING' if polls['count'] < 3 else 'SUCCEEDED'
+            return {'jobs': [{'jobId': job_id, 'status': status} for job_id in job_ids if job_id == 'job_1']}
+
+        poller = btap.AWSBatchJobPoller(describe_jobs=describe_jobs, min_interval=0.01, max_interval=0.02, max_missing=3)
+        finished = poller.watch('job_1', 'finished')
+        missing = poller.watch('job_2', 'missing')
+        assert finished.result(timeout=10)['status'] == 'SUCCEEDED', 'Finished job was not reported'
+        assert set(finished.result()['status_times'].keys()) == {'RUNNING', 'SUCCEEDED'}, 'Status history is missing'
+        with self.assertRaisesRegex(Exception, 'was not found'):
+            missing.result(timeout=10)
+        assert poller.number_of_jobs() == 0, 'Missing job is still watched'
+        poller.stop()
+
+
+class TestWorkerSlots(unittest.TestCase):
+
+    # Queues a waiter on the slots for each (name, priority, group) in arrival order while all the slots are held.
+    # Each waiter records its name when it gets a slot and releases it right away.
+    def start_waiters(self, slots, waiters, order):
+        threads = []
+        for name, priority, group in waiters:
+            def wait(name=name, priority=priority, group=group):
+                slots.acquire(priority=priority, group=group)
+                order.append(name)
+                slots.release(group=group)
+            thread = threading.Thread(target=wait)
+            thread.start()
+            threads.append(thread)
+            while len(slots.waiting) < len(threads):
+                time.sleep(0.001)
+        return threads
+
+    def test_priority(self):
+        slots = btap.WorkerSlots(size=1)
+        slots.acquire(group='held')
+        order = []
+        threads = self.start_waiters(slots, [('low', 2, 'a'), ('high', 0, 'b'), ('medium', 1, 'c')], order)
+        slots.release(group='held')
+        for thread in threads:
+            thread.join(timeout=10)
+        assert order == ['high', 'medium', 'low'], f'Slots were not given by priority: {order}'
+
+    def test_fairness(self):
+        slots = btap.WorkerSlots(size=2)
+        slots.acquire(group='x')
+        slots.acquire(group='x')
+        order = []
+        # Same priority. The group with fewer running datapoints goes first even though it arrived later.
+        threads = self.start_waiters(slots, [('x_1', 0, 'x'), ('y_1', 0, 'y')], order)
+        slots.release(group='x')
+        for thread in threads:
+            thread.join(timeout=10)
+        slots.release(group='x')
+        assert order == ['y_1', 'x_1'], f'Slots were not shared fairly between groups: {order}'
+        assert slots.running == 0, 'Slots were not all released'
+
+    def test_share(self):
+        slots = btap.WorkerSlots(size=5)
+        assert slots.share() == 5, 'A single analysis should use all the slots'
+        slots.join('a')
+        slots.join('b')
+        assert slots.share() == 3, 'The slots were not shared between the analyses'
+        slots.leave('b')
+        assert slots.share() == 5, 'The share did not grow back when an analysis finished'
+        slots.leave('a')
+
+
+class TestStageScheduler(unittest.TestCase):
+
+    class FakeAnalysis:
+        def __init__(self, name, order, error=None):
+            self.name = name
+            self.order = order
+            self.error = error
+
+        def run(self):
+            time.sleep(0.01)
+            if self.error is not None:
+                raise self.error
+            self.order.append(self.name)
+
+    def test_dependency_order(self):
+        order = []
+        scheduler = btap.StageScheduler()
+        scheduler.add_stage('elimination', lambda: self.FakeAnalysis('elimination', order))
+        scheduler.add_stage('sensitivity', lambda: self.FakeAnalysis('sensitivity', order),
+                            depends_on=['elimination'])
+        scheduler.add_stage('optimization', lambda: self.FakeAnalysis('optimization', order),
+                            depends_on=['sensitivity'])
+        analyses = scheduler.run()
+        assert order == ['elimination', 'sensitivity', 'optimization'], f'Stages ran out of order: {order}'
+        assert list(analyses.keys()) == ['elimination', 'sensitivity', 'optimization'], 'Analyses are missing'
+        with self.assertRaises(ValueError):
+            scheduler.add_stage('post', lambda: self.FakeAnalysis('post', order), depends_on=['unknown'])
+
+    def test_failed_dependency(self):
+        order = []
+        scheduler = btap.StageScheduler()
+        scheduler.add_stage('elimination', lambda: self.FakeAnalysis('elimination', order, RuntimeError('failed')))
+        scheduler.add_stage('sensitivity', lambda: self.FakeAnalysis('sensitivity', order),
+                            depends_on=['elimination'])
+        scheduler.add_stage('reference', lambda: self.FakeAnalysis('reference', order))
+        with self.assertRaisesRegex(RuntimeError, 'failed'):
+            scheduler.run()
+        assert order == ['reference'], f'A stage depending on a failed stage was run: {order}'
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,338 @@
+# Benchmark of the time btap_batch spends outside of the simulations. An LHS analysis of the sample-lhs example is run
+# with the local_mock compute environment at several scales (number of datapoints). The stages of the analysis are timed
+# by wrapping the methods of btap_batch that do them, and the peak memory (RSS) of the process is sampled while each stage
+# runs. The number of files in each folder of the analysis is counted at the end.
+#
+# The results are printed and appended to a history file. A stage whose time is more than the tolerance above the median
+# of the previous runs at the same scale is reported as a regression, and the script exits with 1 so it can be used in
+# CI. Run it from the root of the repository, for example
+#
+#   python utilities/benchmark_orchestration.py --scales 1000 10000 100000
+#
+# Peak memory is read from /proc and is only available on Linux.
+
+import argparse
+import csv
+import datetime
+import functools
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import src.btap_batch as btap
+
+# Stages of an analysis and the methods that do them. Stages are reported by their summed time (total_s) and by the time
+# at least one call was running (wall_s). They differ for methods that run in the analysis threads.
+STAGES = {
+    'backend_setup': [(btap.LocalMockBatch, 'setup')],
+    'scenario_generation': [(btap.BTAPSamplingLHS, 'compute_scenarios')],
+    'run_datapoint': [(btap.BTAPAnalysis, 'run_datapoint')],
+    'simulator': [(btap.LocalMockBatch, 'job')],
+    'save_results': [(btap.BTAPAnalysis, 'save_results_to_database')],
+    'read_results': [(btap.PostProcessResults, '__init__')],
+    'reference_comparisons': [(btap.PostProcessResults, 'reference_comparisons')],
+    'get_files': [(btap.PostProcessResults, 'get_files')],
+    'hourly_store': [(btap.PostProcessResults, 'save_hourly_results_store')],
+    'excel_write': [(btap.PostProcessResults, 'save_excel_output')],
+    'hourly_operations': [(btap.PostProcessResults, 'operation_on_hourly_output')],
+}
+
+# Columns of the history file.
+HISTORY_COLUMNS = ['date', 'revision', 'scale', 'stage', 'calls', 'total_s', 'wall_s', 'peak_rss_mb', 'files']
+
+# Stages shorter than this (s) are not checked for regressions. Their times are mostly noise.
+REGRESSION_MIN_SECONDS = 1.0
+
+# Interval (s) between two samples of the memory of the process.
+RSS_SAMPLE_INTERVAL = 0.02
+
+
+# Times the stages and samples the peak memory while they run.
+class StageRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.active = {}
+        self.running = False
+        self.sampler = None
+
+    # Current memory of the process in MB, or None if it cannot be read.
+    @staticmethod
+    def rss_mb():
+        try:
+            with open('/proc/self/statm', 'r') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def start(self):
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.running = False
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def sample(self):
+        while self.running:
+            rss = self.rss_mb()
+            with self.lock:
+                for stage in self.active:
+                    self.record_rss(stage, rss)
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    def record_rss(self, stage, rss):
+        if rss is not None:
+            record = self.stages[stage]
+            record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0.0, rss)
+
+    def enter(self, stage):
+        now = time.perf_counter()
+        with self.lock:
+            record = self.stages.setdefault(stage, {'calls': 0, 'total_s': 0.0, 'wall_s': 0.0, 'wall_start': now,
+                                                    'peak_rss_mb': None})
+            record['calls'] += 1
+            if stage not in self.active:
+                record['wall_start'] = now
+            self.active[stage] = self.active.get(stage, 0) + 1
+            self.record_rss(stage, self.rss_mb())
+        return now
+
+    def exit(self, stage, start):
+        now = time.perf_counter()
+        with self.lock:
+            record = self.stages[stage]
+            record['total_s'] += now - start
+            self.active[stage] -= 1
+            if self.active[stage] == 0:
+                record['wall_s'] += now - record['wall_start']
+                del self.active[stage]
+            self.record_rss(stage, self.rss_mb())
+
+    # Replaces the methods of the stages with wrappers that time them.
+    def instrument(self):
+        for stage, methods in STAGES.items():
+            for cls, name in methods:
+                setattr(cls, name, self.wrap(stage, getattr(cls, name)))
+
+    def wrap(self, stage, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = self.enter(stage)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.exit(stage, start)
+
+        return wrapper
+
+    # Returns the results of the stages recorded since the last reset and resets them.
+    def collect(self):
+        with self.lock:
+            stages = self.stages
+            self.stages = {}
+        results = {}
+        for stage in STAGES.keys():
+            if stage in stages:
+                record = stages[stage]
+                results[stage] = {'calls': record['calls'],
+                                  'total_s': record['total_s'],
+                                  'wall_s': record['wall_s'],
+                                  'peak_rss_mb': record['peak_rss_mb']}
+        return results
+
+
+# Number of files in the input, output and results folders of the analysis. The folders of the results folder are
+# counted separately.
+def count_files(folder):
+    counts = {}
+    for root, dirs, files in os.walk(folder):
+        if len(files) > 0:
+            parts = os.path.relpath(root, folder).split(os.sep)
+            key = '/'.join(parts[:2]) if parts[0] == 'results' else parts[0]
+            counts[key] = counts.get(key, 0) + len(files)
+    return counts
+
+
+# Writes the input.yml file of an LHS analysis of scale datapoints in project_folder.
+def write_input_file(project_folder, scale, latency, failure_rate, threads, hourly):
+    example = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'examples', 'sample-lhs', 'input.yml')
+    with open(example, 'r') as stream:
+        analysis = yaml.safe_load(stream)
+    analysis_config = analysis[':analysis_configuration']
+    analysis_config[':compute_environment'] = 'local_mock'
+    analysis_config[':local_mock'] = {':latency': latency, ':latency_sigma': 0.5, ':failure_rate': failure_rate,
+                                      ':threads': threads, ':hourly_outputs': hourly}
+    analysis_config[':analysis_name'] = f"benchmark_{scale}"
+    analysis_config[':algorithm'][':n_samples'] = scale
+    analysis_config[':run_reference'] = True
+    analysis_config[':datapoint_cache'] = False
+    analysis_config[':resume'] = False
+    analysis_config[':output_variables'] = []
+    analysis_config[':output_meters'] = []
+    if hourly:
+        analysis_config[':output_variables'] = [
+            {'key': '*', 'variable': 'Lights Total Heating Energy', 'frequency': 'hourly', 'operation': 'sum',
+             'unit': 'GJ'}]
+    os.makedirs(project_folder, exist_ok=True)
+    input_file = os.path.join(project_folder, 'input.yml')
+    with open(input_file, 'w') as outfile:
+        yaml.dump(analysis, outfile, default_flow_style=False)
+    return input_file
+
+
+# Runs the analysis at one scale and returns the rows of the history file.
+def run_scale(recorder, output_folder, scale, latency, failure_rate, threads, hourly, date, revision):
+    project_folder = os.path.join(output_folder, f"scale_{scale}")
+    if os.path.isdir(project_folder):
+        shutil.rmtree(project_folder)
+    input_file = write_input_file(project_folder, scale, latency, failure_rate, threads, hourly)
+
+    recorder.collect()
+    start = time.perf_counter()
+    bb = btap.btap_batch(analysis_config_file=input_file, git_api_token=None)
+    bb.run()
+    total_s = time.perf_counter() - start
+    stages = recorder.collect()
+
+    analysis_folder = os.path.join(bb.project_root, bb.analysis_config[':analysis_name'], bb.analysis_config[':analysis_id'])
+    files = count_files(analysis_folder)
+    stages['total'] = {'calls': 1, 'total_s': total_s, 'wall_s': total_s, 'peak_rss_mb': StageRecorder.rss_mb()}
+    # Time spent in run_datapoint that was not spent in the simulator.
+    if 'run_datapoint' in stages and 'simulator' in stages:
+        stages['run_datapoint_overhead'] = {
+            'calls': stages['run_datapoint']['calls'],
+            'total_s': stages['run_datapoint']['total_s'] - stages['simulator']['total_s'],
+            'wall_s': None,
+            'peak_rss_mb': None}
+
+    rows = []
+    for stage, record in stages.items():
+        rows.append({'date': date, 'revision': revision, 'scale': scale, 'stage': stage, 'calls': record['calls'],
+                     'total_s': round(record['total_s'], 3),
+                     'wall_s': None if record['wall_s'] is None else round(record['wall_s'], 3),
+                     'peak_rss_mb': None if record['peak_rss_mb'] is None else round(record['peak_rss_mb'], 1),
+                     'files': ''})
+    for folder, count in sorted(files.items()):
+        rows.append({'date': date, 'revision': revision, 'scale': scale, 'stage': f"files:{folder}", 'calls': '',
+                     'total_s': '', 'wall_s': '', 'peak_rss_mb': '', 'files': count})
+    return rows
+
+
+def read_history(history_file):
+    if not os.path.isfile(history_file):
+        return []
+    with open(history_file, 'r', newline='') as file:
+        return list(csv.DictReader(file))
+
+
+def append_history(history_file, rows):
+    new_file = not os.path.isfile(history_file)
+    with open(history_file, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=HISTORY_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+# Time of a row used to find regressions. The wall time if the stage has one, otherwise the summed time.
+def row_time(row):
+    for column in ['wall_s', 'total_s']:
+        if row[column] not in ['', None]:
+            return float(row[column])
+    return None
+
+
+# Returns messages for the stages that are slower than tolerance times the median of the previous runs.
+def find_regressions(rows, history, tolerance):
+    regressions = []
+    for row in rows:
+        current = row_time(row)
+        if current is None or current < REGRESSION_MIN_SECONDS:
+            continue
+        previous = [row_time(entry) for entry in history
+                    if entry['stage'] == row['stage'] and int(entry['scale']) == row['scale']]
+        previous = [value for value in previous if value is not None]
+        if len(previous) == 0:
+            continue
+        median = statistics.median(previous)
+        if current > tolerance * median:
+            regressions.append(f"{row['stage']} at {row['scale']} datapoints took {current:.2f}s. "
+                               f"The median of {len(previous)} previous runs is {median:.2f}s.")
+    return regressions
+
+
+def print_rows(rows):
+    print(f"{'scale':>8} {'stage':<40} {'calls':>8} {'total_s':>10} {'wall_s':>10} {'peak_rss_mb':>12} {'files':>8}")
+    for row in rows:
+        print(f"{row['scale']:>8} {row['stage']:<40} {str(row['calls']):>8} {str(row['total_s']):>10} "
+              f"{str(row['wall_s']):>10} {str(row['peak_rss_mb']):>12} {str(row['files']):>8}")
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the orchestration overhead of btap_batch.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Number of datapoints of each benchmark analysis.')
+    parser.add_argument('--output_folder', default=os.path.join(os.getcwd(), 'benchmark_output'),
+                        help='Folder of the benchmark analyses.')
+    parser.add_argument('--history_file', default=None,
+                        help='History of the results. Defaults to benchmark_history.csv in the output folder.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Median time (s) of a mock simulation.')
+    parser.add_argument('--failure_rate', type=float, default=0.0, help='Fraction of mock simulations that fail.')
+    parser.add_argument('--threads', type=int, default=None, help='Number of mock simulations run at the same time.')
+    parser.add_argument('--hourly', action='store_true', help='Write and process hourly outputs.')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='A stage is a regression if it takes longer than this times the median of previous runs.')
+    parser.add_argument('--keep', action='store_true', help='Keep the analysis folders.')
+    args = parser.parse_args()
+
+    history_file = args.history_file or os.path.join(args.output_folder, 'benchmark_history.csv')
+    os.makedirs(args.output_folder, exist_ok=True)
+    history = read_history(history_file)
+    date = datetime.datetime.now().isoformat(timespec='seconds')
+    revision = git_revision()
+
+    recorder = StageRecorder()
+    recorder.instrument()
+    recorder.start()
+    rows = []
+    try:
+        for scale in args.scales:
+            scale_rows = run_scale(recorder, args.output_folder, scale, args.latency, args.failure_rate, args.threads,
+                                   args.hourly, date, revision)
+            rows.extend(scale_rows)
+            if not args.keep:
+                shutil.rmtree(os.path.join(args.output_folder, f"scale_{scale}"), ignore_errors=True)
+    finally:
+        recorder.stop()
+
+    print_rows(rows)
+    regressions = find_regressions(rows, history, args.tolerance)
+    append_history(history_file, rows)
+    print(f"Results appended to {history_file}")
+    if len(regressions) > 0:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"\t{regression}")
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
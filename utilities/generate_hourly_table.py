@@ -2,6 +2,9 @@
 # through the hourly results csv for each datapoint in the folder and collect them all into one csv file called
 # 'total_hourly_res.csv'.  The 'tatal_hourly_res.csv' file is saved in the same directory as the individual hourly
 # results files.
+# The files are streamed to the output file one line at a time so large analyses do not have to fit in memory. The
+# results folder of an analysis also has the hourly outputs in a memory mapped format (results/hourly) that can be read
+# with HourlyResultsStore in btap_batch.py.
 
 import os
 
@@ -9,37 +12,30 @@ import os
 curr_dir = os.getcwd()
 output_file = os.path.join(curr_dir, "total_hourly_res.csv")
 
-# Initilalize the output list
-concat_data = []
+# Files in the folder that are not hourly results of a datapoint.
+skipped_files = ["total_hourly_res.csv", "sum_hourly_res.csv"]
 
 # first_read is used to determine weather or not to write the header to the output file
 first_read = True
 
-# Go through all of the objects in the output folder
-for file_object in os.listdir(curr_dir):
-    # Set the absolute location of the current file object we are looking at
-    datapoint = os.path.join(curr_dir, file_object)
-    # Check if it is a file
-    if os.path.isfile(datapoint):
-        # If it is a file check if it is a csv file
-        if str(datapoint).lower().endswith('.csv'):
-            # If it is a csv file make sure it is not the output file
-            if str(datapoint).lower() != "total_hourly_res.csv":
-                # Open the file and add it to the concat_data list which collects the hourly data from all of the files
-                with open(datapoint) as f:
-                    lines = f.readlines()
-                    line_num = 0
-                    # If this is the first time looking at a file add the header data to the output list, otherwise don't
-                    for line in lines:
-                        if first_read and line_num == 0:
-                            concat_data.append(line)
+with open(output_file, 'w') as f_out:
+    # Go through all of the objects in the output folder
+    for file_object in os.listdir(curr_dir):
+        # Set the absolute location of the current file object we are looking at
+        datapoint = os.path.join(curr_dir, file_object)
+        # Check if it is a file
+        if os.path.isfile(datapoint):
+            # If it is a file check if it is a csv file
+            if str(datapoint).lower().endswith('.csv'):
+                # If it is a csv file make sure it is not the output file
+                if file_object.lower() not in skipped_files:
+                    # Open the file and add its lines to the output file
+                    with open(datapoint) as f:
+                        # If this is the first time looking at a file add the header data to the output file, otherwise don't
+                        header = f.readline()
+                        if first_read and header:
+                            f_out.write(header)
                             first_read = False
-                        if line_num > 0:
-                            concat_data.append(line)
-                        line_num += 1
-
-# Write the hourly data list to the output file
-f_out = open(output_file, 'w')
-for out_line in concat_data:
-    f_out.write(out_line)
-f_out.close()
\ No newline at end of file
+                        for line in f:
+                            # Make sure the last line of a file without a trailing newline does not run into the next file.
+                            f_out.write(line if line.endswith('\n') else line + '\n')